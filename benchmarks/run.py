@@ -0,0 +1,197 @@
+""" Offline benchmarks of the lookup stages and the WSGI app on a synthetic datadir (see benchmarks/synthetic.py):
+
+    python -m benchmarks.run --datadir /tmp/xylookup-bench --output results.json
+    python -m benchmarks.run --compare before.json after.json
+
+The datadir is created when it doesn't exist. Every benchmark runs on the uniform, coastal and duplicated point sets
+at each batch size and reports the best and median time of --repeat runs. Results are stored as JSON together with
+the git commit and library versions; --compare prints the ratio per benchmark and exits with 1 when one of them got
+slower than --threshold.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import scipy
+import service.config as config
+import benchmarks.synthetic as synthetic
+
+POINTSETS = ['uniform', 'coastal', 'duplicated']
+BATCHSIZES = [1, 100, 10000, 100000]
+APP_OPTIONS = {'areas': False, 'grids': True, 'shoredistance': True}
+
+
+def configure(datadir):
+    """ Points the service at the synthetic datadir, without the database: no areas and the landmask for on land.
+    Call before the subsystems are loaded. """
+    config.datadir = datadir
+    config.landmaskdir = os.path.join(datadir, 'landmask')
+    config.areasdir = os.path.join(datadir, 'areas')
+    config.onland = 'landmask'
+    config.areas_engine = 'postgis'  # areas are not benchmarked, they need the database or an exported index
+    config.result_cache_precision = None
+    config.init_mode = 'lazy'
+
+
+def _stage_benchmarks():
+    import service.dedup as dedup
+    import service.landmask as landmask
+    import service.rasters as rasters
+    import service.shoredistance as shoredistance
+    return [('dedup', lambda points: dedup.unique_points(points)),
+            ('rasters', rasters.get_columns),
+            ('coastlinedistance', shoredistance.get_coastlinedistances),
+            ('landmask', landmask.on_land)]
+
+
+def _app_benchmarks():
+    from falcon import testing
+    import msgpack
+    import service.app as app
+    import service.lookup as lookup
+    client = testing.TestClient(app.create())
+
+    def post(body, content_type, query=None):
+        result = client.simulate_post('/lookup', body=body, query_string=query, headers={'Content-Type': content_type})
+        assert result.status_code == 200, result.text
+    # the request bodies are encoded before the timing starts, binary bodies have the options in the query string
+    query = '&'.join('{}={}'.format(k, str(v).lower()) for k, v in sorted(APP_OPTIONS.items())) + '&format=columns'
+    return [('app_json', lambda points: json.dumps(dict(APP_OPTIONS, points=points.tolist())),
+             lambda body: post(body, 'application/json')),
+            ('app_msgpack', lambda points: msgpack.dumps(dict(APP_OPTIONS, points=points.tolist()), use_bin_type=True),
+             lambda body: post(body, 'application/msgpack')),
+            ('app_binary_columns', lambda points: points.astype('<f8').tobytes(),
+             lambda body: post(body, lookup.MEDIA_BINARY, query))]
+
+
+def _timeit(f, arg, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        f(arg)
+        times.append(time.time() - start)
+    return times
+
+
+def _result(name, pointset, batchsize, times):
+    best = min(times)
+    return {'benchmark': name, 'points': pointset, 'batchsize': batchsize, 'best': best,
+            'median': float(np.median(times)), 'points_per_second': batchsize / best if best > 0 else None}
+
+
+def load_times():
+    """ Seconds to load each subsystem in this process (the coastline cache is built on the first run) """
+    import service.startup as startup
+    times = {}
+    for name in startup.required():
+        start = time.time()
+        startup.get(name).load()
+        times[name] = time.time() - start
+    return times
+
+
+def run(datadir, batchsizes=BATCHSIZES, pointsets=POINTSETS, repeat=5, only=None, seed=1):
+    """ Runs the benchmarks and returns the results as a dict """
+    if not os.path.exists(os.path.join(datadir, 'synthetic.json')):
+        synthetic.create_datadir(datadir)
+    configure(datadir)
+    rings = synthetic.load_islands(datadir)
+    results = {'meta': _meta(datadir, repeat), 'load': load_times(), 'results': []}
+    rng = np.random.RandomState(seed)
+    points = dict((kind, synthetic.create_points(rng, max(batchsizes), kind, rings)) for kind in pointsets)
+    for name, f in _stage_benchmarks():
+        if only and name not in only:
+            continue
+        for kind in pointsets:
+            for batchsize in batchsizes:
+                f(points[kind][:batchsize])  # warm up
+                results['results'].append(_result(name, kind, batchsize, _timeit(f, points[kind][:batchsize], repeat)))
+    for name, encode, f in _app_benchmarks():
+        if only and name not in only:
+            continue
+        for kind in pointsets:
+            for batchsize in batchsizes:
+                body = encode(points[kind][:batchsize])
+                f(body)
+                results['results'].append(_result(name, kind, batchsize, _timeit(f, body, repeat)))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _meta(datadir, repeat):
+    with open(os.path.join(datadir, 'synthetic.json')) as f:
+        data = json.load(f)
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': _git_commit(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'scipy': scipy.__version__, 'machine': platform.machine(),
+            'cpus': multiprocessing.cpu_count(), 'data': data, 'repeat': repeat,
+            'stage_workers': config.stage_workers}
+
+
+def compare(before, after, threshold=0.1):
+    """ [(benchmark, points, batchsize, before, after, ratio)] for the benchmarks in both runs, ratio is after/before
+    of the best times, and whether one of them is more than threshold slower """
+    key = lambda r: (r['benchmark'], r['points'], r['batchsize'])
+    old = dict((key(r), r['best']) for r in before['results'])
+    rows = [key(r) + (old[key(r)], r['best'], r['best'] / old[key(r)] if old[key(r)] > 0 else float('inf'))
+            for r in after['results'] if key(r) in old]
+    return rows, any(row[-1] > 1 + threshold for row in rows)
+
+
+def format_results(results):
+    lines = ['{:<20} {:<11} {:>9} {:>10} {:>10} {:>12}'.format('benchmark', 'points', 'batch', 'best ms', 'median ms',
+                                                               'points/s')]
+    for r in results['results']:
+        lines.append('{:<20} {:<11} {:>9} {:>10.2f} {:>10.2f} {:>12.0f}'.format(
+            r['benchmark'], r['points'], r['batchsize'], r['best'] * 1000, r['median'] * 1000,
+            r['points_per_second'] or 0))
+    return '\n'.join(lines)
+
+
+def format_compare(rows, threshold=0.1):
+    lines = ['{:<20} {:<11} {:>9} {:>10} {:>10} {:>7}'.format('benchmark', 'points', 'batch', 'before ms', 'after ms',
+                                                              'ratio')]
+    for name, kind, batchsize, old, new, ratio in rows:
+        lines.append('{:<20} {:<11} {:>9} {:>10.2f} {:>10.2f} {:>7.2f}{}'.format(
+            name, kind, batchsize, old * 1000, new * 1000, ratio, ' slower' if ratio > 1 + threshold else ''))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks on a synthetic datadir')
+    parser.add_argument('--datadir', default='/tmp/xylookup-bench')
+    parser.add_argument('--output', help='JSON file for the results')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in BATCHSIZES), help='comma separated batch sizes')
+    parser.add_argument('--points', default=','.join(POINTSETS), help='comma separated point sets')
+    parser.add_argument('--only', help='comma separated benchmark names')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as a regression')
+    args = parser.parse_args(argv)
+    if args.compare:
+        with open(args.compare[0]) as f1, open(args.compare[1]) as f2:
+            rows, regression = compare(json.load(f1), json.load(f2), args.threshold)
+        print(format_compare(rows, args.threshold))
+        return 1 if regression else 0
+    results = run(args.datadir, [int(s) for s in args.sizes.split(',')], args.points.split(','), args.repeat,
+                  args.only.split(',') if args.only else None)
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
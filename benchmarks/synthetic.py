@@ -0,0 +1,180 @@
+""" Synthetic datadir for the benchmarks, no PostgreSQL or source rasters needed:
+
+    python -m benchmarks.synthetic /tmp/xylookup-bench [--scale 0.5] [--tilesize 256]
+
+Writes rasters in the rasters.metadata/.mmf layout of dataprep/rasters.py (or as compressed tiles), coastlines as
+jsonlines like the shoredistance source and a landmask in the layout of dataprep/landmask.py. The coastlines are
+closed rings around random islands, the landmask marks the cells around the islands as MIXED with the cell border and
+the island rings as edges, so points inside an island are on land. Everything is generated from a seed so two runs
+with the same arguments produce the same files.
+"""
+import argparse
+import json
+import os
+import numpy as np
+from service.landmask import WATER, MIXED
+from service.tiles import TileWriter
+
+RASTERS = [  # id, category, cell size in degrees, dtype, nodata, scale_factor, bounds (minx, miny, maxx, maxy)
+    ('global_bathy', 'bathymetry', 0.1, 'int16', 32767, -1, (-180, -90, 180, 90)),
+    ('regional_bathy', 'bathymetry', 0.01, 'float32', -9999.0, 1.0, (-10, 40, 10, 60)),
+    ('sst', 'sstemperature', 1 / 12.0, 'float32', -9999.0, 1.0, (-180, -90, 180, 90)),
+    ('sss', 'sssalinity', 1 / 12.0, 'float32', -9999.0, 1.0, (-180, -90, 180, 90)),
+]
+
+
+def _raster_values(rng, x, y, dtype, nodata):
+    """ Smooth field with noise and rectangular nodata patches """
+    values = 1000 * np.sin(np.radians(x) * 3) * np.cos(np.radians(y) * 2) + rng.normal(0, 10, (len(y), len(x)))
+    values = values.astype(dtype)
+    for _ in range(20):
+        r, c = rng.randint(0, len(y)), rng.randint(0, len(x))
+        values[r:r + len(y) // 20, c:c + len(x) // 20] = nodata
+    return values
+
+
+def create_rasters(outdir, rng, scale=1.0, tilesize=None):
+    """ One raster per entry of RASTERS, scale < 1 makes the cells larger (and the files smaller) """
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    metadata = []
+    for rid, category, res, dtype, nodata, scale_factor, (minx, miny, maxx, maxy) in RASTERS:
+        res = res / scale
+        ncol, nrow = int(round((maxx - minx) / res)), int(round((maxy - miny) / res))
+        x = minx + (np.arange(ncol) + 0.5) * res
+        y = maxy - (np.arange(nrow)[:, None] + 0.5) * res
+        values = _raster_values(rng, x, y, dtype, nodata)
+        if tilesize:
+            writer = TileWriter(os.path.join(outdir, rid), values.shape, values.dtype, tilesize, fill=nodata)
+            for row in range(0, nrow, tilesize):
+                writer.write_rows(values[row:row + tilesize])
+            writer.close()
+        else:
+            fp = np.memmap(os.path.join(outdir, rid + '.mmf'), dtype=values.dtype, mode='w+', shape=values.shape)
+            fp[:] = values
+            del fp  # flush to disk
+        meta = {'id': rid, 'category': category, 'shape': [nrow, ncol], 'dtype': dtype, 'minx': minx, 'miny': miny,
+                'maxx': maxx, 'maxy': maxy, 'xres': res, 'yres': -res, 'nodata': nodata,
+                'bandinfo': {'scale_factor': scale_factor, 'add_offset': 0}, 'rasterinfo': {}}
+        if tilesize:
+            meta['tiles'] = {'size': tilesize, 'compression': 'zlib'}
+        metadata.append(meta)
+    with open(os.path.join(outdir, 'rasters.metadata'), 'w') as f:
+        json.dump(metadata, f)
+
+
+def create_islands(rng, n, maxradius=0.5, nvertices=(6, 40)):
+    """ Closed rings (counter clockwise) that don't overlap, each island stays within its own cell of 2 * maxradius
+    degrees. Half of the islands are placed near the other half so there are coastal clusters. """
+    size = 2 * maxradius
+    ncol, nrow = int(358 // size), int(160 // size)
+    cells = []
+    taken = set()
+    while len(cells) < min(n, ncol * nrow // 2):
+        if len(cells) < n // 2 or not cells:
+            cell = (rng.randint(0, nrow), rng.randint(0, ncol))
+        else:
+            r, c = cells[rng.randint(0, len(cells))]
+            cell = (int(np.clip(r + rng.normal(0, 2 / size), 0, nrow - 1)),
+                    int(np.clip(c + rng.normal(0, 2 / size), 0, ncol - 1)))
+        if cell not in taken:
+            taken.add(cell)
+            cells.append(cell)
+    rings = []
+    for r, c in cells:
+        cx, cy = -179 + (c + 0.5) * size, -80 + (r + 0.5) * size
+        cx, cy = cx + rng.uniform(-0.2, 0.2) * maxradius, cy + rng.uniform(-0.2, 0.2) * maxradius
+        k = rng.randint(nvertices[0], nvertices[1])
+        angles = np.sort(rng.uniform(0, 2 * np.pi, k))
+        radius = rng.uniform(0.2, 1, k) * rng.uniform(0.02, 0.8) * maxradius
+        ring = np.column_stack((cx + radius * np.cos(angles), cy + radius * np.sin(angles)))
+        rings.append(np.vstack((ring, ring[:1])))
+    return rings
+
+
+def create_coastlines(path, rings):
+    """ Writes the rings as LineStrings in the jsonlines format read by service/shoredistance.py """
+    with open(path, 'w') as f:
+        for ring in rings:
+            f.write(json.dumps({'type': 'LineString', 'coordinates': np.round(ring, 7).tolist()}) + '\n')
+
+
+def create_landmask(outdir, rings, resolution=0.25):
+    """ Landmask with the islands as land: cells overlapping the bounding box of an island are MIXED, their edges are
+    the cell border and the island rings so the even-odd test gives water inside the cell and outside the islands """
+    minx, maxy = -180.0, 90.0
+    nrow, ncol = int(round(180 / resolution)), int(round(360 / resolution))
+    mask = np.full((nrow, ncol), WATER, dtype=np.uint8)
+    cellrings = {}
+    for i, ring in enumerate(rings):
+        (x0, y0), (x1, y1) = ring.min(axis=0), ring.max(axis=0)
+        for r in range(int((maxy - y1) // resolution), int((maxy - y0) // resolution) + 1):
+            for c in range(int((x0 - minx) // resolution), int((x1 - minx) // resolution) + 1):
+                cellrings.setdefault(r * ncol + c, []).append(i)
+    cells = np.array(sorted(cellrings), dtype=np.int64)
+    edges = []
+    for cell in cells.tolist():
+        r, c = divmod(cell, ncol)
+        left, top = minx + c * resolution, maxy - r * resolution
+        border = np.array([[left, top - resolution], [left + resolution, top - resolution],
+                           [left + resolution, top], [left, top], [left, top - resolution]])
+        celledges = [np.column_stack((border[:-1], border[1:]))]
+        celledges += [np.column_stack((rings[i][:-1], rings[i][1:])) for i in cellrings[cell]]
+        edges.append(np.concatenate(celledges))
+        mask[r, c] = MIXED
+    offsets = np.concatenate([[0], np.cumsum([len(e) for e in edges])]).astype(np.int64)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    np.save(os.path.join(outdir, 'mask.npy'), mask)
+    np.save(os.path.join(outdir, 'cells.npy'), cells)
+    np.save(os.path.join(outdir, 'offsets.npy'), offsets)
+    np.save(os.path.join(outdir, 'edges.npy'), np.concatenate(edges) if edges else np.zeros((0, 4)))
+    with open(os.path.join(outdir, 'landmask.json'), 'w') as f:
+        json.dump({'minx': minx, 'maxy': maxy, 'resolution': resolution, 'source': 'synthetic'}, f)
+
+
+def create_points(rng, n, kind, rings=None):
+    """ Point sets for the benchmarks: 'uniform' over the globe, 'coastal' within about 10 km of island vertices
+    and 'duplicated' with every coordinate repeated about 10 times """
+    if kind == 'uniform':
+        return np.column_stack((rng.uniform(-180, 180, n), rng.uniform(-90, 90, n)))
+    elif kind == 'coastal':
+        vertices = np.concatenate(rings)
+        points = vertices[rng.randint(0, len(vertices), n)] + rng.normal(0, 0.1, (n, 2))
+        return np.clip(points, [-180, -90], [180, 90])
+    elif kind == 'duplicated':
+        distinct = create_points(rng, max(1, n // 10), 'uniform')
+        return distinct[rng.randint(0, len(distinct), n)]
+    raise ValueError('Unknown point set {}'.format(kind))
+
+
+def create_datadir(datadir, scale=1.0, nislands=20000, tilesize=None, seed=42):
+    """ Writes the rasters, coastlines and landmask of a synthetic datadir and returns the island rings """
+    rng = np.random.RandomState(seed)
+    create_rasters(os.path.join(datadir, 'rasters'), rng, scale, tilesize)
+    rings = create_islands(rng, nislands)
+    shoredir = os.path.join(datadir, 'shoredistance')
+    if not os.path.exists(shoredir):
+        os.makedirs(shoredir)
+    create_coastlines(os.path.join(shoredir, 'coastlines5.jsonlines'), rings)
+    create_landmask(os.path.join(datadir, 'landmask'), rings)
+    with open(os.path.join(datadir, 'synthetic.json'), 'w') as f:
+        json.dump({'scale': scale, 'nislands': nislands, 'tilesize': tilesize, 'seed': seed}, f)
+    return rings
+
+
+def load_islands(datadir):
+    """ The island rings of a synthetic datadir, read back from the coastlines """
+    with open(os.path.join(datadir, 'shoredistance', 'coastlines5.jsonlines')) as f:
+        return [np.array(json.loads(line)['coordinates']) for line in f]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a synthetic datadir for the benchmarks')
+    parser.add_argument('datadir')
+    parser.add_argument('--scale', type=float, default=1.0, help='raster resolution relative to the production rasters')
+    parser.add_argument('--islands', type=int, default=20000)
+    parser.add_argument('--tilesize', type=int, default=None, help='store the rasters as compressed tiles')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    create_datadir(args.datadir, args.scale, args.islands, args.tilesize, args.seed)
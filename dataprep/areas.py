@@ -0,0 +1,67 @@
+import numpy as np
+import os
+import json
+import logging
+import psycopg2
+import service.config as config
+import service.geometry as geometry
+
+
+logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+
+
+def export_table(cur, table, columns, outdir, resolution):
+    """ Exports the polygons of an areas table and their index cells for service/areaindex.py """
+    logging.info("export_table %s", table)
+    minx, maxy = -180.0, 90.0
+    nrow, ncol = int(round(180 / resolution)), int(round(360 / resolution))
+    cur.execute("""CREATE TEMP TABLE xylookup_export ON COMMIT DROP AS
+                   SELECT (row_number() OVER ()) - 1 AS pid, {}, geom FROM {}""".format(", ".join(columns), table))
+    cur.execute("SELECT {}, ST_AsBinary(geom) FROM xylookup_export ORDER BY pid".format(", ".join(columns)))
+    attributes, edges = [], []
+    for row in cur.fetchall():
+        attributes.append(list(row[:-1]))
+        rings = geometry.polygon_rings(row[-1])
+        edges.append(np.concatenate([geometry.ring_edges(ring) for ring in rings]) if rings else np.zeros((0, 4)))
+    cur.execute("""
+      WITH cells AS (
+        SELECT pid, r, c, ST_MakeEnvelope(%(minx)s + c * %(res)s, %(maxy)s - (r + 1) * %(res)s,
+                                          %(minx)s + (c + 1) * %(res)s, %(maxy)s - r * %(res)s, 4326) AS env
+          FROM xylookup_export,
+               generate_series(greatest(floor((%(maxy)s - ST_YMax(geom)) / %(res)s)::integer, 0),
+                               least(floor((%(maxy)s - ST_YMin(geom)) / %(res)s)::integer, %(nrow)s - 1)) r,
+               generate_series(greatest(floor((ST_XMin(geom) - %(minx)s) / %(res)s)::integer, 0),
+                               least(floor((ST_XMax(geom) - %(minx)s) / %(res)s)::integer, %(ncol)s - 1)) c
+      )
+      SELECT r * %(ncol)s + c AS cell, pid, ST_Covers(p.geom, env)
+        FROM cells JOIN xylookup_export p USING (pid)
+       WHERE ST_Intersects(p.geom, env)
+       ORDER BY cell, pid""", {'minx': minx, 'maxy': maxy, 'res': resolution, 'nrow': nrow, 'ncol': ncol})
+    cells = np.array(cur.fetchall(), dtype=np.int64).reshape(-1, 3)
+    cur.connection.rollback()
+
+    tabledir = os.path.join(outdir, table)
+    if not os.path.exists(tabledir):
+        os.makedirs(tabledir)
+    np.save(os.path.join(tabledir, 'edges.npy'), np.concatenate(edges) if edges else np.zeros((0, 4)))
+    np.save(os.path.join(tabledir, 'offsets.npy'), np.concatenate([[0], np.cumsum([len(e) for e in edges])]).astype(np.int64))
+    np.save(os.path.join(tabledir, 'cells.npy'), cells[:, 0])
+    np.save(os.path.join(tabledir, 'polygons.npy'), cells[:, 1])
+    np.save(os.path.join(tabledir, 'covers.npy'), cells[:, 2].astype(bool))
+    json.dump(attributes, open(os.path.join(tabledir, 'attributes.json'), 'w'))
+    metadata = {'table': table, 'columns': columns, 'minx': minx, 'maxy': maxy, 'resolution': resolution,
+                'nrow': nrow, 'ncol': ncol}
+    json.dump(metadata, open(os.path.join(tabledir, 'index.json'), 'w'))
+
+
+def export_areas(outdir, resolution=0.5):
+    """ Exports all areas tables in config.areas, resolution is the size in degrees of the index cells """
+    logging.info("export_areas")
+    with psycopg2.connect(config.connstring) as conn:
+        with conn.cursor() as cur:
+            for table, (alias, columns) in config.areas.items():
+                export_table(cur, table, columns, outdir, resolution)
+
+
+if __name__ == '__main__':
+    export_areas(config.areasdir)
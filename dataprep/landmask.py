@@ -0,0 +1,88 @@
+import numpy as np
+import os
+import json
+import logging
+import psycopg2
+import service.config as config
+import service.geometry as geometry
+from service.landmask import LAND, WATER, MIXED
+
+
+logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+water_table = 'water_polygons0_00005'
+
+
+def classify_block(cur, minx, maxy, resolution, nrow, ncol):
+    """ Classifies the cells of one block as LAND, WATER or MIXED, for MIXED cells the edges of the water
+    polygons clipped to the cell are returned as well """
+    states = np.full((nrow, ncol), LAND, dtype=np.uint8)
+    edges = {}
+    env = (minx, maxy - nrow * resolution, minx + ncol * resolution, maxy)
+    cur.execute("""SELECT count(*), coalesce(bool_or(ST_Covers(geom, env)), false)
+                     FROM {} w, (SELECT ST_MakeEnvelope(%s, %s, %s, %s, 4326) AS env) b
+                    WHERE w.geom && env AND ST_Intersects(w.geom, env)""".format(water_table), env)
+    count, covered = cur.fetchone()
+    if count == 0:
+        return states, edges
+    elif covered:
+        states[:] = WATER
+        return states, edges
+    cur.execute("""
+      WITH cells AS (
+        SELECT r, c, ST_MakeEnvelope(%(minx)s + c * %(res)s, %(maxy)s - (r + 1) * %(res)s,
+                                     %(minx)s + (c + 1) * %(res)s, %(maxy)s - r * %(res)s, 4326) AS env
+          FROM generate_series(0, %(nrow)s - 1) r, generate_series(0, %(ncol)s - 1) c
+      )
+      SELECT r, c, fraction, CASE WHEN fraction < 1 - 1e-9 THEN ST_AsBinary(geom) END
+        FROM (SELECT r, c, ST_Area(geom) / ST_Area(env) AS fraction, geom
+                FROM (SELECT r, c, env, ST_Union(ST_Intersection(w.geom, env)) AS geom
+                        FROM cells JOIN {} w ON w.geom && env AND ST_Intersects(w.geom, env)
+                       GROUP BY r, c, env) u) t""".format(water_table),
+                {'minx': minx, 'maxy': maxy, 'res': resolution, 'nrow': nrow, 'ncol': ncol})
+    for r, c, fraction, wkb in cur.fetchall():
+        if fraction >= 1 - 1e-9:
+            states[r, c] = WATER
+        elif fraction > 0:
+            states[r, c] = MIXED
+            edges[(r, c)] = np.concatenate([geometry.ring_edges(ring) for ring in geometry.polygon_rings(wkb)])
+    return states, edges
+
+
+def create_landmask(outdir, resolution=0.05, blocksize=1.0):
+    """ Creates the land/water mask used by service/landmask.py from the water polygons in PostgreSQL.
+
+    resolution is the cell size in degrees, blocksize the size in degrees of the blocks that are classified in
+    one query. Blocks that are completely land or water are resolved without looking at the individual cells.
+    """
+    logging.info("create_landmask")
+    minx, maxy = -180.0, 90.0
+    nrow, ncol = int(round(180 / resolution)), int(round(360 / resolution))
+    blockcells = int(round(blocksize / resolution))
+    mask = np.full((nrow, ncol), LAND, dtype=np.uint8)
+    celledges = {}
+    with psycopg2.connect(config.connstring) as conn:
+        with conn.cursor() as cur:
+            for r0 in range(0, nrow, blockcells):
+                logging.info("row %s of %s", r0, nrow)
+                for c0 in range(0, ncol, blockcells):
+                    nr, nc = min(blockcells, nrow - r0), min(blockcells, ncol - c0)
+                    states, edges = classify_block(cur, minx + c0 * resolution, maxy - r0 * resolution,
+                                                   resolution, nr, nc)
+                    mask[r0:r0 + nr, c0:c0 + nc] = states
+                    for (r, c), e in edges.items():
+                        celledges[(r0 + r) * ncol + c0 + c] = e
+    cells = np.array(sorted(celledges), dtype=np.int64)
+    edges = [celledges[cell] for cell in cells]
+    offsets = np.concatenate([[0], np.cumsum([len(e) for e in edges])]).astype(np.int64)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    np.save(os.path.join(outdir, 'mask.npy'), mask)
+    np.save(os.path.join(outdir, 'cells.npy'), cells)
+    np.save(os.path.join(outdir, 'offsets.npy'), offsets)
+    np.save(os.path.join(outdir, 'edges.npy'), np.concatenate(edges) if edges else np.zeros((0, 4)))
+    metadata = {'minx': minx, 'maxy': maxy, 'resolution': resolution, 'source': water_table}
+    json.dump(metadata, open(os.path.join(outdir, 'landmask.json'), 'w'))
+
+
+if __name__ == '__main__':
+    create_landmask(config.landmaskdir)
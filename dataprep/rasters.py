@@ -1,12 +1,13 @@
 import numpy as np
-from osgeo import gdal
 import os
+import multiprocessing
 import glob
 import zipfile
 import json
 import subprocess
 import logging
 import service.config as config
+from service.tiles import TileWriter
 # import rpy2.robjects as robjects
 # for python 2.7:
 # brew install llvm
@@ -16,6 +17,9 @@ import service.config as config
 
 tmpdir = os.path.expanduser('~/a/tmp')
 outdir = os.path.join(config.datadir, 'rasters')
+tilesize = None  # e.g. 256 to store the rasters as zlib compressed tiles instead of uncompressed memory mapped files
+window_bytes = 64 * 1024 * 1024  # rasters are read and written in windows of whole rows of at most about this size
+processes = None  # conversions run in parallel in this many processes, None for one per core
 logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
 
 
@@ -26,87 +30,191 @@ def get_info(ds):
     return {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy, 'xres': xres, 'yres': yres}
 
 
+def window_rows(band, itemsize):
+    """ Rows per read window: a multiple of the block height of the band (and of tilesize) within window_bytes """
+    step = band.GetBlockSize()[1] if not tilesize else tilesize
+    rows = max(1, window_bytes // max(1, band.XSize * itemsize * step)) * step
+    return min(rows, band.YSize) if not tilesize else rows
+
+
 def create_memmap(path, outdir, outname):
-    logging.info("create_mmap")
+    """ Copies the first band of the raster at path to the memory mapped file (or tiles) outname, window by window
+    so memory use does not depend on the size of the raster """
+    from osgeo import gdal, gdal_array  # only needed for the conversion itself
+    logging.info("create_mmap " + outname)
     ds = gdal.Open(path)
     band = ds.GetRasterBand(1)
-    arr = band.ReadAsArray()
-    outpath = os.path.join(outdir, outname+'.mmf')
-    fp = np.memmap(outpath, dtype=arr.dtype, mode='w+', shape=arr.shape)
-    fp[:] = arr[:]
-    del fp  # flush to disk
-    metadata = {'id': outname, 'dtype': str(arr.dtype), 'shape': arr.shape, 'nodata': band.GetNoDataValue(),
+    shape = (band.YSize, band.XSize)
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(band.DataType))
+    rows = window_rows(band, dtype.itemsize)
+    if tilesize:
+        writer = TileWriter(os.path.join(outdir, outname), shape, dtype, tilesize, fill=band.GetNoDataValue() or 0)
+        for row in range(0, shape[0], rows):
+            arr = band.ReadAsArray(0, row, shape[1], min(rows, shape[0] - row))
+            for block in range(0, arr.shape[0], tilesize):
+                writer.write_rows(arr[block:block + tilesize])
+        writer.close()
+    else:
+        outpath = os.path.join(outdir, outname+'.mmf')
+        fp = np.memmap(outpath, dtype=dtype, mode='w+', shape=shape)
+        for row in range(0, shape[0], rows):
+            fp[row:row + rows] = band.ReadAsArray(0, row, shape[1], min(rows, shape[0] - row))
+        fp.flush()
+        del fp  # flush to disk
+    metadata = {'id': outname, 'dtype': str(dtype), 'shape': shape, 'nodata': band.GetNoDataValue(),
                 'bandinfo': band.GetMetadata_Dict(), 'rasterinfo': ds.GetMetadata_Dict()}
+    if tilesize:
+        metadata['tiles'] = {'size': tilesize, 'compression': 'zlib'}
     metadata.update(get_info(ds))
     return metadata
 
 
+def source_file(path):
+    """ The file of a GDAL path, e.g. x.nc for NETCDF:"x.nc":elevation """
+    return path.split('"')[1] if path.startswith('NETCDF:') else path
+
+
+def source_signature(path):
+    stat = os.stat(source_file(path))
+    return {'path': source_file(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
 def output_exists(outdir, outname):
-    return os.path.exists(os.path.join(outdir, outname + '.mmf')) and os.path.exists(os.path.join(outdir, outname + '.json'))
+    data = os.path.join(outdir, outname + ('.tiles' if tilesize else '.mmf'))
+    return os.path.exists(data) and os.path.exists(os.path.join(outdir, outname + '.json'))
 
 
-def emodnet2memmap(overwrite=False):
-    logging.info("emodnet2memmap")
+def up_to_date(outdir, outname, signature):
+    """ True when the output exists in the current format and was converted from the source with this signature.
+    convert removes the json before the data is rewritten and writes it last, so an interrupted conversion is never
+    up to date. """
+    if not output_exists(outdir, outname):
+        return False
+    with open(os.path.join(outdir, outname + '.json')) as f:
+        metadata = json.load(f)
+    return metadata.get('source') == signature and \
+        metadata.get('tiles', {}).get('size') == tilesize
+
+
+def write_metadata(outdir, outname, metadata):
+    tmppath = os.path.join(outdir, outname + '.json.tmp')
+    with open(tmppath, 'w') as f:
+        json.dump(metadata, f)
+    os.rename(tmppath, os.path.join(outdir, outname + '.json'))
+
+
+def convert(path, outname, category, negate=False, missing_value=None, overwrite=False, signature=None):
+    """ Converts one raster unless it is up to date, returns the outname when it was converted. The signature
+    identifies the version of the source (source_signature(path) by default). With negate the scale_factor and
+    add_offset are negated to turn elevations into depths. """
+    signature = signature or source_signature(path)
+    if not overwrite and up_to_date(outdir, outname, signature):
+        return None
+    jsonpath = os.path.join(outdir, outname + '.json')
+    if os.path.exists(jsonpath):
+        os.remove(jsonpath)  # the data is rewritten in place
+    metadata = create_memmap(path, outdir, outname)
+    metadata['category'] = category
+    metadata['source'] = signature
+    if missing_value is not None:
+        metadata['bandinfo']['missing_value'] = missing_value
+    if negate:
+        metadata['bandinfo']['scale_factor'] = -1 * float(metadata['bandinfo'].get('scale_factor', 1))
+        metadata['bandinfo']['add_offset'] = -1 * float(metadata['bandinfo'].get('add_offset', 0))
+    write_metadata(outdir, outname, metadata)
+    return outname
+
+
+def _convert(task):
+    return convert(**task)
+
+
+def run_conversions(tasks, overwrite=False, nprocesses=None):
+    """ Runs the conversion tasks (keyword arguments of convert) in a process pool, each process converts one raster
+    at a time in windows. Returns the names of the converted rasters. """
+    tasks = [dict(task, overwrite=overwrite) for task in tasks]
+    nprocesses = nprocesses or processes or multiprocessing.cpu_count()
+    if nprocesses == 1 or len(tasks) <= 1:
+        converted = [_convert(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(min(nprocesses, len(tasks)))
+        try:
+            converted = pool.map(_convert, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [name for name in converted if name]
+
+
+def emodnet_tasks(overwrite=False):
+    """ One task per .mnt file in the EMODnet zips. The signature is the zip member (name, size and CRC), so
+    extracting again or clearing tmpdir does not make a tile change. Only the members of tiles that are not up to
+    date are extracted to tmpdir. """
+    logging.info("emodnet_tasks")
     emodnet_dir = os.path.join(config.dataprepdir, 'EMODNET_Bathy')
-    # Step 1 unzip all
-    for bathyzip in glob.glob(os.path.join(emodnet_dir, "*.zip")):
+    tasks = []
+    for bathyzip in sorted(glob.glob(os.path.join(emodnet_dir, "*.zip"))):
         with zipfile.ZipFile(bathyzip, 'r') as zipf:
-            if overwrite or not os.path.exists(os.path.join(tmpdir, os.path.split(bathyzip)[1].replace('.zip', ''))):
-                zipf.extractall(tmpdir)
-    # Step 2 create memmap for all netcdf files
-    for bathymnt in glob.glob(os.path.join(tmpdir, "*.mnt")):
-        outname = 'emodnet_bathy_' + os.path.split(bathymnt)[1].replace('.mnt', '')
-        if overwrite or not output_exists(outdir, outname):
-            metadata = create_memmap('NETCDF:"' + bathymnt + '":DEPTH', outdir, outname)
-            metadata['category'] = 'bathymetry'
-            metadata['bandinfo']['scale_factor'] = -1 * float(metadata['bandinfo'].get('scale_factor', 1))
-            metadata['bandinfo']['add_offset'] = -1 * float(metadata['bandinfo'].get('add_offset', 0))
-            json.dump(metadata, open(os.path.join(outdir, outname+'.json'), 'w'))
+            for info in zipf.infolist():
+                if not info.filename.endswith('.mnt'):
+                    continue
+                bathymnt = os.path.join(tmpdir, info.filename)
+                outname = 'emodnet_bathy_' + os.path.split(bathymnt)[1].replace('.mnt', '')
+                signature = {'path': os.path.basename(bathyzip), 'member': info.filename, 'size': info.file_size,
+                             'crc': info.CRC}
+                if overwrite or not up_to_date(outdir, outname, signature):
+                    if not (os.path.exists(bathymnt) and os.path.getsize(bathymnt) == info.file_size):
+                        zipf.extract(info, tmpdir)
+                tasks.append({'path': 'NETCDF:"' + bathymnt + '":DEPTH', 'outname': outname, 'category': 'bathymetry',
+                              'negate': True, 'signature': signature})
+    return tasks
 
 
-def gebco2memmap(overwrite=False):
-    logging.info("gebco2memmap")
+def gebco_tasks():
     gebco_dir = os.path.join(config.dataprepdir, 'GEBCO_2014')
-    outname = 'gebco_2014'
-    if overwrite or not output_exists(outdir, outname):
-        metadata = create_memmap('NETCDF:"' + os.path.join(gebco_dir, 'GEBCO_2014_2D.nc":elevation'), outdir, outname)
-        metadata['category'] = 'bathymetry'
-        metadata['bandinfo']['missing_value'] = 32767
-        metadata['bandinfo']['scale_factor'] = -1 * float(metadata['bandinfo'].get('scale_factor', 1))
-        metadata['bandinfo']['add_offset'] = -1 * float(metadata['bandinfo'].get('add_offset', 0))
-        json.dump(metadata, open(os.path.join(outdir, outname + '.json'), 'w'))
+    return [{'path': 'NETCDF:"' + os.path.join(gebco_dir, 'GEBCO_2014_2D.nc":elevation'), 'outname': 'gebco_2014',
+             'category': 'bathymetry', 'negate': True, 'missing_value': 32767}]
 
 
-def gbr100v5_memmap(overwrite=False):
-    logging.info("gbr100v5_memmap")
+def gbr100v5_tasks():
     # gbr100: High-resolution bathymetry model of the Great Barrier Reef and Coral Sea, an output of Project 3DGBR
     # https://www.deepreef.org/bathymetry/65-3dgbr-bathy.html
     gbr_dir = os.path.join(config.dataprepdir, 'gbr100')
-    outname = 'gbr100'
-    if overwrite or not output_exists(outdir, outname):
-        metadata = create_memmap('NETCDF:"' + os.path.join(gbr_dir, 'gbr100_02sep.grd":depth'), outdir, outname)
-        metadata['category'] = 'bathymetry'
-        metadata['bandinfo']['scale_factor'] = -1 * float(metadata['bandinfo'].get('scale_factor', 1))
-        metadata['bandinfo']['add_offset'] = -1 * float(metadata['bandinfo'].get('add_offset',0))
-        json.dump(metadata, open(os.path.join(outdir, outname + '.json'), 'w'))
+    return [{'path': 'NETCDF:"' + os.path.join(gbr_dir, 'gbr100_02sep.grd":depth'), 'outname': 'gbr100',
+             'category': 'bathymetry', 'negate': True}]
 
 
-def boem2memmap(overwrite=False):
-    logging.info("boem2memmap")
+def boem_tasks():
     # BOEM Northern Gulf of Mexico Deepwater Bathymetry Grid from 3D Seismic
     # https://www.boem.gov/Gulf-of-Mexico-Deepwater-Bathymetry/
     boem_dir = os.path.join(config.dataprepdir, 'boem')
-    for fname, outname in [('BOEMbathyW_m.tif', 'BOEM_west'), ('BOEMbathyE_m.tif', 'BOEM_east')]:
-        if overwrite or not output_exists(outdir, outname):
-            metadata = create_memmap(os.path.join(boem_dir, fname), outdir, outname)
-            metadata['category'] = 'bathymetry'
-            metadata['bandinfo']['scale_factor'] = -1 * float(metadata['bandinfo']['scale_factor'])
-            metadata['bandinfo']['add_offset'] = -1 * float(metadata['bandinfo']['add_offset'])
-            json.dump(metadata, open(os.path.join(outdir, outname + '.json'), 'w'))
+    return [{'path': os.path.join(boem_dir, fname), 'outname': outname, 'category': 'bathymetry', 'negate': True}
+            for fname, outname in [('BOEMbathyW_m.tif', 'BOEM_west'), ('BOEMbathyE_m.tif', 'BOEM_east')]]
 
 
-def sdmpredictors2memmap(layers, overwrite=False):
-    logging.info("sdmpredictors2memmap")
+def emodnet2memmap(overwrite=False):
+    logging.info("emodnet2memmap")
+    run_conversions(emodnet_tasks(overwrite), overwrite)
+
+
+def gebco2memmap(overwrite=False):
+    logging.info("gebco2memmap")
+    run_conversions(gebco_tasks(), overwrite)
+
+
+def gbr100v5_memmap(overwrite=False):
+    logging.info("gbr100v5_memmap")
+    run_conversions(gbr100v5_tasks(), overwrite)
+
+
+def boem2memmap(overwrite=False):
+    logging.info("boem2memmap")
+    run_conversions(boem_tasks(), overwrite)
+
+
+def sdmpredictors_tasks(layers):
+    """ Downloads the layers with the sdmpredictors R package, already downloaded layers are not downloaded again """
+    logging.info("sdmpredictors_tasks")
     sdmpredictors_dir = os.path.join(config.dataprepdir, 'sdmpredictors')
     layercodes = [l for _, codes in layers.items() for l in codes]
     code = """
@@ -123,12 +231,13 @@ load_layers(c("{0}"), datadir = "{1}")
         subprocess.check_call(['Rscript', rfile], universal_newlines=True)
     finally:
         os.remove(rfile)
-    for category, layercodes in layers.items():
-        for outname in layercodes:
-            if overwrite or not output_exists(outdir, outname):
-                metadata = create_memmap(os.path.join(sdmpredictors_dir, outname+'_lonlat.tif'), outdir, outname)
-                metadata['category'] = category
-                json.dump(metadata, open(os.path.join(outdir, outname + '.json'), 'w'))
+    return [{'path': os.path.join(sdmpredictors_dir, outname + '_lonlat.tif'), 'outname': outname, 'category': category}
+            for category, layercodes in layers.items() for outname in layercodes]
+
+
+def sdmpredictors2memmap(layers, overwrite=False):
+    logging.info("sdmpredictors2memmap")
+    run_conversions(sdmpredictors_tasks(layers), overwrite)
 
 
 def combine_metadata():
@@ -141,9 +250,9 @@ def combine_metadata():
 
 if __name__ == '__main__':
     logging.info("main")
-    emodnet2memmap()
-    gebco2memmap()
-    gbr100v5_memmap()
-    # boem2memmap() # different projection
-    sdmpredictors2memmap(layers={'sstemperature': ['BO2_tempmean_ss'], 'sssalinity': ['BO2_salinitymean_ss']})
+    # all rasters in one process pool, only rasters whose source changed since the last run are converted
+    tasks = emodnet_tasks() + gebco_tasks() + gbr100v5_tasks()
+    # tasks += boem_tasks()  # different projection
+    tasks += sdmpredictors_tasks(layers={'sstemperature': ['BO2_tempmean_ss'], 'sssalinity': ['BO2_salinitymean_ss']})
+    logging.info("converted: " + ", ".join(run_conversions(tasks)))
     combine_metadata()
\ No newline at end of file
@@ -0,0 +1,20 @@
+# gunicorn -c gunicorn.conf.py service.app:api
+import multiprocessing
+
+bind = '127.0.0.1:8000'
+workers = multiprocessing.cpu_count()
+threads = 4  # keep pool_maxconn in service/config.py at least this high
+timeout = 120
+# Import the service in the master before forking the workers: the coastline KD-tree, the raster metadata and the
+# area indexes are loaded once and the workers share these pages (copy on write). The memory mapped data files are
+# shared through the page cache either way. Code changes need a restart, --reload doesn't work with preload_app.
+# Keep init_mode = 'eager' in service/config.py with preload_app, background loading would happen in the master's
+# thread which doesn't survive the fork and every worker would load its own copy.
+preload_app = True
+pidfile = '/tmp/xylookup-gunicorn.pid'  # memory per worker: python -m service.memory $(cat /tmp/xylookup-gunicorn.pid)
+
+
+def on_starting(server):
+    # with metrics_dir in service/config.py the workers of this run start the summed /lookup/metrics from zero
+    import service.metrics as metrics
+    metrics.clear()
@@ -3,14 +3,26 @@ import simplejson as json
 import msgpack
 import service.lookup as lookup
 import service.areas as areas
+import service.encoding as encoding
+import service.jobs as jobs
+import service.startup as startup
+import service.db as db
+import service.metrics as metrics
+import service.profiling as profiling
+from service.encoding import MEDIA_NDJSON, encode_arrays
+import time
 import traceback
 
+
 class LookupResource(object):
     @staticmethod
-    def _prepare_response(results, req, resp):
+    def _prepare_response(results, req, resp, columns=False):
         if req.client_accepts_msgpack and req.content_type and req.content_type.lower() == falcon.MEDIA_MSGPACK:
             try:
-                resp.data = msgpack.packb(results, use_bin_type=False)
+                if columns:
+                    resp.data = msgpack.packb(encode_arrays(results, True), use_bin_type=True)
+                else:
+                    resp.data = msgpack.packb(results, use_bin_type=False)
                 resp.content_type = falcon.MEDIA_MSGPACK
                 resp.status = falcon.HTTP_200
             except Exception as ex:
@@ -18,36 +30,188 @@ class LookupResource(object):
                 raise falcon.HTTPError(falcon.HTTP_400, 'Error creating msgpack response', str(ex))
         else:
             try:
-                resp.body = json.dumps(results)
+                resp.body = json.dumps(encode_arrays(results, False), ignore_nan=True) if columns else json.dumps(results)
             except Exception as ex:
                 print(str(ex))
                 raise falcon.HTTPError(falcon.HTTP_400, 'Error creating JSON response', str(ex))
 
+    @staticmethod
+    def _stream_encoder(req, resp, columns=False):
+        """ Sets the content type of a streaming response and returns the function that encodes a chunk of results """
+        binary = req.client_accepts_msgpack and req.content_type and req.content_type.lower() == falcon.MEDIA_MSGPACK
+        resp.content_type = falcon.MEDIA_MSGPACK if binary else MEDIA_NDJSON
+        return encoding.chunk_encoder(binary, columns)
+
+    @staticmethod
+    def _stream_error(ex, columns=False):
+        error = {'error': ex.title, 'description': ex.description}
+        return error if columns else [error]
+
+    def _prepare_stream(self, chunks, req, resp, columns=False):
+        """ Sends every chunk as soon as it is looked up. Errors after the first chunk can't change the status
+        anymore, they are sent as a final error record. """
+        encode = self._stream_encoder(req, resp, columns)
+
+        def stream():
+            try:
+                for results in chunks:
+                    yield encode(results)
+            except falcon.HTTPError as ex:
+                yield encode(self._stream_error(ex, columns))
+        resp.stream = stream()
+        resp.status = falcon.HTTP_200
+
+    @staticmethod
+    def _wants_stream(req, options):
+        return options['stream'] or MEDIA_NDJSON in (req.accept or '').lower()
+
+    @staticmethod
+    def _set_stats_headers(req, resp):
+        stats = req.context.get('stats')
+        if stats and stats['points'] > 0:
+            resp.set_header('X-Unique-Points', str(stats['unique']))
+            resp.set_header('X-Dedup-Ratio', '{:.3f}'.format(1 - stats['unique'] / float(stats['points'])))
+            if 'cache_hits' in stats:
+                resp.set_header('X-Cache-Hits', str(stats['cache_hits']))
+                resp.set_header('X-Cache-Misses', str(stats['cache_misses']))
+            if 'tilecache_hit_ratio' in stats:
+                resp.set_header('X-Tile-Cache-Hit-Ratio', '{:.3f}'.format(stats['tilecache_hit_ratio']))
+
     def on_get(self, req, resp):
-	results = lookup.lookup(req)
-	self._prepare_response(results, req, resp)
+        self._respond_or_profile(req, resp)
 
     def on_post(self, req, resp):
-        results = lookup.lookup(req)
-        self._prepare_response(results, req, resp)
+        self._respond_or_profile(req, resp)
+
+    def _respond_or_profile(self, req, resp):
+        if profiling.requested(req):
+            profiling.run(req, resp, lambda: self._respond(req, resp))
+        else:
+            self._respond(req, resp)
+
+    @staticmethod
+    def _set_timing_header(req, resp, timings):
+        start = req.context.get('start')
+        resp.set_header('Server-Timing', timings.server_timing(time.time() - start if start else None))
+
+    def _respond(self, req, resp):
+        timings = metrics.Timings()
+        with timings.stage('parse'):
+            points, options = lookup.parse_request(req)
+        columns = options['format'] == 'columns'
+        if self._wants_stream(req, options) and not profiling.active():
+            self._prepare_stream(lookup.lookup_stream(points, options, timings=timings), req, resp, columns)
+            self._set_timing_header(req, resp, timings)  # the stages of the first chunk
+        else:
+            req.context['stats'] = {'timings': timings}
+            results = lookup.lookup_options(points, options, req.context['stats'])
+            self._set_stats_headers(req, resp)
+            with timings.stage('serialize', len(points)):
+                self._prepare_response(results, req, resp, columns)
+            self._set_timing_header(req, resp, timings)
 
 
 class AreasResource(object):
 
     def on_get(self, req, resp):
-        resp.body = areas.table_sql(req)
+        resp.stream = areas.table_sql(areas.sql_format(req))
         resp.content_type = falcon.MEDIA_TEXT
         resp.status = falcon.HTTP_200
         resp.content_disposition = 'inline; filename = "create_areas.txt"'
 
 
+class JobsResource(object):
+
+    def on_post(self, req, resp):
+        """ Creates a job for the posted points (same formats and options as /lookup), the results are msgpack for
+        msgpack requests and NDJSON otherwise """
+        points, options = lookup.parse_request(req)
+        binary = req.content_type and req.content_type.lower() == falcon.MEDIA_MSGPACK
+        job = jobs.create_job(points, options, binary)
+        resp.body = json.dumps(job)
+        resp.location = '/lookup/jobs/' + job['id']
+        resp.status = falcon.HTTP_202
+
+
+class JobResource(object):
+
+    def on_get(self, req, resp, job_id):
+        job = jobs.get_job(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound()
+        resp.body = json.dumps(job)
+
+
+class JobResultResource(object):
+
+    def on_get(self, req, resp, job_id):
+        job = jobs.get_job(job_id)
+        if job is None:
+            raise falcon.HTTPNotFound()
+        if job['status'] != jobs.FINISHED:
+            raise falcon.HTTPConflict('Job not finished', 'The job is {}, progress {:.0%}'.format(job['status'],
+                                                                                                  job['progress']))
+        resp.content_type = falcon.MEDIA_MSGPACK if job['binary'] else MEDIA_NDJSON
+        resp.stream = jobs.result_chunks(job)
+
+
+class MetricsResource(object):
+    """ Request, stage and cache metrics of this process in the Prometheus text format """
+
+    def on_get(self, req, resp):
+        resp.body = metrics.render()
+        resp.content_type = metrics.MEDIA_PROMETHEUS
+
+
+def health_report(check_database=True):
+    """ (ready, report) with the state and timings of the subsystems and, when it is used, the database """
+    report = {'subsystems': startup.status()}
+    ready = startup.ready()
+    if check_database and startup.database_required():
+        try:
+            report['database'] = {'state': startup.READY, 'seconds': db.check()}
+        except Exception as ex:
+            report['database'] = {'state': startup.FAILED, 'error': str(ex)}
+            ready = False
+    report['ready'] = ready
+    return ready, report
+
+
+class HealthResource(object):
+    """ The process is up, reports the subsystems without checking the database """
+
+    def on_get(self, req, resp):
+        _, report = health_report(check_database=False)
+        report['status'] = 'ok'
+        resp.body = json.dumps(report)
+
+
+class ReadyResource(object):
+    """ 200 when the process can handle lookups, 503 while loading or when the database can't be reached """
+
+    def on_get(self, req, resp):
+        ready, report = health_report()
+        resp.body = json.dumps(report)
+        resp.status = falcon.HTTP_200 if ready else falcon.HTTP_503
+
+
 def create():
-    api = falcon.API()
+    api = falcon.API(middleware=[metrics.Middleware()])
+    # the falcon 1 defaults, falcon 3 splits no lists (x=1,2&y=3,4) and keeps blank values (x=&y=)
+    api.req_options.auto_parse_qs_csv = True
+    api.req_options.keep_blank_qs_values = False
     api.add_route('/lookup/areas', AreasResource())
+    api.add_route('/lookup/metrics', MetricsResource())
+    api.add_route('/lookup/health', HealthResource())
+    api.add_route('/lookup/ready', ReadyResource())
+    api.add_route('/lookup/jobs', JobsResource())
+    api.add_route('/lookup/jobs/{job_id}', JobResource())
+    api.add_route('/lookup/jobs/{job_id}/result', JobResultResource())
     api.add_route('/lookup', LookupResource())
     return api
 
 
+startup.start()
 api = create()
 
 if __name__ == '__main__':
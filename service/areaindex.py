@@ -0,0 +1,121 @@
+import os
+import json
+from collections import OrderedDict
+import numpy as np
+import service.config as config
+import service.geometry as geometry
+import service.startup as startup
+
+
+class AreaIndex:
+    """ In memory point in polygon index for one areas table, created by dataprep/areas.py.
+
+    The polygons are indexed on a regular grid, each grid cell lists the polygons intersecting it and whether the
+    polygon covers the whole cell. Points in a covered cell are resolved without a geometry test.
+
+    Areas within a distance of the points are found on a sphere: the cells overlapping the lon/lat box around a point
+    give the candidate polygons, a candidate matches when the point is inside it or when one of its edges, taken as
+    great circle arcs, is within the distance.
+    """
+    def __init__(self, areadir, alias, columns):
+        self.alias = alias
+        with open(os.path.join(areadir, 'index.json')) as f:
+            metadata = json.load(f)
+        self.minx, self.maxy = metadata['minx'], metadata['maxy']
+        self.resolution = metadata['resolution']
+        self.nrow, self.ncol = metadata['nrow'], metadata['ncol']
+        with open(os.path.join(areadir, 'attributes.json')) as f:
+            attributes = [tuple(a) for a in json.load(f)]
+        # polygons with the same attributes (parts of the same area) are reported once per point
+        unique = list(OrderedDict.fromkeys(attributes))
+        keys = dict((a, i) for i, a in enumerate(unique))
+        self.rows = [dict(zip(columns, a)) for a in unique]
+        self.keys = np.array([keys[a] for a in attributes], dtype=np.int64)
+        self.offsets = np.load(os.path.join(areadir, 'offsets.npy'), mmap_mode='r')  # edges per polygon
+        self.edges = np.load(os.path.join(areadir, 'edges.npy'), mmap_mode='r')
+        self.cells = np.load(os.path.join(areadir, 'cells.npy'), mmap_mode='r')  # sorted cell ids
+        self.polygons = np.load(os.path.join(areadir, 'polygons.npy'), mmap_mode='r')  # polygon per cell entry
+        self.covers = np.load(os.path.join(areadir, 'covers.npy'), mmap_mode='r')  # polygon covers the cell
+        self._bulge = None
+
+    def get_cells(self, x, y):
+        rows = np.clip(np.floor((self.maxy - y) / self.resolution).astype(int), 0, self.nrow - 1)
+        cols = np.clip(np.floor((x - self.minx) / self.resolution).astype(int), 0, self.ncol - 1)
+        return rows * self.ncol + cols
+
+    def get_matches(self, x, y):
+        """ Returns the point indexes and area keys of all matches, sorted and without duplicates """
+        cells = self.get_cells(x, y)
+        start = np.searchsorted(self.cells, cells, side='left')
+        counts = np.searchsorted(self.cells, cells, side='right') - start
+        pointidx = np.repeat(np.arange(len(x)), counts)
+        entries = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+        polygons = self.polygons[entries]
+        match = self.covers[entries].copy()
+        test = np.flatnonzero(~match)
+        match[test] = geometry.points_in_polygons(x[pointidx[test]], y[pointidx[test]], self.edges,
+                                                  self.offsets[polygons[test]], self.offsets[polygons[test] + 1])
+        matches = np.unique(np.column_stack((pointidx[match], self.keys[polygons[match]])), axis=0)
+        return matches[:, 0], matches[:, 1]
+
+    @property
+    def bulge(self):
+        """ Degrees the great circle edges reach beyond the cells of their polygons, computed on first use """
+        if self._bulge is None:
+            self._bulge = geometry.gc_bulge(self.edges)
+        return self._bulge
+
+    def get_box_entries(self, boxidx, minx, miny, maxx, maxy):
+        """ The box indexes and cell entries of all cells overlapping the boxes """
+        row0 = np.clip(np.floor((self.maxy - maxy) / self.resolution).astype(int), 0, self.nrow - 1)
+        row1 = np.clip(np.floor((self.maxy - miny) / self.resolution).astype(int), 0, self.nrow - 1)
+        col0 = np.clip(np.floor((minx - self.minx) / self.resolution).astype(int), 0, self.ncol - 1)
+        col1 = np.clip(np.floor((maxx - self.minx) / self.resolution).astype(int), 0, self.ncol - 1)
+        ncols = col1 - col0 + 1
+        ncells = (row1 - row0 + 1) * ncols
+        box = np.repeat(np.arange(len(boxidx)), ncells)
+        offset = np.arange(ncells.sum()) - np.repeat(np.cumsum(ncells) - ncells, ncells)
+        cells = (row0[box] + offset // ncols[box]) * self.ncol + col0[box] + offset % ncols[box]
+        start = np.searchsorted(self.cells, cells, side='left')
+        counts = np.searchsorted(self.cells, cells, side='right') - start
+        entries = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+        return np.repeat(boxidx[box], counts), entries
+
+    def get_matches_within(self, x, y, distance, maxpairs=5000000):
+        """ Returns the point indexes and area keys of all areas within distance meters, sorted and without
+        duplicates """
+        boxes = geometry.distance_boxes(x, y, distance, self.bulge)
+        pointidx, entries = self.get_box_entries(*boxes)
+        candidates = np.unique(np.column_stack((pointidx, self.polygons[entries])), axis=0)
+        pointidx, polygons = candidates[:, 0], candidates[:, 1]
+        start, stop = self.offsets[polygons], self.offsets[polygons + 1]
+        match = geometry.points_in_polygons(x[pointidx], y[pointidx], self.edges, start, stop, maxpairs=maxpairs)
+        test = np.flatnonzero(~match)
+        match[test] = geometry.edges_within(x[pointidx[test]], y[pointidx[test]], self.edges, start[test],
+                                            stop[test], distance / geometry.RADIUS, maxpairs=maxpairs)
+        matches = np.unique(np.column_stack((pointidx[match], self.keys[polygons[match]])), axis=0)
+        return matches[:, 0], matches[:, 1]
+
+    def add_areas(self, x, y, results, distancewithin=0):
+        if distancewithin > 0:
+            pointidx, keys = self.get_matches_within(x, y, distancewithin)
+        else:
+            pointidx, keys = self.get_matches(x, y)
+        for idx, key in zip(pointidx.tolist(), keys.tolist()):
+            results[idx].setdefault(self.alias, []).append(self.rows[key])
+
+
+def get_areas(points, distancewithin=0):
+    """ Same output as areas.get_areas without querying the database. Distances are computed on a sphere, areas at
+    almost exactly distancewithin meters can differ from the spheroid distances of PostGIS. """
+    x, y = points[:, 0], points[:, 1]
+    results = [{} for _ in range(len(points))]
+    for index in _indexes.get():
+        index.add_areas(x, y, results, distancewithin)
+    return results
+
+
+_indexes = startup.Subsystem('areaindex', lambda: [AreaIndex(os.path.join(config.areasdir, table), alias, columns)
+                                                   for table, (alias, columns) in config.areas.items()],
+                             lambda indexes: [a for i in indexes for a in (i.offsets, i.edges, i.cells, i.polygons,
+                                                                           i.covers)])
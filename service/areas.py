@@ -1,49 +1,136 @@
+import json
+import falcon
+import numpy as np
 import service.config as config
 
 
+ONLAND = -1  # source of the on land rows in combined_sql
+
+
+def _membership_sql(pointstable, table, columns, distancewithin):
+    """ Distinct point id and area columns of the areas the points intersect or are within distancewithin meters of.
+    The points are only cast to geography in the distance check, the geography index of the areas table finds the
+    candidate areas with a box around each point. """
+    if distancewithin is not None and distancewithin > 0:
+        condition = "ST_DWithin(pts.geom::geography, grid.geog, {})".format(distancewithin)
+    else:  # faster query
+        condition = "ST_Intersects(grid.geom, pts.geom)"
+    return """SELECT DISTINCT pts.id AS ptsid, grid.{} FROM {} pts, {} grid
+               WHERE {}""".format(", grid.".join(columns), pointstable, table, condition)
+
+
+def combined_sql(pointstable, distancewithin, pareas=True, onland_sql=None):
+    """ One statement for the area memberships of the points in all config.areas tables and, when onland_sql (the
+    query for the ids of the points on land) is given, the points on land. The rows are (source, point id, values)
+    with source the position of the table in config.areas or ONLAND and values a JSON array of the area columns. """
+    branches = []
+    if pareas:
+        for source, (table, (alias, columns)) in enumerate(config.areas.items()):
+            branches.append("SELECT {}, ptsid, json_build_array({}) FROM ({}) a{}".format(
+                source, ", ".join(columns), _membership_sql(pointstable, table, columns, distancewithin), source))
+    if onland_sql:
+        branches.append("SELECT {}, id, NULL::json FROM ({}) onland".format(ONLAND, onland_sql))
+    return "\nUNION ALL\n".join(branches)
+
+
+def group_rows(rows, npoints, pareas=True, ponland=False):
+    """ The areas per point (as get_areas) and the on land array (-1 on land, 1 in water) from the rows of
+    combined_sql, None for the parts that were not requested. The rows are grouped by source and point with a sort
+    instead of a dict lookup per row. """
+    sources = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    ids = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+    onland = None
+    if ponland:
+        onland = np.ones(npoints)
+        onland[ids[sources == ONLAND]] = -1
+    if not pareas:
+        return None, onland
+    results = [{} for _ in range(npoints)]
+    order = np.lexsort((ids, sources))
+    sources, ids = sources[order], ids[order]
+    for source, (alias, columns) in enumerate(config.areas.values()):
+        lo, hi = np.searchsorted(sources, [source, source + 1])
+        if lo == hi:
+            continue
+        records = []
+        for i in order[lo:hi].tolist():
+            values = rows[i][2]
+            if not isinstance(values, list):
+                values = json.loads(values)  # asyncpg returns json as text
+            records.append(dict(zip(columns, values)))
+        pointids, starts = np.unique(ids[lo:hi], return_index=True)
+        stops = np.append(starts[1:], hi - lo)
+        for pointid, start, stop in zip(pointids.tolist(), starts.tolist(), stops.tolist()):
+            results[pointid][alias] = records[start:stop]
+    return results, onland
+
+
+def query(cur, npoints, pointstable, distancewithin, pareas=True, onland_sql=None):
+    """ Areas per point and on land for the points in pointstable in one round trip, see group_rows """
+    cur.execute(combined_sql(pointstable, distancewithin, pareas, onland_sql))
+    return group_rows(cur.fetchall(), npoints, pareas, onland_sql is not None)
+
+
 def get_areas(cur, points, pointstable, distancewithin):
-    tablecols = config.areas
-    results = [{} for _ in range(len(points))]
-    for table, (alias, columns) in tablecols.items():
-        if distancewithin is not None and distancewithin > 0:
-            cur.execute("""SELECT DISTINCT pts.id as ptsid, grid.{} FROM {} pts, {} grid 
-                                        WHERE ST_DWithin(pts.geog, grid.geog, {}) 
-                                        ORDER BY pts.id""".format(", grid.".join(columns), pointstable, table, distancewithin))
-        else: # faster query
-            cur.execute("""SELECT DISTINCT pts.id as ptsid, grid.{} FROM {} pts, {} grid 
-                            WHERE ST_Intersects(grid.geom, pts.geom) 
-                            ORDER BY pts.id""".format(", grid.".join(columns), pointstable, table))
-        data = cur.fetchone()
-        for idx in range(len(points)):
-            results[idx][alias] = []
-            while data and data[0] == idx:
-                d = dict(zip(columns, data[1:]))
-                results[idx][alias].append(d)
-                data = cur.fetchone()
-            if len(results[idx][alias]) == 0:
-                del results[idx][alias]
-    return results
-        
-        
-def table_sql(req):
-    def sqlval(x):
-        if x is None:
-            return 'NULL'
-        elif isinstance(x, int):
-            return str(x)
-        return "'" + x.replace("'", "''") + "'"
-
-    import psycopg2
-    output = ["DELETE FROM obis.areas;"]
-    with psycopg2.connect(config.connstring) as conn:
-        with conn.cursor() as cur:
-            for table, (alias, columns) in config.areas.items():
+    return query(cur, len(points), pointstable, distancewithin)[0]
+
+
+def _sqlval(x):
+    if x is None:
+        return 'NULL'
+    elif isinstance(x, int):
+        return str(x)
+    return "'" + x.replace("'", "''") + "'"
+
+
+def _copyval(x):
+    if x is None:
+        return '\\N'
+    return str(x).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def _encode(text):
+    return text if isinstance(text, bytes) else text.encode('utf-8')
+
+
+SQL_FORMATS = ('sql', 'copy')
+
+
+def sql_format(req):
+    fmt = req.get_param('format') or 'sql'
+    if fmt not in SQL_FORMATS:
+        raise falcon.HTTPInvalidParam('The format must be sql (INSERT statements) or copy (COPY FROM stdin)', 'format')
+    return fmt
+
+
+def table_sql(fmt='sql', batchsize=None):
+    """ Generator of the encoded chunks of the SQL script that fills the obis.areas table from the areas tables.
+
+    fmt 'sql' gives INSERT statements, 'copy' a COPY FROM stdin block for psql. The rows are read with a server side
+    cursor in batches of batchsize (config.areas_sql_batchsize) rows and a chunk is yielded per batch, so memory use
+    does not depend on the size of the tables. The database connection is taken after the first chunk and held until
+    the generator is exhausted or closed.
+    """
+    import service.db as db
+    batchsize = batchsize or config.areas_sql_batchsize
+    yield _encode("DELETE FROM obis.areas;\n")
+    if fmt == 'copy':
+        yield _encode("COPY obis.areas (id, name, type) FROM stdin;\n")
+    with db.pool.connection() as conn:
+        for table, (alias, columns) in config.areas.items():
+            if fmt != 'copy':
+                yield _encode("-- Data from " + table + "\n")
+            with conn.cursor(name='xylookup_areas') as cur:
+                cur.itersize = batchsize
                 cur.execute("SELECT distinct id::integer, name FROM {} ORDER BY id".format(table))
-                data = cur.fetchone()
-                output.append("-- Data from " + table)
-                while data:
-                    data = data + (alias,)
-                    output.append("INSERT INTO obis.areas (id, name, type) VALUES ({});".format(", ".join(map(sqlval, data))))
-                    data = cur.fetchone()
-
-    return "\n".join(output) + "\n"
+                rows = cur.fetchmany(batchsize)
+                while rows:
+                    if fmt == 'copy':
+                        lines = ["\t".join(map(_copyval, row + (alias,))) for row in rows]
+                    else:
+                        lines = ["INSERT INTO obis.areas (id, name, type) VALUES ({});".format(
+                            ", ".join(map(_sqlval, row + (alias,)))) for row in rows]
+                    yield _encode("\n".join(lines) + "\n")
+                    rows = cur.fetchmany(batchsize)
+    if fmt == 'copy':
+        yield _encode("\\.\n")
@@ -0,0 +1,275 @@
+""" ASGI variant of the service for falcon 3 and asyncpg, run it with e.g. uvicorn service.asgi:app
+
+The lookup core (request parsing, stages, result cache, response encoding) is shared with the WSGI app in
+service/app.py. The database stage runs on an asyncpg pool so one process can have many slow area queries in flight,
+the CPU bound stages (rasters, coastline KD-tree, landmask, in memory areas) run on a thread pool.
+"""
+import asyncio
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import asyncpg
+import falcon
+import falcon.asgi
+import service.app as wsgiapp
+import service.areas as areas
+import service.config as config
+import service.lookup as lookup
+import service.metrics as metrics
+import service.resultcache as resultcache
+import service.shoredistance as shoredistance
+import service.startup as startup
+
+_executor = ThreadPoolExecutor(max_workers=config.asgi_cpu_workers)
+pool = None  # created at startup
+
+
+def connect_kwargs(connstring):
+    """ asyncpg arguments for a libpq key=value connection string """
+    names = {'dbname': 'database', 'user': 'user', 'password': 'password', 'host': 'host', 'port': 'port'}
+    kwargs = {}
+    for item in connstring.split():
+        key, _, value = item.partition('=')
+        if key in names:
+            kwargs[names[key]] = int(value) if key == 'port' else value
+    return kwargs
+
+
+class Connection(asyncpg.Connection):
+    """ asyncpg connection with a dict for data about its session, like db.ConnectionPool.state """
+    __slots__ = ('_state',)
+
+    def state(self):
+        try:
+            return self._state
+        except AttributeError:
+            self._state = {}
+            return self._state
+
+
+async def _init_connection(conn):
+    await conn.execute(lookup._pointstable_sql)
+
+
+async def _cpu(f, *args):
+    return await asyncio.get_running_loop().run_in_executor(_executor, f, *args)
+
+
+async def _db_stage(points, pareas, pareasdistancewithin, ponland, timings):
+    """ Same queries as lookup._db_stage, the points are inserted as arrays and removed by the rollback """
+    async with pool.acquire(timeout=config.pool_timeout) as conn:
+        if lookup._count_pointstable_use(conn.state()):  # the points table is created by _init_connection
+            await conn.execute("TRUNCATE {}".format(lookup._pointstable))
+        transaction = conn.transaction()
+        await transaction.start()
+        try:
+            start = time.time()
+            await conn.execute("""INSERT INTO {0} (id, geom)
+                SELECT id, ST_SetSRID(ST_MakePoint(x, y), 4326)
+                  FROM unnest($1::integer[], $2::float8[], $3::float8[]) AS p(id, x, y)""".format(lookup._pointstable),
+                list(range(len(points))), points[:, 0].tolist(), points[:, 1].tolist())
+            timings.add('load_points', time.time() - start, len(points))
+            start = time.time()
+            sql = areas.combined_sql(lookup._pointstable, pareasdistancewithin, pareas,
+                                     shoredistance.onland_sql(lookup._pointstable) if ponland else None)
+            rows = await conn.fetch(sql)
+            timings.add('query', time.time() - start, len(points))
+        finally:
+            await transaction.rollback()
+    return await _cpu(areas.group_rows, rows, len(points), pareas, ponland)  # after the connection is released
+
+
+async def _iterate(chunks):
+    """ Async iterator over a blocking iterator, the items are produced on the executor """
+    try:
+        while True:
+            chunk = await _cpu(next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        await _cpu(chunks.close)
+
+
+async def _timed(timings, name, npoints, work):
+    start = time.time()
+    try:
+        return await work
+    finally:
+        timings.add(name, time.time() - start, npoints)
+
+
+async def _lookup_unique_columns(points, pareas, pgrids, pshoredistance, pareasdistancewithin, timings):
+    dbargs, stages = lookup._plan_stages(points, pareas, pgrids, pshoredistance, pareasdistancewithin)
+    names = list(stages)
+    work = [_cpu(timings.timed(name, stages[name], len(points))) for name in names]
+    if dbargs:
+        names.append('db')
+        work.append(_timed(timings, 'db', len(points), _db_stage(points, *(dbargs + (timings,)))))
+    values = dict(zip(names, await asyncio.gather(*work)))
+    return lookup._combine_stages(values, pareas, pgrids, pshoredistance)
+
+
+async def _lookup_unique(points, pareas, pgrids, pshoredistance, pareasdistancewithin, timings):
+    columns = await _lookup_unique_columns(points, pareas, pgrids, pshoredistance, pareasdistancewithin, timings)
+    return await _cpu(timings.timed('results', lambda: lookup._columns_to_results(columns, len(points)), len(points)))
+
+
+async def lookup_points(points, pareas, pgrids, pshoredistance, pareasdistancewithin, stats=None):
+    """ lookup.lookup_points without blocking the event loop """
+    stats, timings = lookup._begin(stats)
+    unique, inverse = await _cpu(lookup._dedup, points, timings)
+    if resultcache.cache is None:
+        results = await _lookup_unique(unique, pareas, pgrids, pshoredistance, pareasdistancewithin, timings)
+    else:
+        keys, results, missing = await _cpu(lookup._cache_get, unique, pareas, pgrids, pshoredistance,
+                                            pareasdistancewithin, timings)
+        computed = await _lookup_unique(unique[missing], pareas, pgrids, pshoredistance, pareasdistancewithin,
+                                        timings) if missing else []
+        await _cpu(lookup._cache_fill, keys, results, missing, computed, stats)
+    lookup._add_stats(stats, points, unique)
+    return lookup._expand_results(results, inverse)
+
+
+async def lookup_columns(points, pareas, pgrids, pshoredistance, pareasdistancewithin, stats=None):
+    """ lookup.lookup_columns without blocking the event loop """
+    stats, timings = lookup._begin(stats)
+    unique, inverse = await _cpu(lookup._dedup, points, timings)
+    columns = await _lookup_unique_columns(unique, pareas, pgrids, pshoredistance, pareasdistancewithin, timings)
+    lookup._add_stats(stats, points, unique)
+    return await _cpu(timings.timed('results', lambda: lookup._expand_columns(columns, inverse), len(points)))
+
+
+async def lookup_options(points, options, stats=None):
+    """ lookup.lookup_options without blocking the event loop """
+    f = lookup_columns if options.get('format') == 'columns' else lookup_points
+    try:
+        return await f(points, options['areas'], options['grids'], options['shoredistance'],
+                       options['areasdistancewithin'], stats)
+    except (asyncio.TimeoutError, asyncpg.TooManyConnectionsError) as ex:
+        raise falcon.HTTPServiceUnavailable('Database busy', str(ex), retry_after=1)
+    except Exception as ex:
+        traceback.print_exc()
+        print(ex)
+        raise falcon.HTTPError(falcon.HTTP_400, 'Error looking up data for provided points', str(ex))
+
+
+class LookupResource(wsgiapp.LookupResource):
+    async def on_get(self, req, resp):
+        await self._respond(req, resp)
+
+    async def on_post(self, req, resp):
+        await self._respond(req, resp)
+
+    async def _respond(self, req, resp):
+        timings = metrics.Timings()
+        raw_data = await req.stream.read() if req.method == 'POST' else None
+        with timings.stage('parse'):
+            points, options = lookup.parse_request(req, raw_data)
+        columns = options['format'] == 'columns'
+        if self._wants_stream(req, options):
+            self._prepare_async_stream(points, options, req, resp, columns,
+                                       await lookup_options(points[:config.stream_chunksize], options,
+                                                            {'timings': timings}))
+            self._set_timing_header(req, resp, timings)
+        else:
+            req.context['stats'] = {'timings': timings}
+            results = await lookup_options(points, options, req.context['stats'])
+            self._set_stats_headers(req, resp)
+            await _cpu(timings.timed('serialize', lambda: self._prepare_response(results, req, resp, columns),
+                                     len(points)))
+            self._set_timing_header(req, resp, timings)
+
+    def _prepare_async_stream(self, points, options, req, resp, columns, first):
+        encode = self._stream_encoder(req, resp, columns)
+        chunksize = config.stream_chunksize
+
+        async def stream():
+            yield encode(first)
+            try:
+                for start in range(chunksize, len(points), chunksize):
+                    yield encode(await lookup_options(points[start:start + chunksize], options))
+            except falcon.HTTPError as ex:
+                yield encode(self._stream_error(ex, columns))
+        resp.stream = stream()
+        resp.status = falcon.HTTP_200
+
+
+class AreasResource(object):
+
+    async def on_get(self, req, resp):
+        # rarely used, reads from the synchronous connection pool with each chunk produced on the executor
+        resp.stream = _iterate(areas.table_sql(areas.sql_format(req)))
+        resp.content_type = falcon.MEDIA_TEXT
+        resp.status = falcon.HTTP_200
+        resp.content_disposition = 'inline; filename = "create_areas.txt"'
+
+
+class HealthResource(object):
+
+    async def on_get(self, req, resp):
+        _, report = wsgiapp.health_report(check_database=False)
+        report['status'] = 'ok'
+        resp.text = wsgiapp.json.dumps(report)
+
+
+class ReadyResource(object):
+    """ As the WSGI /lookup/ready but checks the database on the asyncpg pool """
+
+    async def on_get(self, req, resp):
+        ready, report = await _cpu(wsgiapp.health_report, False)
+        if startup.database_required():
+            start = time.time()
+            try:
+                async with pool.acquire(timeout=config.pool_timeout) as conn:
+                    await conn.fetchval("SELECT 1")
+                report['database'] = {'state': startup.READY, 'seconds': time.time() - start}
+            except Exception as ex:
+                report['database'] = {'state': startup.FAILED, 'error': str(ex)}
+                ready = report['ready'] = False
+        resp.text = wsgiapp.json.dumps(report)
+        resp.status = falcon.HTTP_200 if ready else falcon.HTTP_503
+
+
+class MetricsResource(object):
+
+    async def on_get(self, req, resp):
+        resp.text = metrics.render()
+        resp.content_type = metrics.MEDIA_PROMETHEUS
+
+
+class Metrics(metrics.Middleware):
+    async def process_request(self, req, resp):
+        metrics.Middleware.process_request(self, req, resp)
+
+    async def process_response(self, req, resp, resource, req_succeeded):
+        metrics.Middleware.process_response(self, req, resp, resource, req_succeeded)
+
+
+class DatabasePool(object):
+    """ Opens the asyncpg pool when the server starts, connections are created on demand """
+    async def process_startup(self, scope, event):
+        global pool
+        pool = await asyncpg.create_pool(min_size=0, max_size=config.asgi_pool_maxconn, init=_init_connection,
+                                         connection_class=Connection,
+                                         **connect_kwargs(config.connstring))
+
+    async def process_shutdown(self, scope, event):
+        if pool is not None:
+            await pool.close()
+
+
+def create():
+    api = falcon.asgi.App(middleware=[DatabasePool(), Metrics()])
+    # the falcon 1 defaults, falcon 3 splits no lists (x=1,2&y=3,4) and keeps blank values (x=&y=)
+    api.req_options.auto_parse_qs_csv = True
+    api.req_options.keep_blank_qs_values = False
+    api.add_route('/lookup/areas', AreasResource())
+    api.add_route('/lookup/health', HealthResource())
+    api.add_route('/lookup/ready', ReadyResource())
+    api.add_route('/lookup/metrics', MetricsResource())
+    api.add_route('/lookup', LookupResource())
+    return api
+
+
+app = create()
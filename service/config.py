@@ -1,8 +1,49 @@
 import os
 
-datadir = os.path.expanduser('/data/xylookup/datadir')
+datadir = os.path.expanduser(os.environ.get('XYLOOKUP_DATADIR', '/data/xylookup/datadir'))  # env for e.g. the benchmarks
 dataprepdir = os.path.expanduser('/data/xylookup/dataprep')
 connstring = "dbname=xylookup user=postgres port=5432 password=postgres"
+# loading of the coastlines, rasters, landmask and area index: 'eager' when the app is created (use with gunicorn
+# preload_app), 'background' in a thread after the app is created (/lookup/ready reports when done) or 'lazy' on first use
+init_mode = 'eager'
+warmup = False  # read all pages of the memory mapped data after loading so the first requests don't wait for the disk
+# connection pool (per process), connections are opened on demand
+pool_maxconn = 10  # maximum number of connections, should be at least the number of threads per worker
+pool_timeout = 30  # seconds to wait for a free connection before the request fails
+pool_check_idle = 60  # connections that were idle for more seconds are checked before use
+# threads per process that run the lookup stages (database, areas, grids, shoredistance) of a request concurrently,
+# 0 runs the stages one after another in the request thread
+stage_workers = 8
+# ASGI app (service/asgi.py): threads for the CPU bound stages and maximum number of asyncpg connections per process
+asgi_cpu_workers = 8
+asgi_pool_maxconn = 50
+# memory (bytes) per process for decoded tiles of rasters stored as compressed tiles
+raster_cache_bytes = 512 * 1024 * 1024
+# duplicate points are looked up once, set to a number of decimals to also merge points that are equal after rounding
+dedup_precision = None
+# result cache, enabled by setting the number of decimals of the coordinates in the cache key (e.g. 6, about 0.1 m)
+result_cache_precision = None
+result_cache_bytes = 256 * 1024 * 1024  # in process LRU
+result_cache_path = None  # optional SQLite file shared by all workers on a node, e.g. '/data/xylookup/cache.sqlite'
+data_version = '1'  # change when rasters, areas or coastlines are updated so cached results are not reused
+# points per chunk of a streaming response (stream=true or Accept: application/x-ndjson)
+stream_chunksize = 10000
+# profiling of single requests by operators: a /lookup request with the header X-Profile: <profile_token> is run
+# under cProfile (see service/profiling.py), None disables profiling
+profile_token = None
+profile_dir = None  # directory for the <request id>.prof files, None returns the report as the response instead
+profile_limit = 60  # functions in the returned report
+# /lookup/metrics of all gunicorn workers: each worker writes its metrics to <metrics_dir>/<pid>.json at most every
+# metrics_dump_interval seconds (and when scraped) and the endpoint sums the files. None returns only the metrics of
+# the worker that handles the scrape, with a pid label.
+metrics_dir = None
+metrics_dump_interval = 5
+# batch jobs (service/jobs.py), run by python -m service.jobs
+jobs_dir = os.path.expanduser('/data/xylookup/jobs')
+jobs_workers = 2  # worker processes of the job runner
+jobs_chunksize = 100000  # points per result chunk, a finished chunk is not looked up again after a restart
+jobs_nice = 10  # the job runner runs at a lower priority than the web workers
+jobs_keep_days = 7  # finished jobs are removed after this many days
 
 areas = {
     "final_fixed_grid5": ("obis", ["id", "name"]),
@@ -12,3 +53,17 @@ areas = {
     "lme_grid5": ("lme", ["id", "name"]),
     "iho_grid5": ("iho", ["id", "name"])
 }
+
+# on land check for the shoredistance: 'postgis' queries the water_polygons0_00005 table,
+# 'landmask' uses the in process land/water mask created by dataprep/landmask.py
+onland = 'postgis'
+landmaskdir = os.path.join(datadir, 'landmask')
+
+# areas lookup: 'postgis' queries the areas tables, 'memory' uses the in process index created by dataprep/areas.py
+areas_engine = 'postgis'
+# areasdistancewithin lookup: 'postgis' or 'memory' for the in process index, the in process distances are on a sphere
+# and can differ from PostGIS for areas at almost exactly the requested distance
+areas_distance_engine = 'postgis'
+areasdir = os.path.join(datadir, 'areas')
+# rows per fetch and per response chunk of the /lookup/areas SQL script
+areas_sql_batchsize = 10000
@@ -0,0 +1,126 @@
+import threading
+import time
+from contextlib import contextmanager
+import psycopg2
+import psycopg2.pool
+import service.config as config
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    pass
+
+
+class ConnectionPool(object):
+    """ Thread safe pool of PostgreSQL connections.
+
+    Connections are opened on demand up to maxconn, when all are in use getconn waits at most timeout seconds.
+    Connections that have been idle for more than check_idle seconds are checked before they are handed out, broken
+    connections are replaced by a new connection. state(conn) keeps data for as long as a connection is open.
+    """
+    def __init__(self, connstring, maxconn=10, timeout=30, check_idle=60):
+        self.connstring = connstring
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self._idle = []  # (connection, time it was returned)
+        self._size = 0  # idle and used connections
+        self._state = {}  # id(connection) => dict, removed when the connection is closed
+        self._lock = threading.Condition()
+
+    def getconn(self):
+        deadline = time.time() + self.timeout
+        with self._lock:
+            while not self._idle and self._size >= self.maxconn:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeout('No database connection available within {} seconds'.format(self.timeout))
+                self._lock.wait(remaining)
+            if self._idle:
+                conn, since = self._idle.pop()
+            else:
+                conn, since = None, None
+                self._size += 1
+        try:
+            if conn is not None and not self._healthy(conn, since):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = psycopg2.connect(self.connstring)
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        with self._lock:
+            if discard or conn.closed:
+                self._close(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.time()))
+            self._lock.notify()
+
+    def state(self, conn):
+        """ Dict for data about the session of conn (e.g. temporary tables), empty for a new connection """
+        with self._lock:
+            return self._state.setdefault(id(conn), {})
+
+    @contextmanager
+    def connection(self):
+        """ Connection for the duration of a request, it is rolled back when returned to the pool """
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard)
+
+    def closeall(self):
+        with self._lock:
+            for conn, _ in self._idle:
+                self._close(conn)
+            self._size -= len(self._idle)
+            self._idle = []
+
+    def _healthy(self, conn, since):
+        if conn.closed:
+            return False
+        if time.time() - since < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self, conn):
+        with self._lock:  # reentrant, putconn and closeall hold it already
+            self._state.pop(id(conn), None)
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+pool = ConnectionPool(config.connstring, maxconn=config.pool_maxconn, timeout=config.pool_timeout,
+                      check_idle=config.pool_check_idle)
+
+
+def check():
+    """ Seconds for a round trip to the database, raises when the database can't be reached """
+    start = time.time()
+    with pool.connection() as conn, conn.cursor() as cur:
+        cur.execute("SELECT 1")
+    return time.time() - start
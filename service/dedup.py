@@ -0,0 +1,33 @@
+import numpy as np
+
+
+def _spread_bits(v):
+    """ Inserts a zero bit between each of the lower 32 bits of v """
+    v = v & np.uint64(0x00000000FFFFFFFF)
+    for shift, mask in [(16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F),
+                        (2, 0x3333333333333333), (1, 0x5555555555555555)]:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_codes(points, bits=24):
+    """ Z-order curve codes of lon/lat points on a 2^bits by 2^bits grid, nearby points get nearby codes """
+    scale = 2 ** bits - 1
+    x = np.round((points[:, 0] + 180) / 360 * scale).astype(np.uint64)
+    y = np.round((points[:, 1] + 90) / 180 * scale).astype(np.uint64)
+    return _spread_bits(x) | (_spread_bits(y) << np.uint64(1))
+
+
+def unique_points(points, precision=None):
+    """ Unique points, optionally after rounding to precision decimals, sorted along a Morton curve.
+
+    Returns the unique points and for every input point the index of its unique point, so results for the unique
+    points can be scattered back with results[inverse].
+    """
+    if precision is not None:
+        points = np.round(points, precision)
+    unique, inverse = np.unique(points, axis=0, return_inverse=True)
+    order = np.argsort(morton_codes(unique), kind='mergesort')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return unique[order], rank[inverse.reshape(-1)]
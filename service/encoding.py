@@ -0,0 +1,29 @@
+import simplejson as json
+import msgpack
+import numpy as np
+
+MEDIA_NDJSON = 'application/x-ndjson'
+
+
+def encode_arrays(value, binary):
+    """ Replaces the numpy arrays in a columnar result by lists, or for msgpack (binary) by typed arrays
+    {'dtype': numpy dtype string, 'shape': [...], 'data': bytes} that clients read with numpy.frombuffer """
+    if isinstance(value, np.ndarray):
+        if binary:
+            return {'dtype': value.dtype.str, 'shape': list(value.shape), 'data': value.tobytes()}
+        return value.tolist()
+    elif isinstance(value, dict):
+        return dict((k, encode_arrays(v, binary)) for k, v in value.items())
+    return value
+
+
+def chunk_encoder(binary, columns=False):
+    """ Function that encodes a chunk of results for a streaming response or a job result, as one JSON line per point
+    or one msgpack array per chunk, columnar chunks are one JSON line or msgpack map """
+    if binary:
+        if columns:
+            return lambda results: msgpack.packb(encode_arrays(results, True), use_bin_type=True)
+        return lambda results: msgpack.packb(results, use_bin_type=False)
+    if columns:
+        return lambda results: (json.dumps(encode_arrays(results, False), ignore_nan=True) + '\n').encode('utf-8')
+    return lambda results: ''.join(json.dumps(result) + '\n' for result in results).encode('utf-8')
@@ -0,0 +1,199 @@
+import struct
+import numpy as np
+
+
+def points_in_polygons(x, y, edges, start, stop, boundary=True, maxpairs=5000000):
+    """ Even-odd point in polygon test for a batch of points, each point with its own set of polygon edges.
+
+    edges is an (m, 4) array of x1, y1, x2, y2 segments forming closed rings. Point i is tested against
+    edges[start[i]:stop[i]]. With boundary points on an edge count as inside, like ST_Intersects, otherwise
+    points on the left and bottom edges are inside and points on the right and top edges are outside.
+    Work is done in chunks of at most maxpairs point/edge combinations to bound memory.
+    """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    start, stop = np.asarray(start, dtype=np.int64), np.asarray(stop, dtype=np.int64)
+    inside = np.zeros(len(x), dtype=bool)
+    counts = stop - start
+    cumcounts = np.cumsum(counts)
+    begin = 0
+    while begin < len(x):
+        # take at least one point per chunk, and as many as fit in maxpairs
+        offset = cumcounts[begin - 1] if begin > 0 else 0
+        end = max(begin + 1, int(np.searchsorted(cumcounts, offset + maxpairs, side='right')))
+        inside[begin:end] = _points_in_polygons(x[begin:end], y[begin:end], edges, start[begin:end], counts[begin:end],
+                                                boundary)
+        begin = end
+    return inside
+
+
+def _points_in_polygons(x, y, edges, start, counts, boundary):
+    total = counts.sum()
+    if total == 0:
+        return np.zeros(len(x), dtype=bool)
+    pointidx = np.repeat(np.arange(len(x)), counts)
+    edgeidx = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(start, counts)
+    x1, y1, x2, y2 = edges[edgeidx].T
+    px, py = x[pointidx], y[pointidx]
+    straddles = (y1 > py) != (y2 > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xcross = x1 + (py - y1) * (x2 - x1) / (y2 - y1)
+    crossed = straddles & (px < xcross)
+    odd = np.bincount(pointidx[crossed], minlength=len(x)) % 2 == 1
+    if not boundary:
+        return odd
+    onedge = (((x2 - x1) * (py - y1) - (y2 - y1) * (px - x1)) == 0) & \
+             (np.minimum(x1, x2) <= px) & (px <= np.maximum(x1, x2)) & \
+             (np.minimum(y1, y2) <= py) & (py <= np.maximum(y1, y2))
+    return odd | (np.bincount(pointidx[onedge], minlength=len(x)) > 0)
+
+
+def edges_within(x, y, edges, start, stop, angle, maxpairs=5000000):
+    """ For each point whether one of edges[start[i]:stop[i]] is within angle radians, see gc_distances_to_edges.
+    Work is done in chunks of at most maxpairs point/edge combinations like points_in_polygons. """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    start, stop = np.asarray(start, dtype=np.int64), np.asarray(stop, dtype=np.int64)
+    within = np.zeros(len(x), dtype=bool)
+    counts = stop - start
+    cumcounts = np.cumsum(counts)
+    begin = 0
+    while begin < len(x):
+        offset = cumcounts[begin - 1] if begin > 0 else 0
+        end = max(begin + 1, int(np.searchsorted(cumcounts, offset + maxpairs, side='right')))
+        n = counts[begin:end]
+        pointidx = np.repeat(np.arange(end - begin), n)
+        edgeidx = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(start[begin:end], n)
+        close = gc_distances_to_edges(x[begin:end][pointidx], y[begin:end][pointidx], edges[edgeidx]) <= angle
+        within[begin:end] = np.bincount(pointidx[close], minlength=end - begin) > 0
+        begin = end
+    return within
+
+
+RADIUS = 6371008.8  # mean earth radius in meters
+MIN_RADIUS = 6335439.0  # smallest radius of curvature of the WGS84 spheroid (meridian at the equator)
+
+
+def distance_boxes(x, y, distance, bulge=0.0, margin=1.01):
+    """ Longitude/latitude boxes containing everything within distance meters of the points, returned as arrays
+    (point index, minx, miny, maxx, maxy) sorted by point index. Boxes crossing the antimeridian are split in two,
+    boxes reaching a pole span all longitudes. The latitudes are widened by bulge degrees for great circle edges
+    bulging out of the lon/lat boxes of their polygons. """
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    delta = distance * margin / MIN_RADIUS
+    dlat = np.degrees(delta) + bulge
+    miny, maxy = np.maximum(y - dlat, -90.0), np.minimum(y + dlat, 90.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.sin(min(delta, np.pi / 2)) / np.cos(np.radians(y))
+    polar = (np.abs(y) + dlat >= 90) | ~(np.abs(ratio) < 1)
+    dlon = np.where(polar, 180.0, np.degrees(np.arcsin(np.where(polar, 0.0, ratio))))
+    minx, maxx = x - dlon, x + dlon
+    idx = np.arange(len(x))
+    full = dlon >= 180
+    west, east = ~full & (minx < -180), ~full & (maxx > 180)
+    boxes = [(idx, np.where(full, -180.0, np.maximum(minx, -180.0)), miny,
+              np.where(full, 180.0, np.minimum(maxx, 180.0)), maxy),
+             (idx[west], minx[west] + 360, miny[west], np.full(west.sum(), 180.0), maxy[west]),
+             (idx[east], np.full(east.sum(), -180.0), miny[east], maxx[east] - 360, maxy[east])]
+    boxes = [np.concatenate(parts) for parts in zip(*boxes)]
+    order = np.argsort(boxes[0], kind='mergesort')
+    return tuple(part[order] for part in boxes)
+
+
+def _unit_vectors(x, y):
+    lon, lat = np.radians(x), np.radians(y)
+    return np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+
+
+def _dot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def _angles(a, b):
+    return np.arctan2(np.linalg.norm(np.cross(a, b), axis=1), _dot(a, b))
+
+
+def gc_distances_to_edges(x, y, edges):
+    """ Great circle distance in radians from point i to edge i, an edge (x1, y1, x2, y2) is the shortest great
+    circle arc between its ends """
+    edges = np.asarray(edges, dtype=float).reshape(-1, 4)
+    p, a, b = _unit_vectors(x, y), _unit_vectors(edges[:, 0], edges[:, 1]), _unit_vectors(edges[:, 2], edges[:, 3])
+    distances = np.minimum(_angles(p, a), _angles(p, b))
+    n = np.cross(a, b)
+    norm = np.linalg.norm(n, axis=1)
+    arc = norm > 1e-12  # zero length edges only have the end distance
+    n = n[arc] / norm[arc, None]
+    pn = _dot(p[arc], n)
+    c = p[arc] - pn[:, None] * n  # p projected on the plane of the great circle
+    between = (_dot(np.cross(a[arc], c), n) >= 0) & (_dot(np.cross(c, b[arc]), n) >= 0)
+    crosstrack = np.arcsin(np.minimum(np.abs(pn), 1.0))
+    distances[arc] = np.where(between, crosstrack, distances[arc])
+    return distances
+
+
+def gc_bulge(edges):
+    """ Degrees that the great circle arcs of the edges reach further north or south than their ends """
+    edges = np.asarray(edges, dtype=float).reshape(-1, 4)
+    if len(edges) == 0:
+        return 0.0
+    a, b = _unit_vectors(edges[:, 0], edges[:, 1]), _unit_vectors(edges[:, 2], edges[:, 3])
+    n = np.cross(a, b)
+    norm = np.linalg.norm(n, axis=1)
+    arc = norm > 1e-12
+    n = n[arc] / norm[arc, None]
+    # the points of the great circle furthest from the equator, the arc bulges when it passes one of them
+    top = np.column_stack((-n[:, 0] * n[:, 2], -n[:, 1] * n[:, 2], 1 - n[:, 2] ** 2))
+    topnorm = np.linalg.norm(top, axis=1)
+    valid = topnorm > 1e-12
+    top[valid] /= topnorm[valid, None]
+    bulge = np.zeros(len(n))
+    for t in (top, -top):
+        passes = valid & (_dot(np.cross(a[arc], t), n) >= 0) & (_dot(np.cross(t, b[arc]), n) >= 0)
+        toplat = np.degrees(np.arcsin(np.minimum(np.abs(t[:, 2]), 1.0)))
+        endlat = np.maximum(np.abs(edges[arc, 1]), np.abs(edges[arc, 3]))
+        bulge = np.maximum(bulge, np.where(passes, toplat - endlat, 0.0))
+    return float(bulge.max()) if len(bulge) else 0.0
+
+
+def ring_edges(ring):
+    """ Edges (x1, y1, x2, y2) of a closed ring given as an (n, 2) array of coordinates """
+    ring = np.asarray(ring, dtype=float)
+    return np.column_stack((ring[:-1], ring[1:]))
+
+
+def polygon_rings(wkb):
+    """ Returns the rings of all polygons in a 2D WKB geometry (e.g. from ST_AsBinary) as a list of (n, 2) arrays.
+    Points and lines, also inside geometry collections, are skipped. """
+    rings = []
+    _read_geometry(bytes(wkb), 0, rings)
+    return rings
+
+
+def _read_geometry(wkb, offset, rings):
+    byteorder = '<' if wkb[offset:offset + 1] == b'\x01' else '>'
+    gtype, = struct.unpack_from(byteorder + 'I', wkb, offset + 1)
+    offset += 5
+    if gtype == 1:  # Point
+        return offset + 16
+    elif gtype == 2:  # LineString
+        _, offset = _read_points(wkb, offset, byteorder)
+        return offset
+    elif gtype == 3:  # Polygon
+        nrings, = struct.unpack_from(byteorder + 'I', wkb, offset)
+        offset += 4
+        for _ in range(nrings):
+            ring, offset = _read_points(wkb, offset, byteorder)
+            rings.append(ring)
+        return offset
+    elif gtype in (4, 5, 6, 7):  # Multi* and GeometryCollection
+        ngeoms, = struct.unpack_from(byteorder + 'I', wkb, offset)
+        offset += 4
+        for _ in range(ngeoms):
+            offset = _read_geometry(wkb, offset, rings)
+        return offset
+    raise ValueError('Unsupported WKB geometry type {}'.format(gtype))
+
+
+def _read_points(wkb, offset, byteorder):
+    npoints, = struct.unpack_from(byteorder + 'I', wkb, offset)
+    offset += 4
+    points = np.frombuffer(wkb, dtype=byteorder + 'f8', count=2 * npoints, offset=offset).reshape(npoints, 2)
+    return points.astype(float), offset + 16 * npoints
@@ -0,0 +1,145 @@
+""" Batch lookup jobs for very large point sets.
+
+A job is a directory in config.jobs_dir with the points (points.npy), the job description (job.json) and a result file
+per chunk of config.jobs_chunksize points (chunks/<n>). The web app only creates jobs and reports on them, the jobs
+are run by a separate process with a pool of low priority workers:
+
+    python -m service.jobs
+
+Chunk results are written atomically and chunks that already have a result are skipped, so after a crash or restart
+the runner continues where it stopped.
+"""
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+import service.config as config
+import service.encoding as encoding
+
+QUEUED, RUNNING, FINISHED, FAILED = 'queued', 'running', 'finished', 'failed'
+
+
+def _write_atomic(path, data):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def job_dir(job_id):
+    return os.path.join(config.jobs_dir, job_id)
+
+
+def _chunk_path(job_id, chunk):
+    return os.path.join(job_dir(job_id), 'chunks', str(chunk))
+
+
+def _save_job(job):
+    _write_atomic(os.path.join(job_dir(job['id']), 'job.json'), json.dumps(job).encode('utf-8'))
+
+
+def create_job(points, options, binary):
+    """ Stores the points and options of a new job and returns the job, results are msgpack when binary is set
+    and NDJSON otherwise """
+    job_id = uuid.uuid4().hex
+    os.makedirs(os.path.join(job_dir(job_id), 'chunks'))
+    np.save(os.path.join(job_dir(job_id), 'points.npy'), np.ascontiguousarray(points, dtype=np.float64))
+    chunksize = config.jobs_chunksize
+    options = dict(options, stream=False)
+    job = {'id': job_id, 'status': QUEUED, 'options': options, 'binary': bool(binary), 'npoints': len(points),
+           'chunksize': chunksize, 'nchunks': (len(points) + chunksize - 1) // chunksize, 'created': time.time()}
+    _save_job(job)
+    return job
+
+
+def get_job(job_id):
+    """ The job with its progress (fraction of the chunks that are done) or None when it doesn't exist """
+    try:
+        int(job_id, 16)
+        with open(os.path.join(job_dir(job_id), 'job.json')) as f:
+            job = json.load(f)
+    except (ValueError, IOError, OSError):
+        return None
+    done = sum(1 for name in os.listdir(os.path.join(job_dir(job_id), 'chunks')) if name.isdigit())
+    job['progress'] = done / float(job['nchunks']) if job['nchunks'] else 1.0
+    return job
+
+
+def result_chunks(job):
+    """ Iterator over the encoded result chunks of a finished job """
+    for chunk in range(job['nchunks']):
+        with open(_chunk_path(job['id'], chunk), 'rb') as f:
+            yield f.read()
+
+
+def _run_chunk(job, chunk):
+    """ Looks up one chunk of a job in a worker process and writes its encoded results """
+    import service.lookup as lookup
+    points = np.load(os.path.join(job_dir(job['id']), 'points.npy'), mmap_mode='r')
+    start = chunk * job['chunksize']
+    points = np.array(points[start:start + job['chunksize']])
+    options = job['options']
+    f = lookup.lookup_columns if options.get('format') == 'columns' else lookup.lookup_points
+    results = f(points, options['areas'], options['grids'], options['shoredistance'], options['areasdistancewithin'])
+    encode = encoding.chunk_encoder(job['binary'], options.get('format') == 'columns')
+    _write_atomic(_chunk_path(job['id'], chunk), encode(results))
+    return chunk
+
+
+def _pending_jobs():
+    if not os.path.isdir(config.jobs_dir):
+        return []
+    jobs = [get_job(job_id) for job_id in os.listdir(config.jobs_dir)]
+    jobs = [job for job in jobs if job and job['status'] in (QUEUED, RUNNING)]
+    return sorted(jobs, key=lambda job: job['created'])
+
+
+def _remove_old_jobs():
+    if not os.path.isdir(config.jobs_dir):
+        return
+    for job_id in os.listdir(config.jobs_dir):
+        job = get_job(job_id)
+        if job and job['status'] in (FINISHED, FAILED) and time.time() - job['created'] > config.jobs_keep_days * 86400:
+            shutil.rmtree(job_dir(job_id), ignore_errors=True)
+
+
+def run_job(pool, job):
+    """ Runs the chunks of the job that don't have a result yet """
+    job['status'] = RUNNING
+    job.pop('progress', None)
+    _save_job(job)
+    todo = [chunk for chunk in range(job['nchunks']) if not os.path.exists(_chunk_path(job['id'], chunk))]
+    try:
+        for chunk in pool.imap_unordered(_run_chunk_args, [(job, chunk) for chunk in todo]):
+            logging.info("job %s chunk %s of %s done", job['id'], chunk + 1, job['nchunks'])
+        job['status'] = FINISHED
+    except Exception as ex:
+        logging.exception("job %s failed", job['id'])
+        job['status'], job['error'] = FAILED, str(ex)
+    job['finished'] = time.time()
+    _save_job(job)
+
+
+def _run_chunk_args(args):
+    return _run_chunk(*args)
+
+
+def run(poll=5):
+    """ Runs the pending jobs one after another, forever """
+    import multiprocessing
+    logging.basicConfig(format='%(asctime)s - %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+    os.nice(config.jobs_nice)  # the workers inherit the lower priority
+    pool = multiprocessing.Pool(config.jobs_workers)
+    while True:
+        _remove_old_jobs()
+        for job in _pending_jobs():
+            logging.info("job %s: %s points", job['id'], job['npoints'])
+            run_job(pool, job)
+        time.sleep(poll)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,58 @@
+import os
+import json
+import numpy as np
+import service.config as config
+import service.geometry as geometry
+import service.startup as startup
+
+LAND, WATER, MIXED = 0, 1, 2
+
+
+class LandMask:
+    """ Land/water grid created by dataprep/landmask.py.
+
+    Cells that are completely land or water are answered from the mask, points in cells crossed by the coastline
+    (MIXED) are tested against the edges of the water polygons clipped to that cell. Points on an edge, so also
+    points exactly on the coastline, are in water like with ST_DWithin(..., 0) against the water polygons in PostGIS.
+    """
+    def __init__(self, maskdir):
+        with open(os.path.join(maskdir, 'landmask.json')) as f:
+            metadata = json.load(f)
+        self.minx, self.maxy = metadata['minx'], metadata['maxy']
+        self.resolution = metadata['resolution']
+        self.mask = np.load(os.path.join(maskdir, 'mask.npy'), mmap_mode='r')
+        self.nrow, self.ncol = self.mask.shape
+        self.cells = np.load(os.path.join(maskdir, 'cells.npy'), mmap_mode='r')  # sorted ids of the MIXED cells
+        self.offsets = np.load(os.path.join(maskdir, 'offsets.npy'), mmap_mode='r')  # edges per MIXED cell
+        self.edges = np.load(os.path.join(maskdir, 'edges.npy'), mmap_mode='r')
+
+    def get_rows_cols(self, x, y):
+        # points on a cell border belong to the cell above and to the right of it, the edges of the clipped water
+        # polygons on that border count as inside so the border itself is water when the neighbouring cell is
+        miny = self.maxy - self.nrow * self.resolution
+        rows = self.nrow - 1 - np.floor((y - miny) / self.resolution).astype(int)
+        cols = np.floor((x - self.minx) / self.resolution).astype(int)
+        return np.clip(rows, 0, self.nrow - 1), np.clip(cols, 0, self.ncol - 1)
+
+    def in_water(self, x, y):
+        rows, cols = self.get_rows_cols(x, y)
+        states = self.mask[rows, cols]
+        water = states == WATER
+        mixed = np.flatnonzero(states == MIXED)
+        if len(mixed) > 0:
+            i = np.searchsorted(self.cells, rows[mixed] * self.ncol + cols[mixed])
+            water[mixed] = geometry.points_in_polygons(x[mixed], y[mixed], self.edges,
+                                                       self.offsets[i], self.offsets[i + 1], boundary=True)
+        return water
+
+
+def on_land(points):
+    """ In process replacement for shoredistance._on_land, returns -1 for points on land and 1 for points in water """
+    x, y = points.T
+    onland = np.ones(len(points))
+    onland[~_landmask.get().in_water(x, y)] = -1
+    return onland
+
+
+_landmask = startup.Subsystem('landmask', lambda: LandMask(config.landmaskdir),
+                              lambda mask: [mask.mask, mask.cells, mask.offsets, mask.edges])
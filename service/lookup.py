@@ -1,40 +1,69 @@
 import simplejson as json
 import msgpack
 import falcon
-import psycopg2
-import uuid
 import numpy as np
 import sys
 if sys.version_info[0] == 2:
     from StringIO import StringIO
 else:
     from io import StringIO
+from io import BytesIO
 import service.areas as areas
 import service.rasters as rasters
 import service.shoredistance as shoredistance
 import service.config as config
+import service.db as db
+import service.dedup as dedup
+import service.metrics as metrics
+import service.profiling as profiling
+import service.resultcache as resultcache
 import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-conn = psycopg2.connect(config.connstring)
+_stage_executor = ThreadPoolExecutor(max_workers=config.stage_workers) if config.stage_workers > 0 else None
 
 
 def points_to_file(points):
-    txt = "\n".join(["{}\tSRID=4326;POINT({} {})'".format(idx, xy[0], xy[1]) for idx, xy in enumerate(points)])
+    row = "{0}\tSRID=4326;POINT({1} {2})"
+    txt = "\n".join([row.format(idx, xy[0], xy[1]) for idx, xy in enumerate(points)])
     return StringIO(txt)
 
 
-def load_points(cur, points, geog=False):
-    tmptable = "tmp" + str(uuid.uuid4()).replace("-", "")
-    cur.execute("""CREATE TABLE {0}(id INTEGER);
-       SELECT AddGeometryColumn('{0}', 'geom', 4326, 'POINT', 2);
-       CREATE INDEX {0}_geom_gist ON {0} USING gist(geom);""".format(tmptable))
+_pointstable = "xylookup_points"
+_pointstable_truncate = 1000  # rolled back rows stay behind as dead tuples and temporary tables are never vacuumed
+_pointstable_sql = """CREATE TEMPORARY TABLE {0}(id INTEGER, geom geometry(Point, 4326));
+            CREATE INDEX {0}_geom_gist ON {0} USING gist(geom);""".format(_pointstable)
+
+
+def _count_pointstable_use(state):
+    """ Counts a request using the points table of a connection (state is the dict of the connection), returns True
+    when the table has to be emptied first """
+    uses = state.get('pointstable_uses', 0)
+    truncate = uses >= _pointstable_truncate
+    state['pointstable_uses'] = 1 if truncate else uses + 1
+    return truncate
+
+
+def _prepare_pointstable(cur):
+    """ Creates the session temporary points table once per connection, the table is emptied by the rollback at the
+    end of each request so no DDL is needed per request """
+    conn = cur.connection
+    state = db.pool.state(conn)
+    if not state.get('pointstable'):
+        cur.execute(_pointstable_sql)
+        conn.commit()
+        state['pointstable'] = True
+    if _count_pointstable_use(state):
+        cur.execute("TRUNCATE {}".format(_pointstable))
+        conn.commit()
+
+
+def load_points(cur, points):
+    _prepare_pointstable(cur)
     f = points_to_file(points)
-    cur.copy_from(f, tmptable, columns = ('id', 'geom'))
-    if geog:
-        cur.execute("""ALTER TABLE {0} ADD COLUMN geog geography;
-            UPDATE {0} SET geog = geom::geography;
-            CREATE INDEX {0}_geog_gist ON {0} USING gist(geog);""".format(tmptable))
-    return tmptable
+    cur.copy_from(f, _pointstable, columns=('id', 'geom'))
+    return _pointstable
 
 
 def get_param_as_bool_with_default(req, paramname, default=False):
@@ -45,21 +74,296 @@ def get_param_as_bool_with_default(req, paramname, default=False):
 
 
 def get_param_as_int_with_default(req, paramname, required=False, min=None, max=None, default= 0):
-    v = req.get_param_as_int(paramname, required=required, min=min, max=max)
+    # bounds are checked here as falcon 3 renamed the min and max arguments of get_param_as_int
+    v = req.get_param_as_int(paramname, required=required)
     if v is None:
         v = default
+    elif min is not None and v < min:
+        raise falcon.HTTPInvalidParam('The value must be at least ' + str(min), paramname)
+    elif max is not None and max < v:
+        raise falcon.HTTPInvalidParam('The value may not exceed ' + str(max), paramname)
     return v
 
 
-def lookup(req):
+def _run_stages(stages):
+    """ Runs the independent stages (name => function) concurrently and returns their results (name => result).
+    The first stage runs in the calling thread, the others on the stage executor. In a profiled request all stages
+    run in the calling thread so the profiler sees them. """
+    names = list(stages)
+    if _stage_executor is None or len(names) < 2 or profiling.active():
+        return dict((name, stages[name]()) for name in names)
+    futures = [(name, _stage_executor.submit(stages[name])) for name in names[1:]]
+    results = {names[0]: stages[names[0]]()}
+    for name, future in futures:
+        results[name] = future.result()
+    return results
+
+
+def _db_stage(points, pareas, pareasdistancewithin, ponland, timings):
+    """ All work that needs the database, the points table only exists within this connection """
+    with db.pool.connection() as conn, conn.cursor() as cur:
+        with timings.stage('load_points', len(points)):
+            pointstable = load_points(cur, points)
+        with timings.stage('query', len(points)):  # areas and on land in one statement
+            return areas.query(cur, len(points), pointstable, pareasdistancewithin, pareas,
+                               shoredistance.onland_sql(pointstable) if ponland else None)
+
+
+def lookup_points(points, pareas, pgrids, pshoredistance, pareasdistancewithin, stats=None):
+    """ Runs the requested stages for an (n, 2) array of validated points and returns the results per point.
+
+    Duplicate coordinates (after rounding to config.dedup_precision decimals) are looked up once and the unique points
+    are processed along a Morton curve so nearby points hit the same raster pages and tiles. When the result cache is
+    enabled only the points missing from it are looked up. When a stats dict is passed the number of points, unique
+    points, result cache hits and misses and the tile cache hit ratio are added to it, the stage timings are added to
+    stats['timings'] (a metrics.Timings).
+    """
+    stats, timings = _begin(stats)
+    unique, inverse = _dedup(points, timings)
+    if resultcache.cache is None:
+        results = _lookup_unique(unique, pareas, pgrids, pshoredistance, pareasdistancewithin, timings)
+    else:
+        keys, results, missing = _cache_get(unique, pareas, pgrids, pshoredistance, pareasdistancewithin, timings)
+        computed = _lookup_unique(unique[missing], pareas, pgrids, pshoredistance, pareasdistancewithin,
+                                  timings) if missing else []
+        _cache_fill(keys, results, missing, computed, stats)
+    _add_stats(stats, points, unique)
+    return _expand_results(results, inverse)
+
+
+# The steps of lookup_points and lookup_columns, shared with the ASGI app which runs them on its executor
+
+
+def _begin(stats):
+    """ The stats dict of a lookup and its timings """
+    if stats is None:
+        stats = {}
+    return stats, stats.setdefault('timings', metrics.Timings())
+
+
+def _dedup(points, timings):
+    with timings.stage('dedup', len(points)):
+        return dedup.unique_points(points, config.dedup_precision)
+
+
+def _cache_keys(points, pareas, pgrids, pshoredistance, pareasdistancewithin):
+    namespace = '{:d}{:d}{:d}{}'.format(bool(pareas), bool(pgrids), bool(pshoredistance), pareasdistancewithin)
+    return resultcache.cache.keys(points, namespace)
+
+
+def _cache_get(points, pareas, pgrids, pshoredistance, pareasdistancewithin, timings):
+    """ The cache keys of the points, the cached results (None when missing) and the indexes of the missing points """
+    with timings.stage('cache_get', len(points)):
+        keys = _cache_keys(points, pareas, pgrids, pshoredistance, pareasdistancewithin)
+        results = resultcache.cache.get_many(keys)
+    return keys, results, [i for i, result in enumerate(results) if result is None]
+
+
+def _cache_fill(keys, results, missing, computed, stats):
+    """ Stores the computed results of the missing points in the cache and in results """
+    if missing:
+        with stats['timings'].stage('cache_put', len(missing)):
+            resultcache.cache.put_many([keys[i] for i in missing], computed)
+        for i, result in zip(missing, computed):
+            results[i] = result
+    stats['cache_hits'], stats['cache_misses'] = len(results) - len(missing), len(missing)
+    return results
+
+
+def _expand_results(results, inverse):
+    """ The results of the unique points for all points, inverse maps the points to the unique points """
+    return [results[i] for i in inverse.tolist()]
+
+
+def _lookup_unique(points, pareas, pgrids, pshoredistance, pareasdistancewithin, timings=None):
+    timings = timings or metrics.Timings()
+    columns = _lookup_unique_columns(points, pareas, pgrids, pshoredistance, pareasdistancewithin, timings)
+    with timings.stage('results', len(points)):
+        return _columns_to_results(columns, len(points))
+
+
+def _plan_stages(points, pareas, pgrids, pshoredistance, pareasdistancewithin):
+    """ Splits the work for the points into the database work and the stages that only need the CPU. Returns the
+    arguments for the database stage (areas, areasdistancewithin, onland) or None and the CPU stages. """
+    engine = config.areas_distance_engine if pareasdistancewithin > 0 else config.areas_engine
+    areas_in_db = pareas and engine == 'postgis'
+    onland_in_db = pshoredistance and config.onland == 'postgis'
+    dbargs = (areas_in_db, pareasdistancewithin, onland_in_db) if areas_in_db or onland_in_db else None
+    stages = OrderedDict()
+    if pareas and not areas_in_db:
+        import service.areaindex as areaindex
+        stages['areas'] = lambda: areaindex.get_areas(points, pareasdistancewithin)
+    if pgrids:
+        stages['grids'] = lambda: rasters.get_columns(points)
+    if pshoredistance:
+        stages['shoredistance'] = lambda: shoredistance.get_coastlinedistances(points)
+    if pshoredistance and not onland_in_db:
+        stages['onland'] = lambda: shoredistance.get_onland(None, points, None)
+    return dbargs, stages
+
+
+def _combine_stages(values, pareas, pgrids, pshoredistance):
+    """ The columns from the stage results, the database stage result is (areas, onland) """
+    columns = {}
+    areavals, onland = values.get('db', (None, None))
+    if pareas:
+        columns['areas'] = areavals if areavals is not None else values['areas']
+    if pgrids:
+        columns['grids'] = values['grids']
+    if pshoredistance:
+        columns['shoredistance'] = np.round(values['shoredistance'] * (onland if onland is not None else values['onland']))
+    return columns
+
+
+def _lookup_unique_columns(points, pareas, pgrids, pshoredistance, pareasdistancewithin, timings=None):
+    """ Runs the stages for the points, the areas are a list per point, grids and shoredistance are arrays. Each
+    stage is timed in timings. """
+    timings = timings or metrics.Timings()
+    dbargs, cpustages = _plan_stages(points, pareas, pgrids, pshoredistance, pareasdistancewithin)
+    stages = OrderedDict()
+    if dbargs:
+        stages['db'] = lambda: _db_stage(points, *(dbargs + (timings,)))
+    stages.update(cpustages)
+    stages = OrderedDict((name, timings.timed(name, f, len(points))) for name, f in stages.items())
+    return _combine_stages(_run_stages(stages), pareas, pgrids, pshoredistance)
+
+
+def _columns_to_results(columns, npoints):
+    if 'grids' in columns:
+        rastervals = rasters.columns_to_dicts(columns['grids'], npoints)
+    results = [{} for _ in range(npoints)]
+    for idx, result in enumerate(results):
+        if 'areas' in columns:
+            result['areas'] = columns['areas'][idx]
+        if 'grids' in columns:
+            result['grids'] = rastervals[idx]
+        if 'shoredistance' in columns:
+            result['shoredistance'] = columns['shoredistance'][idx]
+    return results
+
+
+def _compact_areas(areavals, inverse):
+    """ Per area alias the distinct area records (values) and for each point the indices of its areas in values,
+    point i has the areas indices[offsets[i]:offsets[i + 1]] """
+    output = {}
+    for _, (alias, _) in config.areas.items():
+        records, positions, lists = [], {}, []
+        for pointareas in areavals:
+            ids = []
+            for record in pointareas.get(alias, ()):
+                key = tuple(sorted(record.items()))
+                if key not in positions:
+                    positions[key] = len(records)
+                    records.append(record)
+                ids.append(positions[key])
+            lists.append(ids)
+        ulengths = np.array([len(ids) for ids in lists], dtype=np.int64)
+        ustarts = np.cumsum(ulengths) - ulengths
+        uindices = np.array([i for ids in lists for i in ids], dtype=np.int32)
+        lengths = ulengths[inverse]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+        output[alias] = {'values': records, 'offsets': offsets,
+                         'indices': uindices[np.repeat(ustarts[inverse], lengths) + within]}
+    return output
+
+
+def lookup_columns(points, pareas, pgrids, pshoredistance, pareasdistancewithin, stats=None):
+    """ Like lookup_points but returns the results as columns: an array per grid category (NaN without data), a
+    shoredistance array and per area alias the compact membership lists of _compact_areas. The results are not taken
+    from or added to the result cache as it stores results per point. """
+    stats, timings = _begin(stats)
+    unique, inverse = _dedup(points, timings)
+    columns = _lookup_unique_columns(unique, pareas, pgrids, pshoredistance, pareasdistancewithin, timings)
+    _add_stats(stats, points, unique)
+    with timings.stage('results', len(points)):
+        return _expand_columns(columns, inverse)
+
+
+def _expand_columns(columns, inverse):
+    """ The columns of the unique points for all points, inverse maps the points to the unique points """
+    output = {'npoints': len(inverse)}
+    if 'areas' in columns:
+        output['areas'] = _compact_areas(columns['areas'], inverse)
+    if 'grids' in columns:
+        output['grids'] = dict((category, values[inverse]) for category, values in columns['grids'].items())
+    if 'shoredistance' in columns:
+        output['shoredistance'] = columns['shoredistance'][inverse]
+    return output
+
+
+def _add_stats(stats, points, unique):
+    stats['points'], stats['unique'] = len(points), len(unique)
+    metrics.registry.inc('xylookup_points_total', value=len(points))
+    tilecache = stats['timings'].tilecache  # only the tiles read by the stages of this request
+    hits, misses = tilecache.hits, tilecache.misses
+    if hits + misses > 0:
+        stats['tilecache_hit_ratio'] = hits / float(hits + misses)
+
+
+MEDIA_BINARY = 'application/octet-stream'
+MEDIA_CSV = 'text/csv'
+
+
+def points_from_buffer(data, dtype='<f8'):
+    """ Points from a buffer of x, y pairs (x0, y0, x1, y1, ...) of floats, without copying the data """
+    try:
+        dtype = np.dtype(dtype)
+        if dtype.kind != 'f':
+            raise TypeError('not a float type')
+        return np.frombuffer(data, dtype=dtype).reshape(-1, 2)
+    except (TypeError, ValueError):
+        raise falcon.HTTPInvalidParam('Binary points should be a buffer of x, y pairs of floats (default little '
+                                      'endian float64)', 'points')
+
+
+def points_from_csv(data):
+    """ Points from the first two columns (x, y) of CSV data, a header line is skipped """
+    first = data.lstrip().split(b'\n', 1)[0].split(b',')[0]
+    try:
+        float(first)
+        header = 0
+    except ValueError:
+        header = 1
+    try:
+        return np.loadtxt(BytesIO(data), delimiter=',', usecols=(0, 1), skiprows=header, ndmin=2)
+    except (IndexError, ValueError):
+        raise falcon.HTTPInvalidParam('CSV data should have numeric x and y coordinates in the first two columns',
+                                      'points')
+
+
+def _query_options(req):
+    return (get_param_as_bool_with_default(req, 'areas', default=True),
+            get_param_as_bool_with_default(req, 'grids', default=True),
+            get_param_as_bool_with_default(req, 'shoredistance', default=True),
+            get_param_as_int_with_default(req, 'areasdistancewithin', min=0, default=0),
+            get_param_as_bool_with_default(req, 'stream', default=False),
+            req.get_param('format') or 'records')
+
+
+def parse_request(req, raw_data=None):
+    """ Returns the validated (n, 2) array of points and the requested options of a GET or POST request, raw_data is
+    the body of a POST request when it has been read already (ASGI).
+
+    Points are posted as a JSON or msgpack object with the points as nested x, y arrays, as binary data: an
+    application/octet-stream body or a msgpack bin (or {'dtype': ..., 'data': bin}) of x, y pairs which is used
+    without copying, or as text/csv with x and y in the first two columns. For binary and CSV bodies the options are
+    query parameters as with GET.
+    """
     # points should be a nested array of x,y coordinates
     if req.method == "POST":
         try:
-            raw_data = req.stream.read()
+            if raw_data is None:
+                raw_data = req.bounded_stream.read()
         except Exception as ex:
             raise falcon.HTTPError(falcon.HTTP_400, 'Error reading data from POST', str(ex))
 
-        if req.content_type and req.content_type.lower() == falcon.MEDIA_MSGPACK:
+        content_type = req.content_type.lower() if req.content_type else None
+        if content_type == MEDIA_BINARY:
+            data = {'points': points_from_buffer(raw_data)}
+        elif content_type == MEDIA_CSV:
+            data = {'points': points_from_csv(raw_data)}
+        elif content_type == falcon.MEDIA_MSGPACK:
             try:
                 data = msgpack.unpackb(raw_data, use_list=False, raw=False)
             except Exception:
@@ -72,54 +376,112 @@ def lookup(req):
         if not data or type(data) is not dict or len(data) == 0:
             raise falcon.HTTPInvalidParam('Request POST data should be a JSON object/Python dictionary/R list', 'POST body')
         points = data.get("points", None)
-        if not points or len(points) == 0:
+        if points is None:
+            points = ()
+        elif isinstance(points, bytes):
+            points = points_from_buffer(points)
+        elif isinstance(points, dict):
+            points = points_from_buffer(points.get('data'), points.get('dtype', '<f8'))
+        if len(points) == 0:
             raise falcon.HTTPInvalidParam('No points provided', 'points')
-        pareas = data.get('areas', True)
-        pgrids = data.get('grids', True)
-        pshoredistance = data.get('shoredistance', True)
-        pareasdistancewithin = data.get('areasdistancewithin', 0) # distance to search for areas
+        if content_type in (MEDIA_BINARY, MEDIA_CSV):
+            pareas, pgrids, pshoredistance, pareasdistancewithin, pstream, pformat = _query_options(req)
+        else:
+            pareas = data.get('areas', True)
+            pgrids = data.get('grids', True)
+            pshoredistance = data.get('shoredistance', True)
+            pareasdistancewithin = data.get('areasdistancewithin', 0) # distance to search for areas
+            pstream = data.get('stream', False)
+            pformat = data.get('format', 'records')
     else:
         x = req.get_param_as_list('x')
         y = req.get_param_as_list('y')
-        pareas = get_param_as_bool_with_default(req, 'areas', default=True)
-        pgrids = get_param_as_bool_with_default(req, 'grids', default=True)
-        pshoredistance = get_param_as_bool_with_default(req, 'shoredistance', default=True)
-        pareasdistancewithin = get_param_as_int_with_default(req, 'areasdistancewithin', min=0, default=0)
+        pareas, pgrids, pshoredistance, pareasdistancewithin, pstream, pformat = _query_options(req)
         if not x or not y or len(x) == 0 or len(y) == 0:
             raise falcon.HTTPInvalidParam('Missing parameters x and/or y', 'x/y')
         elif len(x) != len(y):
             raise falcon.HTTPInvalidParam('Length of x parameter is different from length of y', 'x/y')
         points = list(zip(x, y))
 
-    points = np.array(points)
     try:
-        points = points.astype(float)
-    except ValueError:
+        points = np.asarray(points, dtype=float)
+    except (TypeError, ValueError):
         raise falcon.HTTPInvalidParam('Coordinates not numeric', 'x/y points')
+    if points.ndim != 2 or points.shape[1] < 2:
+        raise falcon.HTTPInvalidParam('Points should be x, y pairs', 'x/y points')
+    points = points[:, :2]
+
+    x, y = points[:, 0], points[:, 1]
+    invalid = np.flatnonzero(~((x >= -180) & (x <= 180) & (y >= -90) & (y <= 90)))  # NaN is invalid as well
+    if len(invalid) > 0:
+        raise falcon.HTTPInvalidParam('Invalid coordinates (xmin: -180, ymin: -90, xmax: 180, ymax: 90) for {} points, '
+                                      'at index {}'.format(len(invalid), ', '.join(str(i) for i in invalid[:10].tolist())),
+                                      'x/y points')
+    if pformat not in ('records', 'columns'):
+        raise falcon.HTTPInvalidParam('Format should be records or columns', 'format')
+    options = {'areas': pareas, 'grids': pgrids, 'shoredistance': pshoredistance,
+               'areasdistancewithin': pareasdistancewithin, 'stream': pstream, 'format': pformat}
+    return points, options
+
 
-    if not all([-180 <= p[0] <= 180 and -90 <= p[1] <= 90 for p in points]):
-        raise falcon.HTTPInvalidParam('Invalid coordinates (xmin: -180, ymin: -90, xmax: 180, ymax: 90)', 'x/y points')
+def lookup_options(points, options, stats=None):
+    """ lookup_points (or lookup_columns) for the parsed options of a request, failures are turned into HTTP errors """
+    f = lookup_columns if options.get('format') == 'columns' else lookup_points
     try:
-        with conn.cursor() as cur:
-            pointstable = load_points(cur, points, geog=(pareas and pareasdistancewithin > 0))
-            if pareas:
-                areavals = areas.get_areas(cur, points, pointstable, pareasdistancewithin)
-            if pgrids:
-                rastervals = rasters.get_values(points)
-            if pshoredistance:
-                shoredists = shoredistance.get_shoredistance(cur, points, pointstable)
-        results = [{} for _ in range(len(points))]
-        for idx, result in enumerate(results):
-            if pareas:
-                result['areas'] = areavals[idx]
-            if pgrids:
-                result['grids'] = rastervals[idx]
-            if pshoredistance:
-                result['shoredistance'] = shoredists[idx]
+        return f(points, options['areas'], options['grids'], options['shoredistance'],
+                             options['areasdistancewithin'], stats)
+    except db.PoolTimeout as ex:
+        raise falcon.HTTPServiceUnavailable('Database busy', str(ex), retry_after=1)
     except Exception as ex:
         traceback.print_exc()
-	print(ex)
+        print(ex)
         raise falcon.HTTPError(falcon.HTTP_400, 'Error looking up data for provided points', str(ex))
-    finally:
-        conn.rollback()
+
+
+def lookup(req):
+    points, options = parse_request(req)
+    stats = {}
+    results = lookup_options(points, options, stats)
+    req.context['stats'] = stats
     return results
+
+
+def lookup_stream(points, options, chunksize=None, timings=None):
+    """ Looks up the points in chunks of at most chunksize points (default config.stream_chunksize) and returns an
+    iterator over the results of each chunk. The first chunk is looked up before returning so errors in the request
+    still result in an error response, errors in later chunks are raised while iterating. The stages of the first
+    chunk are timed in timings. """
+    chunksize = chunksize or config.stream_chunksize
+    first = lookup_options(points[:chunksize], options, {'timings': timings} if timings else None)
+
+    def chunks():
+        yield first
+        for start in range(chunksize, len(points), chunksize):
+            yield lookup_options(points[start:start + chunksize], options)
+    return chunks()
+
+
+if __name__ == "__main__":
+    import time
+    import uuid
+
+    def load_points_ddl(cur, points):
+        """ Previous implementation, creates a new table for every request """
+        tmptable = "tmp" + str(uuid.uuid4()).replace("-", "")
+        cur.execute("""CREATE TABLE {0}(id INTEGER);
+           SELECT AddGeometryColumn('{0}', 'geom', 4326, 'POINT', 2);
+           CREATE INDEX {0}_geom_gist ON {0} USING gist(geom);""".format(tmptable))
+        cur.copy_from(points_to_file(points), tmptable, columns=('id', 'geom'))
+        return tmptable
+
+    def per_request(f, points, repeat):
+        start = time.time()
+        for _ in range(repeat):
+            with db.pool.connection() as conn, conn.cursor() as cur:
+                f(cur, points)
+        return (time.time() - start) / repeat * 1000
+
+    for npoints, repeat in [(1, 200), (1000, 50), (100000, 5)]:
+        points = np.column_stack((np.random.uniform(-180, 180, npoints), np.random.uniform(-90, 90, npoints)))
+        print("{} points: ddl {:.2f} ms, temporary table {:.2f} ms per request".format(
+            npoints, per_request(load_points_ddl, points, repeat), per_request(load_points, points, repeat)))
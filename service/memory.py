@@ -0,0 +1,67 @@
+""" Memory report of the service processes (Linux), e.g. for the gunicorn master and its workers:
+
+    python -m service.memory $(cat /run/gunicorn.pid)
+
+Shared memory is used by more than one process: the memory mapped coastline, KD-tree, raster and index files and the
+pages of the master that the workers didn't change since the fork. Private memory is only used by that process, it
+grows with every worker. Pss divides the shared pages over the processes that use them.
+"""
+import os
+import sys
+
+FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty', 'Swap')
+
+
+def process_memory(pid='self'):
+    """ kB per field of /proc/<pid>/smaps_rollup, summed from /proc/<pid>/smaps when the kernel has no rollup """
+    path = '/proc/{}/smaps_rollup'.format(pid)
+    if not os.path.exists(path):
+        path = '/proc/{}/smaps'.format(pid)
+    memory = dict((field, 0) for field in FIELDS)
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 3 and parts[0].endswith(':') and parts[0][:-1] in memory:
+                memory[parts[0][:-1]] += int(parts[1])
+    memory['Shared'] = memory['Shared_Clean'] + memory['Shared_Dirty']
+    memory['Private'] = memory['Private_Clean'] + memory['Private_Dirty']
+    return memory
+
+
+def child_pids(pid):
+    children = []
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(name)) as f:
+                    stat = f.read()
+            except (IOError, OSError):
+                continue  # process ended
+            if int(stat[stat.rindex(')') + 2:].split()[1]) == int(pid):  # the ppid follows the state
+                children.append(int(name))
+    return sorted(children)
+
+
+def report(pid):
+    """ Memory in MB of the process and its children: [(pid, role, memory)] """
+    rows = [(int(pid), 'master', process_memory(pid))]
+    for child in child_pids(pid):
+        try:
+            rows.append((child, 'worker', process_memory(child)))
+        except (IOError, OSError):
+            pass
+    return [(p, role, dict((k, v / 1024.0) for k, v in memory.items())) for p, role, memory in rows]
+
+
+def format_report(rows):
+    lines = ['{:>8} {:>7} {:>9} {:>9} {:>9} {:>9}'.format('pid', 'role', 'rss MB', 'pss MB', 'shared', 'private')]
+    for pid, role, memory in rows:
+        lines.append('{:>8} {:>7} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            pid, role, memory['Rss'], memory['Pss'], memory['Shared'], memory['Private']))
+    lines.append('{:>8} {:>7} {:>9} {:>9.1f} {:>9} {:>9.1f}'.format(
+        'total', '', '', sum(m['Pss'] for _, _, m in rows), '', sum(m['Private'] for _, _, m in rows)))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    print(format_report(report(sys.argv[1] if len(sys.argv) > 1 else os.getpid())))
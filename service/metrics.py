@@ -0,0 +1,285 @@
+""" Stage timings and request metrics.
+
+Every lookup records how long each stage took and for how many points (parse, dedup, load_points, query, areas, grids,
+shoredistance, onland, serialize, ...). The timings of a request are sent in its Server-Timing header, all timings are
+aggregated per process in latency histograms and counters that /lookup/metrics returns in the Prometheus text format.
+A scrape reaches one gunicorn worker. Without config.metrics_dir the metrics are those of that worker (with a pid label),
+with it every worker writes its metrics to <metrics_dir>/<pid>.json and the endpoint returns the sum over all files.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+import service.config as config
+import service.resultcache as resultcache
+import service.tiles as tiles
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+MEDIA_PROMETHEUS = 'text/plain; version=0.0.4'
+
+
+class Registry(object):
+    """ Thread safe counters and histograms with labels """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = OrderedDict()  # (name, labels) => value
+        self._histograms = OrderedDict()  # (name, labels) => [count per bucket + inf, sum]
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, tuple(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, tuple(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+
+    def counter(self, name, labels=()):
+        return self._counters.get((name, tuple(labels)), 0)
+
+    def histogram(self, name, labels=()):
+        """ (count, sum) of a histogram """
+        counts, total = self._histograms.get((name, tuple(labels)), [[0], 0.0])
+        return sum(counts), total
+
+    def samples(self):
+        """ The counters as (name, labels, value) and the histograms as (name, labels, counts, sum) """
+        with self._lock:
+            counters = [(name, labels, value) for (name, labels), value in self._counters.items()]
+            histograms = [(name, labels, list(counts), total) for (name, labels), (counts, total) in
+                          self._histograms.items()]
+        return counters, histograms
+
+    def render(self, collected=(), samples=None, labels=None):
+        """ Prometheus text format, collected is a list of (name, kind, labels, value) read when rendering. samples
+        are (counters, histograms) as returned by samples() (the default) and labels are added to every sample, by
+        default the pid. Every metric family is written as one group, sorted by name and labels. """
+        counters, histograms = samples or self.samples()
+        extra = (('pid', str(os.getpid())),) if labels is None else tuple(labels)
+        scalars = sorted([(name, 'counter', tuple(labels), value) for name, labels, value in counters] +
+                         [(name, kind, tuple(labels), value) for name, kind, labels, value in collected],
+                         key=lambda sample: (sample[0], sample[2]))
+        histograms = sorted(((name, tuple(labels), counts, total) for name, labels, counts, total in histograms),
+                            key=lambda sample: (sample[0], sample[1]))
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP {} {}'.format(name, self._help.get(name, (kind, name))[1]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+        for name, kind, labels, value in scalars:
+            header(name, kind)
+            lines.append('{}{} {}'.format(name, _labels(labels + extra), _number(value)))
+        for name, labels, counts, total in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', le),) + extra), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels + extra), _number(total)))
+            lines.append('{}_count{} {}'.format(name, _labels(labels + extra), cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+registry.describe('xylookup_requests_total', 'counter', 'Requests by endpoint and HTTP status')
+registry.describe('xylookup_request_seconds', 'histogram', 'Request latency by endpoint')
+registry.describe('xylookup_points_total', 'counter', 'Points looked up')
+registry.describe('xylookup_stage_seconds', 'histogram', 'Time per lookup stage')
+registry.describe('xylookup_stage_points_total', 'counter', 'Points processed per lookup stage')
+registry.describe('xylookup_stage_errors_total', 'counter', 'Lookup stages that raised an error')
+
+
+registry.describe('xylookup_result_cache_hits_total', 'counter', 'Result cache hits, in process and shared')
+registry.describe('xylookup_result_cache_misses_total', 'counter', 'Result cache misses')
+registry.describe('xylookup_result_cache_bytes', 'gauge', 'Size of the in process result cache')
+registry.describe('xylookup_tile_cache_hits_total', 'counter', 'Decoded raster tile cache hits')
+registry.describe('xylookup_tile_cache_misses_total', 'counter', 'Decoded raster tile cache misses')
+registry.describe('xylookup_tile_cache_bytes', 'gauge', 'Size of the decoded raster tile cache')
+
+
+def cache_metrics():
+    """ The counters of the result and tile caches as (name, kind, labels, value) """
+    collected = [('xylookup_tile_cache_hits_total', 'counter', (), tiles.cache.hits),
+                 ('xylookup_tile_cache_misses_total', 'counter', (), tiles.cache.misses),
+                 ('xylookup_tile_cache_bytes', 'gauge', (), tiles.cache.nbytes)]
+    if resultcache.cache is not None:
+        stats = resultcache.cache.stats()
+        collected += [('xylookup_result_cache_hits_total', 'counter', (('tier', 'memory'),), stats['hits']),
+                      ('xylookup_result_cache_hits_total', 'counter', (('tier', 'shared'),), stats['shared_hits']),
+                      ('xylookup_result_cache_misses_total', 'counter', (), stats['misses']),
+                      ('xylookup_result_cache_bytes', 'gauge', (), stats['bytes'])]
+    return collected
+
+
+def render():
+    """ The metrics of this process, or of all processes with config.metrics_dir """
+    if not config.metrics_dir:
+        return registry.render(cache_metrics())
+    dump()
+    counters, histograms, collected = merge(load_snapshots())
+    return registry.render(collected, (counters, histograms), labels=())
+
+
+_last_dump = [0.0]
+
+
+def dump():
+    """ Writes the metrics of this process to <config.metrics_dir>/<pid>.json """
+    counters, histograms = registry.samples()
+    snapshot = {'pid': os.getpid(), 'counters': counters, 'histograms': histograms, 'collected': cache_metrics()}
+    if not os.path.isdir(config.metrics_dir):
+        os.makedirs(config.metrics_dir)
+    path = os.path.join(config.metrics_dir, '{}.json'.format(os.getpid()))
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot, f)
+    os.rename(tmp, path)
+    _last_dump[0] = time.time()
+
+
+def dump_periodically():
+    """ dump() when config.metrics_dir is set and the last dump is more than config.metrics_dump_interval ago """
+    if config.metrics_dir and time.time() - _last_dump[0] >= config.metrics_dump_interval:
+        dump()
+
+
+def load_snapshots():
+    snapshots = []
+    for path in glob.glob(os.path.join(config.metrics_dir, '*.json')):
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (IOError, OSError, ValueError):  # removed or replaced while reading
+            continue
+    return snapshots
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def clear():
+    """ Removes the snapshots of previous runs, call before the workers start """
+    if config.metrics_dir:
+        for path in glob.glob(os.path.join(config.metrics_dir, '*.json')):
+            os.remove(path)
+
+
+def merge(snapshots):
+    """ Sums the snapshots of the processes into (counters, histograms, collected). Counters and histograms of
+    processes that exited still count, gauges only for running processes. """
+    counters, histograms, collected = OrderedDict(), OrderedDict(), OrderedDict()
+
+    def key(name, labels):
+        return name, tuple(tuple(label) for label in labels)
+    for snapshot in snapshots:
+        alive = _alive(snapshot['pid'])
+        for name, labels, value in snapshot['counters']:
+            k = key(name, labels)
+            counters[k] = counters.get(k, 0) + value
+        for name, labels, counts, total in snapshot['histograms']:
+            k = key(name, labels)
+            previous = histograms.get(k, ([0] * len(counts), 0.0))
+            histograms[k] = ([a + b for a, b in zip(previous[0], counts)], previous[1] + total)
+        for name, kind, labels, value in snapshot['collected']:
+            if kind == 'gauge' and not alive:
+                continue
+            k = key(name, labels)
+            collected[k] = (kind, collected.get(k, (kind, 0))[1] + value)
+    return ([(name, labels, value) for (name, labels), value in counters.items()],
+            [(name, labels, counts, total) for (name, labels), (counts, total) in histograms.items()],
+            [(name, kind, labels, value) for (name, labels), (kind, value) in collected.items()])
+
+
+class Timings(object):
+    """ The stage timings of one request: (stage, seconds, points) in the order the stages finished. Stages that run
+    concurrently on the stage executor add to the same Timings. The tile cache hits and misses of the stages are
+    counted in tilecache. """
+    def __init__(self):
+        self.stages = []
+        self.tilecache = tiles.Counter()
+
+    @contextmanager
+    def stage(self, name, npoints=None):
+        start = time.time()
+        try:
+            with tiles.counting(self.tilecache):
+                yield
+        except Exception:
+            registry.inc('xylookup_stage_errors_total', (('stage', name),))
+            raise
+        finally:
+            self.add(name, time.time() - start, npoints)
+
+    def add(self, name, seconds, npoints=None):
+        self.stages.append((name, seconds, npoints))  # list.append is atomic
+        registry.observe('xylookup_stage_seconds', seconds, (('stage', name),))
+        if npoints:
+            registry.inc('xylookup_stage_points_total', (('stage', name),), npoints)
+
+    def timed(self, name, f, npoints=None):
+        """ f wrapped in the stage timer, for the stage functions run by lookup._run_stages """
+        def timed_f():
+            with self.stage(name, npoints):
+                return f()
+        return timed_f
+
+    def server_timing(self, total=None):
+        """ Server-Timing header value, the durations of a stage that ran more than once are added up """
+        durations = OrderedDict()
+        for name, seconds, npoints in self.stages:
+            previous = durations.get(name, (0.0, None))
+            durations[name] = (previous[0] + seconds, npoints if previous[1] is None else previous[1] + (npoints or 0))
+        if total is not None:
+            durations['total'] = (total, None)
+        return ', '.join('{};dur={:.2f}{}'.format(name, seconds * 1000, ';desc="{} points"'.format(npoints)
+                                                   if npoints else '')
+                         for name, (seconds, npoints) in durations.items())
+
+
+class Middleware(object):
+    """ Counts the requests and their latency per endpoint and status, the endpoint is the name of the resource """
+    def process_request(self, req, resp):
+        req.context['start'] = time.time()
+
+    def process_response(self, req, resp, resource, req_succeeded=True):
+        start = req.context.get('start')
+        if start is None:
+            return
+        endpoint = type(resource).__name__.replace('Resource', '').lower() if resource is not None else 'none'
+        status = str(resp.status).split(' ', 1)[0]
+        registry.inc('xylookup_requests_total', (('endpoint', endpoint), ('status', status)))
+        registry.observe('xylookup_request_seconds', time.time() - start, (('endpoint', endpoint),))
+        dump_periodically()
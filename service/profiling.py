@@ -0,0 +1,70 @@
+""" Profiling of single /lookup requests in production, for operators.
+
+Set config.profile_token and send it in the X-Profile header of a request. The request is run under cProfile with the
+lookup stages one after another in the request thread (cProfile only sees the thread it runs in) and without
+streaming. With config.profile_dir the profile is saved as <profile_dir>/<request id>.prof (read it with pstats or
+snakeviz) and the normal response is returned with the file name in the X-Profile-File header, otherwise the response
+is the text report of the functions with the highest cumulative time. Requests without the right token are not
+profiled. Only the WSGI app supports profiling.
+"""
+import cProfile
+import hmac
+import os
+import pstats
+import re
+import sys
+import threading
+import uuid
+import falcon
+import service.config as config
+if sys.version_info[0] == 2:
+    from StringIO import StringIO
+else:
+    from io import StringIO
+
+HEADER = 'X-Profile'
+_local = threading.local()
+
+
+def requested(req):
+    token = req.get_header(HEADER)
+    return bool(config.profile_token and token) and hmac.compare_digest(str(token), str(config.profile_token))
+
+
+def active():
+    """ True while the current thread runs a profiled request """
+    return getattr(_local, 'active', False)
+
+
+def request_id(req):
+    """ The X-Request-Id of the request (e.g. set by nginx) when it is safe as a file name, otherwise a new id """
+    rid = req.get_header('X-Request-Id')
+    return rid if rid and re.match(r'^[A-Za-z0-9_.-]{1,64}$', rid) else uuid.uuid4().hex
+
+
+def report(profile, limit=None):
+    out = StringIO()
+    stats = pstats.Stats(profile, stream=out)
+    stats.sort_stats('cumulative').print_stats(limit or config.profile_limit)
+    return out.getvalue()
+
+
+def run(req, resp, respond):
+    """ Runs respond() under cProfile and saves or returns the profile, a profile is also saved when respond fails """
+    rid = request_id(req)
+    resp.set_header('X-Request-Id', rid)
+    profile = cProfile.Profile()
+    _local.active = True
+    try:
+        profile.runcall(respond)
+    finally:
+        _local.active = False
+        if config.profile_dir:
+            if not os.path.isdir(config.profile_dir):
+                os.makedirs(config.profile_dir)
+            path = os.path.join(config.profile_dir, rid + '.prof')
+            profile.dump_stats(path)
+            resp.set_header('X-Profile-File', path)
+    if not config.profile_dir:
+        resp.body, resp.data, resp.stream = report(profile), None, None
+        resp.content_type = falcon.MEDIA_TEXT
@@ -5,6 +5,8 @@ import json
 import numpy as np
 from datetime import datetime
 import service.config as config
+import service.startup as startup
+from service.tiles import TiledArray, cache as tilecache
 
 
 class Raster:
@@ -14,8 +16,13 @@ class Raster:
         nrow, ncol = tuple(metadata['shape'])
         self.nrow = nrow
         self.ncol = ncol
-        path = os.path.join(rasterdir, self.id + '.mmf')
-        self.data = np.memmap(path, dtype=metadata['dtype'], mode='r', shape=(nrow, ncol))
+        tiles = metadata.get('tiles')
+        if tiles:
+            self.data = TiledArray(os.path.join(rasterdir, self.id), metadata['dtype'], (nrow, ncol), tiles['size'],
+                                   tilecache)
+        else:
+            path = os.path.join(rasterdir, self.id + '.mmf')
+            self.data = np.memmap(path, dtype=metadata['dtype'], mode='r', shape=(nrow, ncol))
         self.minx, self.miny = metadata['minx']-1e-12, metadata['miny']-1e-12  # 1e-12 to take care of edge cases
         self.maxx, self.maxy = metadata['maxx']+1e-12, metadata['maxy']+1e-12  # 1e-12 to take care of edge cases
         self.xres, self.yres = metadata['xres'], metadata['yres']
@@ -47,7 +54,6 @@ class Raster:
         return rows.astype(int), cols.astype(int)
 
     def get_values(self, x, y):
-        print(self.id)
         r,c = self.get_rows_cols(x, y)
         values = self.data[r,c]
         okdata = (values <= self.nodata[0]) | (values >= self.nodata[1]) # check outside nodata
@@ -57,53 +63,68 @@ class Raster:
         return str(self.__dict__)
 
 
-def get_values(points):
-    output = [{} for _ in points]
-    x, y = points.T
-    ids = np.array(range(len(x)))
-    for category in categories:
-        ids_remaining, x_remaining, y_remaining = ids, x, y
-        for raster in rasters:
-            if raster.category == category:
-                which = raster.contains_points(x_remaining,y_remaining)
-                values, okdata = raster.get_values(x_remaining[which], y_remaining[which])
-                values = values[okdata]
-                id_ok = ids_remaining[which][okdata]
-                if len(id_ok) > 0:
-                    for i, id in enumerate(id_ok):
-                        output[id][category] = float(values[i])
-
-                    ids_remaining = np.array(list(set(ids_remaining) - set(id_ok)))
-                    if len(ids_remaining) > 0:
-                        x_remaining = x[ids_remaining]
-                        y_remaining = y[ids_remaining]
-                    else:
-                        break
+def get_columns(points):
+    """ Values per category as float arrays (NaN where no raster has data), for each point the value is taken from
+    the highest resolution raster with data """
+    x, y = points[:, 0], points[:, 1]
+    category_rasters = _rasters.get()
+    columns = {}
+    for category in category_rasters:
+        values = np.full(len(x), np.nan)
+        remaining = np.arange(len(x))
+        for raster in category_rasters[category]:
+            idx = remaining[raster.contains_points(x[remaining], y[remaining])]
+            if len(idx) == 0:
+                continue
+            rastervalues, okdata = raster.get_values(x[idx], y[idx])
+            values[idx[okdata]] = rastervalues[okdata]
+            remaining = remaining[np.isnan(values[remaining])]
+            if len(remaining) == 0:
+                break
+        columns[category] = values
+    return columns
+
+
+def columns_to_dicts(columns, npoints):
+    """ One dict per point with the categories that have a value """
+    output = [{} for _ in range(npoints)]
+    for category, values in columns.items():
+        for d, value in zip(output, values.tolist()):
+            if value == value:  # not NaN
+                d[category] = value
     return output
 
 
-rasterdir = os.path.join(config.datadir, 'rasters')
-rasters = [Raster(rasterdir, d) for d in json.load(open(os.path.join(rasterdir, 'rasters.metadata'), 'r'))]
-rasters = [r for r in rasters if r.id not in [u'BOEM_east', u'BOEM_west']] # TODO handle rasters with a different projection e.g. BOEM data (+proj=utm +zone=16 +datum=NAD27 +units=us-ft +no_defs +ellps=clrk66 +nadgrids=@conus,@alaska,@ntv2_0.gsb,@ntv1_can.dat)
-rasters.sort(key=lambda r: math.fabs(r.xres))  # smaller xres = higher precision so ranked first in the list of rasters
-categories = set([r.category for r in rasters])
+def get_values(points):
+    return columns_to_dicts(get_columns(points), len(points))
+
+
+def _load_rasters():
+    """ The rasters per category, highest resolution first """
+    rasterdir = os.path.join(config.datadir, 'rasters')
+    rasters = [Raster(rasterdir, d) for d in json.load(open(os.path.join(rasterdir, 'rasters.metadata'), 'r'))]
+    rasters = [r for r in rasters if r.id not in [u'BOEM_east', u'BOEM_west']] # TODO handle rasters with a different projection e.g. BOEM data (+proj=utm +zone=16 +datum=NAD27 +units=us-ft +no_defs +ellps=clrk66 +nadgrids=@conus,@alaska,@ntv2_0.gsb,@ntv1_can.dat)
+    rasters.sort(key=lambda r: math.fabs(r.xres))  # smaller xres = higher precision so ranked first in the list of rasters
+    categories = set([r.category for r in rasters])
+    return dict((category, [r for r in rasters if r.category == category]) for category in categories)
+
+
+def _warm_rasters(category_rasters):
+    return [r.data.data if isinstance(r.data, TiledArray) else r.data
+            for rasters in category_rasters.values() for r in rasters]
+
+
+def get_categories():
+    return set(_rasters.get())
+
+
+_rasters = startup.Subsystem('rasters', _load_rasters, _warm_rasters)
 
 if __name__ == "__main__":
     pts = np.array([[2.890605926513672, 51.241779327392585], [3, 55], [3, 54.999999],
                     [0, -90], [0, -89.9999999]])
-    v = get_values(pts)
-
-    # get_values(np.array([[-49, 51]]))
-
-    def _get_test_points():
-        import psycopg2
-        conn = psycopg2.connect("dbname=xylookup user=postgres port=5432 password=postgres")
-        cur = conn.cursor()
-        cur.execute("SELECT x, y FROM test_points_1000000")
-        pts = cur.fetchall()
-        return [tuple(point) for point in pts]
-    pts = _get_test_points()
-    print("Ready for rasters :-)")
+    print(get_values(pts))
+    # timings on synthetic data at several batch sizes: python -m benchmarks.run --only rasters
+    pts = np.column_stack((np.random.uniform(-180, 180, 1000000), np.random.uniform(-90, 90, 1000000)))
     import cProfile
-    v = get_values(pts)
-    cProfile.runctx('get_raster_values(points)', globals(), locals())
+    cProfile.runctx('get_columns(pts)', globals(), locals())
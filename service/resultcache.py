@@ -0,0 +1,118 @@
+import logging
+import os
+import sqlite3
+import struct
+import threading
+from collections import OrderedDict
+import msgpack
+import service.config as config
+
+
+class ResultCache(object):
+    """ Lookup results per point, keyed by the rounded coordinate, the requested stages and the data version.
+
+    The first tier is an in process LRU of at most maxbytes of msgpack encoded results. The optional second tier is an
+    SQLite file that all worker processes of a node can share, errors of that file (e.g. locked by another worker for
+    too long) are logged and count as misses or skipped writes.
+    """
+    def __init__(self, precision, maxbytes, path=None, version=''):
+        self.precision = precision
+        self.maxbytes = maxbytes
+        self.path = path
+        self.version = version
+        self.nbytes = 0
+        self.hits, self.shared_hits, self.misses = 0, 0, 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()  # sqlite connections can't be shared between threads or forked processes
+        if path:
+            try:
+                with self._sqlite() as conn:
+                    conn.execute("CREATE TABLE IF NOT EXISTS results (key BLOB PRIMARY KEY, value BLOB)")
+            except sqlite3.OperationalError as ex:
+                logging.warning("Shared result cache %s not created: %s", path, ex)
+
+    def _sqlite(self):
+        pid, conn = getattr(self._local, 'conn', (None, None))
+        if pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = os.getpid(), conn
+        return conn
+
+    def keys(self, points, namespace):
+        prefix = '{}|{}|'.format(self.version, namespace).encode('utf-8')
+        rounded = points.round(self.precision).tolist()
+        return [prefix + struct.pack('<dd', x, y) for x, y in rounded]
+
+    def get_many(self, keys):
+        """ Cached results for the keys, None for the misses """
+        values = [None] * len(keys)
+        with self._lock:
+            for i, key in enumerate(keys):
+                value = self._entries.pop(key, None)
+                if value is not None:
+                    self._entries[key] = value  # most recently used
+                    values[i] = value
+        hits = sum(1 for v in values if v is not None)
+        shared = 0
+        if self.path and hits < len(keys):
+            missing = dict((key, i) for i, key in enumerate(keys) if values[i] is None)
+            found = self._get_shared(list(missing))
+            for key, value in found:
+                values[missing[key]] = value
+            self._add(found)
+            shared = len(found)
+        with self._lock:
+            self.hits += hits
+            self.shared_hits += shared
+            self.misses += len(keys) - hits - shared
+        return [msgpack.unpackb(v, raw=False) if v is not None else None for v in values]
+
+    def put_many(self, keys, results):
+        entries = [(key, msgpack.packb(result, use_bin_type=True)) for key, result in zip(keys, results)]
+        self._add(entries)
+        if self.path:
+            self._put_shared(entries)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'shared_hits': self.shared_hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'bytes': self.nbytes}
+
+    def _get_shared(self, keys):
+        found = []
+        try:
+            conn = self._sqlite()
+            for i in range(0, len(keys), 500):  # stay below the sqlite limit of bound parameters
+                batch = keys[i:i + 500]
+                query = "SELECT key, value FROM results WHERE key IN ({})".format(", ".join("?" * len(batch)))
+                found.extend((bytes(key), bytes(value)) for key, value in conn.execute(query, batch))
+        except sqlite3.OperationalError as ex:
+            logging.warning("Shared result cache %s not read: %s", self.path, ex)
+        return found
+
+    def _put_shared(self, entries):
+        try:
+            with self._sqlite() as conn:
+                conn.executemany("INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)", entries)
+        except sqlite3.OperationalError as ex:
+            logging.warning("Shared result cache %s not written: %s", self.path, ex)  # still cached in process
+
+    def _add(self, entries):
+        with self._lock:
+            for key, value in entries:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.nbytes -= len(key) + len(old)
+                self._entries[key] = value
+                self.nbytes += len(key) + len(value)
+            while self.nbytes > self.maxbytes and self._entries:
+                key, value = self._entries.popitem(last=False)
+                self.nbytes -= len(key) + len(value)
+
+
+cache = None
+if config.result_cache_precision is not None:
+    cache = ResultCache(config.result_cache_precision, config.result_cache_bytes, config.result_cache_path,
+                        config.data_version)
@@ -1,17 +1,21 @@
-import math, json, gc, os
+import json, gc, os, shutil, fcntl
 import numpy as np
+import scipy
 from scipy.spatial import cKDTree
 import service.config as config
+import service.startup as startup
 import logging
 
-_coastlines, _coastpoints, _tree = None, None, None
-
 
 def _init():
+    """ Coastpoints, coastlines and the KD-tree """
     v = '5'  # '50' for lower resolution
-    global _coastlines, _coastpoints, _tree
-    _coastpoints, _coastlines = _load_coastlines(os.path.join(config.datadir, "shoredistance/coastlines"+v+".jsonlines"))
-    _tree = _build_kdtree(_coastpoints)
+    return _load_cache(os.path.join(config.datadir, "shoredistance/coastlines"+v+".jsonlines"))
+
+
+def _warm(data):
+    coastpoints, coastlines, tree = data
+    return [coastpoints, coastlines, tree.data, tree.indices]
 
 
 def _load_coastlines(path):
@@ -37,6 +41,73 @@ def _load_coastlines(path):
         return np.concatenate(points), np.array(coastlines)
 
 
+_cache_version = 1
+
+
+def _cache_key(path):
+    """ Identifies the source jsonlines and the layout of the cached files """
+    stat = os.stat(path)
+    return {'version': _cache_version, 'scipy': scipy.__version__, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _cache_valid(cachedir, key):
+    try:
+        with open(os.path.join(cachedir, 'cache.json')) as f:
+            return json.load(f)['key'] == key
+    except (IOError, OSError, ValueError, KeyError):
+        return False
+
+
+def _build_cache(path, cachedir, key):
+    """ Writes the coastpoints, coastlines and the state of the cartesian KD-tree as .npy files """
+    logging.info("Building coastlines cache for %s", path)
+    tmpdir = cachedir + '.tmp'
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    coastpoints, coastlines = _load_coastlines(path)
+    np.save(os.path.join(tmpdir, 'coastpoints.npy'), coastpoints)
+    np.save(os.path.join(tmpdir, 'coastlines.npy'), coastlines)
+    tree = _build_kdtree(coastpoints)
+    state = []  # cKDTree pickle state, arrays are stored separately so they can be memory mapped
+    for i, item in enumerate(tree.__getstate__()):
+        if isinstance(item, np.ndarray):
+            name = 'tree{}.npy'.format(i)
+            np.save(os.path.join(tmpdir, name), item)
+            state.append({'npy': name})
+        else:
+            state.append({'value': item})
+    with open(os.path.join(tmpdir, 'cache.json'), 'w') as f:
+        json.dump({'key': key, 'tree': state}, f)
+    if os.path.exists(cachedir):
+        shutil.rmtree(cachedir)
+    os.rename(tmpdir, cachedir)
+
+
+def _load_cache(path):
+    """ Loads the coastlines and KD-tree from the binary cache next to path, the cache is (re)built when the
+    source file changed. The arrays are memory mapped so loading is fast and the pages are shared between processes. """
+    cachedir = path + '.cache'
+    key = _cache_key(path)
+    if not _cache_valid(cachedir, key):
+        with open(cachedir + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # only one process builds the cache
+            try:
+                if not _cache_valid(cachedir, key):
+                    _build_cache(path, cachedir, key)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    with open(os.path.join(cachedir, 'cache.json')) as f:
+        meta = json.load(f)
+    coastpoints = np.load(os.path.join(cachedir, 'coastpoints.npy'), mmap_mode='r')
+    coastlines = np.load(os.path.join(cachedir, 'coastlines.npy'), mmap_mode='r')
+    state = [np.load(os.path.join(cachedir, item['npy']), mmap_mode='r') if 'npy' in item else item['value']
+             for item in meta['tree']]
+    tree = cKDTree.__new__(cKDTree)
+    tree.__setstate__(tuple(state))
+    return coastpoints, coastlines, tree
+
+
 def _np_to_cartesian(p):
     # convert lat lon to cartesian coordinates
     lat,lon = np.radians(p[:, 1]), np.radians(p[:, 0])
@@ -47,132 +118,169 @@ def _np_to_cartesian(p):
     return points
 
 
-def _np_gc_distance(p, points):
-    """ http://www.movable-type.co.uk/scripts/latlong.html """
-    dLon = np.radians(points[:, 0] - p[0])  # * 0.0174532925
-    lat1 = np.radians(p[1])
-    lat2 = np.radians(points[:,1])
-    return np.arccos(np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * np.cos(dLon))
-
-
 def _build_kdtree(coastpoints):
     points = _np_to_cartesian(coastpoints)
     tree = cKDTree(points)
     return tree
 
 
-def _gc_distance(A, B):
-    """ http://www.movable-type.co.uk/scripts/latlong.html """
-    dLon = math.radians(B[0]-A[0])  # * 0.0174532925
-    if abs(dLon) < 1.7453e-10 and abs(math.radians(B[1]-A[1])) < 1.7453e-10:
-        return 0
-    lat1 = math.radians(A[1])
-    lat2 = math.radians(B[1])
+def _np_gc_distances(positions, points):
+    """ Great circle distances between each position (n, 2) and its candidate points (n, k, 2) """
+    dLon = np.radians(points[..., 0] - positions[:, np.newaxis, 0])
+    lat1 = np.radians(positions[:, np.newaxis, 1])
+    lat2 = np.radians(points[..., 1])
+    return np.arccos(np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * np.cos(dLon))
 
-    try:
-        return(math.acos(math.sin(lat1)*math.sin(lat2) + math.cos(lat1)*math.cos(lat2) * math.cos(dLon)))
-    except ValueError:
-        return 0
-
-def _gc_distancetoline(p, A, B):
-    """ http://www.movable-type.co.uk/scripts/latlong.html """
-    xd = B[0] - A[0]
-    yd = B[1] - A[1]
-    r = ((p[0]- A[0])*(xd) + (p[1]- A[1])*yd)/(xd*xd + yd*yd)
-    if 0 < r < 1:
-        pointOnLine = (A[0] + r * xd, A[1] + r * yd)
-        return _gc_distance(p, pointOnLine)
-    else:
-        return float("Inf") # minimum distance to p, A and p, B has already been calculated
+
+def _np_gc_distance_pairs(A, B):
+    """ Great circle distance in radians for (n, 2) arrays of point pairs, 0 for (nearly) equal points """
+    dLon = np.radians(B[:, 0] - A[:, 0])
+    dLat = np.radians(B[:, 1] - A[:, 1])
+    lat1 = np.radians(A[:, 1])
+    lat2 = np.radians(B[:, 1])
+    c = np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * np.cos(dLon)
+    outside = np.abs(c) > 1  # outside the domain of arccos, treated as 0
+    c[outside] = 1
+    distances = np.arccos(c)
+    distances[(np.abs(dLon) < 1.7453e-10) & (np.abs(dLat) < 1.7453e-10)] = 0
+    return distances
+
+
+def _np_gc_distancetoline(p, A, B):
+    """ Great circle distance in radians from the points to their segments A-B for (n, 2) arrays, inf when the
+    lon/lat projection of the point falls outside the segment """
+    xd = B[:, 0] - A[:, 0]
+    yd = B[:, 1] - A[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = ((p[:, 0] - A[:, 0]) * xd + (p[:, 1] - A[:, 1]) * yd) / (xd * xd + yd * yd)
+    online = (0 < r) & (r < 1)
+    distances = np.full(len(p), np.inf)
+    r = r[online]
+    pointsonline = np.column_stack((A[online, 0] + r * xd[online], A[online, 1] + r * yd[online]))
+    distances[online] = _np_gc_distance_pairs(p[online], pointsonline)
+    return distances
 
 
 def _getcoastlinedistance(positions, tree, coastpoints, coastlines):
+    """ Distance in meters to the nearest coastline segment for points less than 5 km from a coastline point,
+    otherwise the distance to the nearest coastline point. All candidate segments of a chunk are handled at once.
+
+    A segment distance of 0 is treated as missing, like the falsy checks of the point by point version in the tests.
+    """
     radius = 6371000
-    positions = np.array(positions)
+    positions = np.array(positions, dtype=float)
     _, indexes = tree.query(_np_to_cartesian(positions), k=5, eps=0.00001, p=2)
-    mindistances = np.zeros(len(positions))
-    for i, p in enumerate(positions):
-        distances = _np_gc_distance(p, coastpoints[indexes[i,]])
-        mindistance = distances[0]
-        if mindistance < (5000.0 / radius):  # less than 5 km
-            maxresultindex = np.searchsorted(distances, distances[0] + (250.0 / radius), side="left")
-            for resultsindex in range(maxresultindex):
-                point_index = indexes[i,resultsindex]
-                coastline_index = np.searchsorted(coastlines, point_index, side="right")
-                minpointindex_coastline = coastlines[coastline_index-1]
-                maxpointindex_coastline = coastlines[coastline_index] - 1
-                d1, d2 = None, None # d1 line to the left, d2 line to the right
-                if point_index > minpointindex_coastline:
-                    d1 = _gc_distancetoline(p, coastpoints[point_index - 1], coastpoints[point_index])
-                if point_index < maxpointindex_coastline:
-                    d2 = _gc_distancetoline(p, coastpoints[point_index], coastpoints[point_index + 1])
-                if (not d1 or not d2) and np.array_equal(coastpoints[minpointindex_coastline], coastpoints[maxpointindex_coastline]): # polygon coastline
-                    if not d1:
-                        d1 = _gc_distancetoline(p, coastpoints[maxpointindex_coastline], coastpoints[maxpointindex_coastline-1]) # laatste segment
-                    if not d2:
-                        d2 = _gc_distancetoline(p, coastpoints[minpointindex_coastline], coastpoints[minpointindex_coastline+1]) # eerste segment
-                if d1 and d1 < mindistance:
-                    mindistance = d1
-                if d2 and d2 < mindistance:
-                    mindistance = d2
-        mindistances[i] = mindistance
+    distances = _np_gc_distances(positions, coastpoints[indexes])
+    mindistances = distances[:, 0].copy()
+    near = mindistances < (5000.0 / radius)  # less than 5 km
+    # equivalent of the searchsorted on the (sorted) neighbour distances
+    candidates = np.logical_and.accumulate(distances < (distances[:, :1] + (250.0 / radius)), axis=1)
+    rows, cols = np.nonzero(candidates & near[:, np.newaxis])
+    if len(rows) == 0:
+        return mindistances * radius
+    p = positions[rows]
+    point_index = indexes[rows, cols]
+    coastline_index = np.searchsorted(coastlines, point_index, side="right")
+    minpointindex_coastline = coastlines[coastline_index - 1]
+    maxpointindex_coastline = coastlines[coastline_index] - 1
 
+    d1, d2 = np.zeros(len(rows)), np.zeros(len(rows))  # d1 line to the left, d2 line to the right, 0 is missing
+    left = point_index > minpointindex_coastline
+    d1[left] = _np_gc_distancetoline(p[left], coastpoints[point_index[left] - 1], coastpoints[point_index[left]])
+    right = point_index < maxpointindex_coastline
+    d2[right] = _np_gc_distancetoline(p[right], coastpoints[point_index[right]], coastpoints[point_index[right] + 1])
+
+    polygon = np.all(coastpoints[minpointindex_coastline] == coastpoints[maxpointindex_coastline], axis=1)
+    left = polygon & (d1 == 0)
+    last = maxpointindex_coastline[left]
+    d1[left] = _np_gc_distancetoline(p[left], coastpoints[last], coastpoints[last - 1])  # laatste segment
+    right = polygon & (d2 == 0)
+    first = minpointindex_coastline[right]
+    d2[right] = _np_gc_distancetoline(p[right], coastpoints[first], coastpoints[first + 1])  # eerste segment
+
+    d1[~(d1 > 0)] = np.inf
+    d2[~(d2 > 0)] = np.inf
+    np.minimum.at(mindistances, rows, np.minimum(d1, d2))
     return mindistances * radius
 
 
-def _on_land(cur, pointstable, npoints):
-    cur.execute("""
+def onland_sql(pointstable):
+    """ Query for the ids of the points that are not in the water polygons """
+    return """
     SELECT pts.id
       FROM {0} pts
  LEFT JOIN water_polygons0_00005 all_water ON ST_DWithin(all_water.geom, pts.geom, 0)
      WHERE all_water.geom IS NULL
-    """.format(pointstable))
-    ids_onland = cur.fetchall()
-    ids_onland = [id[0] for id in ids_onland]  # tuple to element
+    """.format(pointstable)
+
+
+def onland_from_rows(rows, npoints):
+    ids_onland = [id[0] for id in rows]  # tuple to element
     onland = np.ones(npoints)
     onland[ids_onland] = -1
     return onland
 
 
-def get_shoredistance(cur, points, pointstable):
+def _on_land(cur, pointstable, npoints):
+    cur.execute(onland_sql(pointstable))
+    return onland_from_rows(cur.fetchall(), npoints)
+
+
+def get_coastlinedistances(points):
+    """ Unsigned distance to the coastline in meters, does not need the database """
+    coastpoints, coastlines, tree = _coastlines.get()
     distances = np.zeros(len(points))
-    chunksize = 1000
+    chunksize = 10000
     chunks = [points[i:i + chunksize] for i in range(0, len(points), chunksize)]
     for i, chunk in enumerate(chunks):
-        distances[i*chunksize:((i+1)*chunksize)] = _getcoastlinedistance(chunk, _tree, _coastpoints, _coastlines)
-    onland = _on_land(cur, pointstable, len(points))
-    return np.round(distances * onland)
+        distances[i*chunksize:((i+1)*chunksize)] = _getcoastlinedistance(chunk, tree, coastpoints, coastlines)
+    return distances
+
+
+def get_onland(cur, points, pointstable):
+    """ -1 for points on land and 1 for points in water, cur and pointstable are not used with the landmask """
+    if config.onland == 'landmask':
+        import service.landmask as landmask
+        return landmask.on_land(points)
+    return _on_land(cur, pointstable, len(points))
+
+
+def get_shoredistance(cur, points, pointstable):
+    return np.round(get_coastlinedistances(points) * get_onland(cur, points, pointstable))
 
 
-_init()  # Initialize the _tree, _coatlines and _coast_points data structures (slow but necessary)
+_coastlines = startup.Subsystem('coastlines', _init, _warm)
 
 
 if __name__ == "__main__":
-    def _get_test_points():
-        import psycopg2
-        conn = psycopg2.connect("dbname=xylookup user=postgres port=5432 password=postgres")
-        cur = conn.cursor()
-        cur.execute("SELECT x, y FROM test_points_100000")
-        points = cur.fetchall()
-        return [tuple(point) for point in points]
-    tp = _get_test_points()
-    print("Ready for landdistance :-)")
+    # python -m service.shoredistance times the point by point loop (kept in the tests as the reference) against the
+    # batched version, set XYLOOKUP_DATADIR to use e.g. the coastlines of a benchmarks/synthetic.py datadir
+    import time
+    from tests.test_shoredistance import _getcoastlinedistance_loop
 
-    #http: // localhost:8000 / lookup?x = 2.922825, 2.918780, 0 & y = 51.236716, 51.237912, 0 & shoredistance = 1 & grids = 0 & areas = 0
-    tp = [[2.922825,51.236716], [2.918780,51.237912]]
-    def landdistance():
-        positions = tp
-        chunksize = 1000
-        chunks = [positions[i:i + chunksize] for i in range(0, len(positions), chunksize)]
-        for i, chunk in enumerate(chunks):
-            try:
-                _getcoastlinedistance(chunk, _tree, _coastpoints, _coastlines)
-            except:
-                print("error " + str(i))
+    def _get_test_points(coastpoints):
+        try:
+            import psycopg2
+            with psycopg2.connect(config.connstring) as conn, conn.cursor() as cur:
+                cur.execute("SELECT x, y FROM test_points_100000")
+                return np.array(cur.fetchall(), dtype=float)
+        except Exception as ex:
+            print("test_points_100000 not available, using points near the coastline: {}".format(ex))
+            rng = np.random.RandomState(1)
+            return coastpoints[rng.randint(0, len(coastpoints), 100000)] + rng.normal(0, 0.02, (100000, 2))
 
-    import cProfile
-    cProfile.runctx('landdistance()', globals(), locals())
-    # print_timing(landdistance)()
+    coastpoints, coastlines, tree = _coastlines.get()
+    tp = _get_test_points(coastpoints)
+    print("Ready for landdistance :-)")
 
-    # _test_getlanddistance3('50')
+    def landdistance(f, chunksize=10000):
+        start = time.time()
+        distances = np.concatenate([f(tp[i:i + chunksize], tree, coastpoints, coastlines)
+                                    for i in range(0, len(tp), chunksize)])
+        return distances, time.time() - start
 
+    expected, looptime = landdistance(_getcoastlinedistance_loop)
+    distances, batchtime = landdistance(_getcoastlinedistance)
+    print("{} points: loop {:.3f}s, batched {:.3f}s, {:.1f}x faster".format(len(tp), looptime, batchtime,
+                                                                           looptime / batchtime))
+    print("max difference: {:.6f} m".format(np.nanmax(np.abs(distances - expected))))
@@ -0,0 +1,139 @@
+""" Loading of the subsystems of the service: coastlines and KD-tree, rasters, landmask and the in memory area index.
+
+Nothing is loaded when the modules are imported. With config.init_mode 'lazy' a subsystem is loaded on first use,
+'background' loads the subsystems needed for the configuration in a thread when the app is created and 'eager' loads
+them before the app is created (use this with gunicorn preload_app so the workers share the loaded data). With
+config.warmup the pages of the memory mapped files are read once after loading so the first requests don't wait for
+the disk. /lookup/health and /lookup/ready report the state and timings of every subsystem.
+"""
+import importlib
+import mmap
+import os
+import threading
+import time
+import traceback
+from collections import OrderedDict
+import numpy as np
+import service.config as config
+
+PENDING, LOADING, READY, FAILED = 'pending', 'loading', 'ready', 'failed'
+
+_subsystems = OrderedDict()
+_modules = OrderedDict([('coastlines', 'service.shoredistance'), ('rasters', 'service.rasters'),
+                        ('landmask', 'service.landmask'), ('areaindex', 'service.areaindex')])
+_background = None  # thread of the background loading
+
+
+class Subsystem(object):
+    """ Data that is loaded once per process by load(), warm(value) returns the arrays to read for the warm-up """
+    def __init__(self, name, load, warm=None):
+        self.name = name
+        self._load = load
+        self._warm = warm
+        self.value = None
+        self.state = PENDING
+        self.error = None
+        self.load_seconds, self.warm_seconds, self.warm_bytes = None, None, None
+        self._lock = threading.Lock()
+        _subsystems[name] = self
+
+    def get(self):
+        if self.state != READY:
+            self.load()
+        return self.value
+
+    def load(self):
+        with self._lock:
+            if self.state == READY:
+                return
+            self.state, start = LOADING, time.time()
+            try:
+                self.value = self._load()
+            except Exception as ex:
+                self.state, self.error = FAILED, str(ex)
+                raise
+            self.state, self.error, self.load_seconds = READY, None, time.time() - start
+
+    def warm(self):
+        value = self.get()
+        start = time.time()
+        self.warm_bytes = sum(touch(array) for array in self._warm(value)) if self._warm else 0
+        self.warm_seconds = time.time() - start
+
+    def status(self):
+        return {'state': self.state, 'error': self.error, 'load_seconds': self.load_seconds,
+                'warm_seconds': self.warm_seconds, 'warm_bytes': self.warm_bytes}
+
+
+def touch(array):
+    """ Reads one value per memory page of the array so a memory mapped file is in the page cache, returns the size """
+    flat = np.asarray(array).reshape(-1)
+    if len(flat) > 0:
+        flat[::max(1, mmap.PAGESIZE // flat.itemsize)].sum()
+    return flat.nbytes
+
+
+def required():
+    """ Names of the subsystems used with the current configuration """
+    names = ['coastlines', 'rasters']
+    if config.onland == 'landmask':
+        names.append('landmask')
+    if 'memory' in (config.areas_engine, config.areas_distance_engine):
+        names.append('areaindex')
+    return names
+
+
+def database_required():
+    return 'postgis' in (config.onland, config.areas_engine, config.areas_distance_engine)
+
+
+def get(name):
+    importlib.import_module(_modules[name])  # the module creates the subsystem
+    return _subsystems[name]
+
+
+def load_all(warm=False):
+    for name in required():
+        subsystem = get(name)
+        try:
+            subsystem.load()
+            if warm and subsystem.warm_seconds is None:
+                subsystem.warm()
+        except Exception:
+            traceback.print_exc()
+
+
+def start(mode=None, warm=None):
+    """ Starts loading the subsystems according to config.init_mode and config.warmup """
+    global _background
+    mode = mode or config.init_mode
+    warm = config.warmup if warm is None else warm
+    if mode == 'eager':
+        load_all(warm)
+    elif mode == 'background':
+        _background = threading.Thread(target=load_all, args=(warm,), name='xylookup-startup')
+        _background.daemon = True
+        _background.start()
+
+
+def status():
+    return OrderedDict((name, get(name).status()) for name in required())
+
+
+def ready():
+    """ True when all required subsystems are loaded (and warmed up when config.warmup is set) """
+    return all(s['state'] == READY and (s['warm_seconds'] is not None or not config.warmup) for s in status().values())
+
+
+def _after_fork():
+    """ Locks and a loading thread don't survive a fork, the child starts over for the unfinished subsystems """
+    for subsystem in _subsystems.values():
+        subsystem._lock = threading.Lock()
+        if subsystem.state == LOADING:
+            subsystem.state = PENDING
+    if _background is not None:
+        start('background')  # subsystems that are ready are skipped
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,120 @@
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+import service.config as config
+
+
+_local = threading.local()
+
+
+class Counter(object):
+    """ Tile cache hits and misses of one request """
+    def __init__(self):
+        self.hits, self.misses = 0, 0
+
+
+@contextmanager
+def counting(counter):
+    """ The tile cache hits and misses of the current thread are also added to counter """
+    previous = getattr(_local, 'counter', None)
+    _local.counter = counter
+    try:
+        yield
+    finally:
+        _local.counter = previous
+
+
+class TileCache(object):
+    """ Bounded LRU cache of decoded tiles, shared by all tiled rasters of the process """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        counter = getattr(_local, 'counter', None)
+        with self._lock:
+            tile = self._tiles.pop(key, None)
+            if tile is not None:
+                self._tiles[key] = tile  # most recently used
+                self.hits += 1
+                if counter is not None:
+                    counter.hits += 1
+                return tile
+            self.misses += 1
+            if counter is not None:
+                counter.misses += 1
+        tile = load()  # decompress outside of the lock
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = tile
+                self.nbytes += tile.nbytes
+                while self.nbytes > self.maxbytes and len(self._tiles) > 1:
+                    _, old = self._tiles.popitem(last=False)
+                    self.nbytes -= old.nbytes
+        return tile
+
+
+class TiledArray(object):
+    """ Read only 2D array stored as zlib compressed tiles, indexing with row and column arrays works like np.memmap """
+    def __init__(self, path, dtype, shape, tilesize, cache):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.shape = shape
+        self.tilesize = tilesize
+        self.ntilecols = -(-shape[1] // tilesize)
+        self.cache = cache
+        self.data = np.memmap(path + '.tiles', dtype=np.uint8, mode='r')
+        self.offsets = np.load(path + '.tileindex.npy', mmap_mode='r')
+
+    def _load(self, tile):
+        compressed = self.data[self.offsets[tile]:self.offsets[tile + 1]]
+        decoded = np.frombuffer(zlib.decompress(compressed.tobytes()), dtype=self.dtype)
+        return decoded.reshape(self.tilesize, self.tilesize)
+
+    def __getitem__(self, index):
+        rows, cols = np.asarray(index[0]), np.asarray(index[1])
+        tiles = (rows // self.tilesize) * self.ntilecols + cols // self.tilesize
+        values = np.empty(rows.shape, dtype=self.dtype)
+        unique, inverse = np.unique(tiles, return_inverse=True)
+        order = np.argsort(inverse, kind='mergesort')
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+        for i, tile in enumerate(unique.tolist()):
+            idx = order[bounds[i]:bounds[i + 1]]
+            data = self.cache.get((self.path, tile), lambda: self._load(tile))
+            values[idx] = data[rows[idx] % self.tilesize, cols[idx] % self.tilesize]
+        return values
+
+
+class TileWriter(object):
+    """ Writes a 2D array as compressed tiles for TiledArray. Rows are added top to bottom in blocks of tilesize rows
+    (the last block can be smaller), edge tiles are padded with fill. """
+    def __init__(self, path, shape, dtype, tilesize, fill=0, level=6):
+        self.path = path
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.tilesize = tilesize
+        self.fill = fill
+        self.level = level
+        self.offsets = [0]
+        self._file = open(path + '.tiles', 'wb')
+
+    def write_rows(self, block):
+        ts = self.tilesize
+        padded = np.full((ts, -(-self.shape[1] // ts) * ts), self.fill, dtype=self.dtype)
+        padded[:block.shape[0], :block.shape[1]] = block
+        for c0 in range(0, padded.shape[1], ts):
+            compressed = zlib.compress(np.ascontiguousarray(padded[:, c0:c0 + ts]).tobytes(), self.level)
+            self._file.write(compressed)
+            self.offsets.append(self.offsets[-1] + len(compressed))
+
+    def close(self):
+        self._file.close()
+        np.save(self.path + '.tileindex.npy', np.array(self.offsets, dtype=np.int64))
+
+
+cache = TileCache(config.raster_cache_bytes)
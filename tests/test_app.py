@@ -3,6 +3,8 @@ import falcon
 import pytest
 import msgpack
 import json
+import io
+import numpy as np
 import csv
 import service.app as app
 import service.config as config
@@ -64,6 +66,70 @@ def test_xy_not_numeric(client, x, y):
     assert "not numeric" in result.json["description"]
 
 
+def test_stream_ndjson(client):
+    print('test_stream_ndjson')
+    query = 'x=1,2,3&y=4,5,6&areas=0&grids=0&shoredistance=0'
+    result = client.simulate_get('/lookup', query_string=query + '&stream=1')
+    assert result.status_code == 200
+    assert result.headers['content-type'] == app.MEDIA_NDJSON
+    assert [json.loads(line) for line in result.text.splitlines()] == [{}, {}, {}]
+    result = client.simulate_get('/lookup', query_string=query, headers={'Accept': app.MEDIA_NDJSON})
+    assert result.text.count('\n') == 3
+
+
+def test_stream_msgpack_frames(client):
+    print('test_stream_msgpack_frames')
+    config.stream_chunksize, chunksize = 2, config.stream_chunksize
+    try:
+        packed = msgpack.dumps({'points': [[1, 2], [3, 4], [5, 6]], 'stream': True, 'areas': False, 'grids': False,
+                                'shoredistance': False}, use_bin_type=True)
+        result = client.simulate_post('/lookup', body=packed, headers={'Content-Type': falcon.MEDIA_MSGPACK})
+    finally:
+        config.stream_chunksize = chunksize
+    assert result.status_code == 200
+    assert list(msgpack.Unpacker(io.BytesIO(result.content), raw=False)) == [[{}, {}], [{}]]
+
+
+def test_columns_format(client):
+    print('test_columns_format')
+    query = 'x=1,2,3&y=4,5,6&areas=0&grids=0&shoredistance=0'
+    result = client.simulate_get('/lookup', query_string=query + '&format=columns')
+    assert result.status_code == 200
+    assert result.json == {'npoints': 3}
+    result = client.simulate_get('/lookup', query_string=query + '&format=rows')
+    assert result.status_code == 400
+    assert 'Format' in result.json['description']
+
+
+def test_post_binary_points(client):
+    print('test_post_binary_points')
+    points = np.array([[1, 2], [3, 4], [5, 6]], dtype='<f8')
+    query = 'areas=0&grids=0&shoredistance=0'
+    result = client.simulate_post('/lookup', body=points.tobytes(), query_string=query,
+                                  headers={'Content-Type': 'application/octet-stream'})
+    assert result.status_code == 200
+    assert result.json == [{}, {}, {}]
+    packed = msgpack.dumps({'points': {'dtype': '<f4', 'data': points.astype('<f4').tobytes()}, 'areas': False,
+                            'grids': False, 'shoredistance': False}, use_bin_type=True)
+    result = client.simulate_post('/lookup', body=packed, headers={'Content-Type': falcon.MEDIA_MSGPACK})
+    assert result.status_code == 200
+    result = client.simulate_post('/lookup', body=points.tobytes()[:-8], query_string=query,
+                                  headers={'Content-Type': 'application/octet-stream'})
+    assert result.status_code == 400
+    assert 'x, y pairs' in result.json['description']
+
+
+def test_post_binary_invalid_points(client):
+    print('test_post_binary_invalid_points')
+    points = np.zeros((100, 2))
+    points[[3, 42], 1] = [91, np.nan]
+    packed = msgpack.dumps({'points': points.tobytes()}, use_bin_type=True)
+    result = client.simulate_post('/lookup', body=packed, headers={'Content-Type': falcon.MEDIA_MSGPACK})
+    assert result.status_code == 400
+    assert "xmin" in result.json["description"]
+    assert "for 2 points, at index 3, 42" in result.json["description"]
+
+
 def test_post_json_invalid(client):
     print('test_post_json_invalid')
     result = client.simulate_post('/lookup', body='')
@@ -88,6 +154,14 @@ def test_post_json_empty(client):
     assert "No points provided" in result.json["description"]
 
 
+def test_post_json_no_points(client):
+    print('test_post_json_no_points')
+    for body in ('{"grids": true}', '{"points": null}'):
+        result = client.simulate_post('/lookup', body=body)
+        assert result.status_code == 400
+        assert "No points provided" in result.json["description"]
+
+
 def test_post_json_xy_outside_world(client):
     print('test_post_json_xy_outside_world')
     result = client.simulate_post('/lookup', body="""{"points":
@@ -267,4 +341,9 @@ def test_raster_edges(client):
     #     grids = actual['grids']
     #     assert_value(grids, 'temperature (sea surface)', expected[0], 0.001)
     #     assert_value(grids, 'salinity (sea surface)', expected[1], 0.001)
-    #     assert_value(grids, 'bathymetry', expected[2], 0.1)
\ No newline at end of file
+    #     assert_value(grids, 'bathymetry', expected[2], 0.1)
+
+
+def test_areas_sql_format(client):
+    print('test_areas_sql_format')
+    assert client.simulate_get('/lookup/areas', query_string='format=csv').status_code == 400
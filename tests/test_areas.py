@@ -0,0 +1,151 @@
+import os
+import csv
+import json
+import numpy as np
+import pytest
+import service.config as config
+import service.areas as areas
+import service.geometry as geometry
+# Terminal run: python -m pytest
+
+
+def _test_points():
+    with open("./tests/r_testlookup.csv") as csvfile:
+        return np.array([row[0:2] for i, row in enumerate(csv.reader(csvfile, delimiter=",")) if i > 0], dtype=float)
+
+
+def _sorted_areas(results):
+    return [dict((alias, sorted(values, key=lambda d: sorted(d.items()))) for alias, values in r.items()) for r in results]
+
+
+@pytest.mark.skipif(not all(os.path.exists(os.path.join(config.areasdir, table, 'index.json')) for table in config.areas),
+                    reason='areas not exported, see dataprep/areas.py')
+def test_areaindex_matches_postgis():
+    print('test_areaindex_matches_postgis')
+    import service.areaindex as areaindex
+    import service.lookup as lookup
+    import service.db as db
+    points = _test_points()
+    with db.pool.connection() as conn, conn.cursor() as cur:
+        pointstable = lookup.load_points(cur, points)
+        expected = areas.get_areas(cur, points, pointstable, 0)
+    assert _sorted_areas(areaindex.get_areas(points)) == _sorted_areas(expected)
+
+
+def test_combined_sql(monkeypatch):
+    print('test_combined_sql')
+    monkeypatch.setattr(config, 'areas', {'grid_a': ('a', ['id', 'name']), 'grid_b': ('b', ['id'])})
+    sql = areas.combined_sql('pts_table', 0, True, 'SELECT pts.id FROM pts_table pts')
+    assert sql.count('UNION ALL') == 2
+    assert 'json_build_array(id, name)' in sql and 'ST_Intersects' in sql
+    assert 'SELECT -1, id, NULL::json' in sql
+    assert 'ST_DWithin(pts.geom::geography, grid.geog, 1000)' in areas.combined_sql('pts_table', 1000)
+    assert 'UNION ALL' not in areas.combined_sql('pts_table', 0, False, 'SELECT pts.id FROM pts_table pts')
+
+
+def test_group_rows(monkeypatch):
+    print('test_group_rows')
+    monkeypatch.setattr(config, 'areas', {'grid_a': ('a', ['id', 'name']), 'grid_b': ('b', ['id'])})
+    rows = [(0, 2, [1, 'x']), (1, 0, [7]), (-1, 1, None), (0, 0, '[2, "y"]'), (0, 2, [3, 'z']), (-1, 2, None)]
+    results, onland = areas.group_rows(rows, 4)
+    assert onland is None
+    assert results == [{'a': [{'id': 2, 'name': 'y'}], 'b': [{'id': 7}]}, {},
+                       {'a': [{'id': 1, 'name': 'x'}, {'id': 3, 'name': 'z'}]}, {}]
+    results, onland = areas.group_rows(rows, 4, pareas=False, ponland=True)
+    assert results is None and onland.tolist() == [1, -1, -1, 1]
+    results, onland = areas.group_rows([], 2, ponland=True)
+    assert results == [{}, {}] and onland.tolist() == [1, 1]
+
+
+def _write_index(areadir, squares):
+    """ Area index with 1 degree cells for squares given as (x, y, size, attributes) """
+    edges, cells = [], []
+    for polygon, (x, y, size, _) in enumerate(squares):
+        edges.append(geometry.ring_edges([[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]))
+        for row in range(int(np.floor(90 - y - size)) - 1, int(np.floor(90 - y)) + 1):
+            for col in range(int(np.floor(x + 180)) - 1, int(np.floor(x + size + 180)) + 1):
+                if 0 <= row < 180 and 0 <= col < 360:
+                    cells.append((row * 360 + col, polygon))
+    cells = np.array(sorted(cells))
+    os.makedirs(areadir)
+    np.save(os.path.join(areadir, 'edges.npy'), np.concatenate(edges))
+    np.save(os.path.join(areadir, 'offsets.npy'), np.concatenate([[0], np.cumsum([len(e) for e in edges])]))
+    np.save(os.path.join(areadir, 'cells.npy'), cells[:, 0])
+    np.save(os.path.join(areadir, 'polygons.npy'), cells[:, 1])
+    np.save(os.path.join(areadir, 'covers.npy'), np.zeros(len(cells), dtype=bool))
+    with open(os.path.join(areadir, 'index.json'), 'w') as f:
+        json.dump({'minx': -180, 'maxy': 90, 'resolution': 1, 'nrow': 180, 'ncol': 360}, f)
+    with open(os.path.join(areadir, 'attributes.json'), 'w') as f:
+        json.dump([attributes for _, _, _, attributes in squares], f)
+
+
+def test_areaindex_within_distance(tmpdir):
+    print('test_areaindex_within_distance')
+    import service.areaindex as areaindex
+    areadir = str(tmpdir.join('grid_a'))
+    _write_index(areadir, [(10, 0, 1, [1, 'a']), (179, 0, 1, [2, 'b']), (10.5, 0.5, 2, [1, 'a'])])
+    index = areaindex.AreaIndex(areadir, 'a', ['id', 'name'])
+    x, y = np.array([10.2, 13, -179.99, 50]), np.array([0.2, 0.5, 0.5, 50])
+    pointidx, keys = index.get_matches_within(x, y, 60000)  # 13, 0.5 is 0.5 degrees (55.6 km) from the third square
+    assert list(zip(pointidx, keys)) == [(0, 0), (1, 0), (2, 1)]
+    pointidx, keys = index.get_matches_within(x, y, 50000)
+    assert list(zip(pointidx, keys)) == [(0, 0), (2, 1)]
+    pointidx, keys = index.get_matches_within(x, y, 500)  # -179.99, 0.5 is 1.1 km from 180, 0.5
+    assert list(zip(pointidx, keys)) == [(0, 0)]
+    assert index.get_matches_within(x[3:], y[3:], 100)[0].size == 0
+
+
+class FakeCursor(object):
+    """ Named cursor returning the rows of one areas table """
+    def __init__(self, tables, fetches):
+        self.tables, self.fetches = tables, fetches
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        self.rows = list(self.tables[sql.split(' FROM ')[1].split()[0]])
+
+    def fetchmany(self, size):
+        self.fetches.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class FakeConnection(object):
+    def __init__(self, tables, fetches):
+        self.tables, self.fetches, self.closed = tables, fetches, 0
+
+    def cursor(self, name=None):
+        assert name  # server side cursor
+        return FakeCursor(self.tables, self.fetches)
+
+    def rollback(self):
+        pass
+
+
+def test_table_sql(monkeypatch):
+    print('test_table_sql')
+    import psycopg2
+    import service.db as db
+    tables = {'grid_a': [(1, "it's"), (2, 'b'), (3, None)], 'grid_b': [(7, 'tab\there')]}
+    fetches = []
+    monkeypatch.setattr(config, 'areas', {'grid_a': ('a', ['id', 'name']), 'grid_b': ('b', ['id', 'name'])})
+    monkeypatch.setattr(psycopg2, 'connect', lambda connstring: FakeConnection(tables, fetches))
+    monkeypatch.setattr(db, 'pool', db.ConnectionPool(''))
+    chunks = areas.table_sql(batchsize=2)
+    assert next(chunks) == b'DELETE FROM obis.areas;\n' and not fetches  # first chunk before the query
+    sql = b''.join(chunks).decode('utf-8')
+    assert fetches == [2] * 5  # two batches and the empty fetch for grid_a, one and the empty fetch for grid_b
+    assert sql.splitlines() == ['-- Data from grid_a',
+                                "INSERT INTO obis.areas (id, name, type) VALUES (1, 'it''s', 'a');",
+                                "INSERT INTO obis.areas (id, name, type) VALUES (2, 'b', 'a');",
+                                "INSERT INTO obis.areas (id, name, type) VALUES (3, NULL, 'a');",
+                                '-- Data from grid_b',
+                                "INSERT INTO obis.areas (id, name, type) VALUES (7, 'tab\there', 'b');"]
+    copy = b''.join(areas.table_sql('copy')).decode('utf-8')
+    assert copy == ('DELETE FROM obis.areas;\nCOPY obis.areas (id, name, type) FROM stdin;\n'
+                    "1\tit's\ta\n2\tb\ta\n3\t\\N\ta\n7\ttab\\there\tb\n\\.\n")
@@ -0,0 +1,54 @@
+import io
+import pytest
+import msgpack
+pytest.importorskip('falcon.asgi')
+pytest.importorskip('asyncpg')
+from falcon import testing
+import service.asgi as asgi
+# Terminal run: python -m pytest
+
+
+@pytest.fixture()
+def client():
+    return testing.TestClient(asgi.create())
+
+
+def test_connect_kwargs():
+    print('test_connect_kwargs')
+    kwargs = asgi.connect_kwargs("dbname=xylookup user=postgres port=5432 password=postgres")
+    assert kwargs == {'database': 'xylookup', 'user': 'postgres', 'port': 5432, 'password': 'postgres'}
+
+
+def test_asgi_lookup_without_database(client):
+    print('test_asgi_lookup_without_database')
+    query = 'x=1,2,1&y=4,5,4&areas=0&grids=0&shoredistance=0'
+    result = client.simulate_get('/lookup', query_string=query)
+    assert result.status_code == 200
+    assert result.json == [{}, {}, {}]
+    assert result.headers['x-unique-points'] == '2'
+    assert 'dedup;dur=' in result.headers['server-timing']
+    assert 'xylookup_requests_total{endpoint="lookup",status="200"' in client.simulate_get('/lookup/metrics').text
+    result = client.simulate_get('/lookup', query_string=query + '&format=columns&stream=1')
+    assert result.text.splitlines() == ['{"npoints": 3}']
+
+
+def test_asgi_errors(client):
+    print('test_asgi_errors')
+    result = client.simulate_get('/lookup', query_string='x=1&y=91')
+    assert result.status_code == 400
+    assert "xmin" in result.json["description"]
+    packed = msgpack.dumps({'points': [[1, 2]], 'stream': True, 'areas': False, 'grids': False, 'shoredistance': False},
+                           use_bin_type=True)
+    result = client.simulate_post('/lookup', body=packed, headers={'Content-Type': 'application/msgpack'})
+    assert list(msgpack.Unpacker(io.BytesIO(result.content), raw=False)) == [[{}]]
+
+
+def test_asgi_result_cache(client, monkeypatch):
+    print('test_asgi_result_cache')
+    import service.resultcache as resultcache
+    monkeypatch.setattr(resultcache, 'cache', resultcache.ResultCache(6, 1024 * 1024))
+    query = 'x=1,2,1&y=4,5,4&areas=0&grids=0&shoredistance=0'
+    assert client.simulate_get('/lookup', query_string=query).headers['x-cache-misses'] == '2'
+    result = client.simulate_get('/lookup', query_string=query)
+    assert result.json == [{}, {}, {}]
+    assert result.headers['x-cache-hits'] == '2' and result.headers['x-cache-misses'] == '0'
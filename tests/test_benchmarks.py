@@ -0,0 +1,64 @@
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+import benchmarks.run as run
+import benchmarks.synthetic as synthetic
+import service.geometry as geometry
+from service.landmask import LandMask
+from service.rasters import Raster
+# Terminal run: python -m pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_synthetic_datadir(tmpdir):
+    print('test_synthetic_datadir')
+    datadir = str(tmpdir)
+    synthetic.create_datadir(datadir, scale=0.05, nislands=50)
+    rings = synthetic.load_islands(datadir)
+    assert len(rings) == 50
+    with open(os.path.join(datadir, 'rasters', 'rasters.metadata')) as f:
+        rasters = [Raster(os.path.join(datadir, 'rasters'), m) for m in json.load(f)]
+    assert set(r.category for r in rasters) == {'bathymetry', 'sstemperature', 'sssalinity'}
+    mask = LandMask(os.path.join(datadir, 'landmask'))
+    means = np.array([ring[:-1].mean(axis=0) for ring in rings])
+    edges = [geometry.ring_edges(ring) for ring in rings]
+    stop = np.cumsum([len(e) for e in edges])
+    inside = geometry.points_in_polygons(means[:, 0], means[:, 1], np.concatenate(edges),
+                                         np.concatenate([[0], stop[:-1]]), stop)
+    assert inside.sum() > 25
+    assert (mask.in_water(means[:, 0], means[:, 1]) == ~inside).all()
+    assert mask.in_water(np.array([0.0]), np.array([-89.0])).all()
+    ends = np.asarray(mask.edges[:, :2])  # points exactly on the coastline are water, like ST_DWithin(..., 0)
+    assert mask.in_water(ends[:, 0], ends[:, 1]).all()
+
+
+def test_points():
+    print('test_points')
+    rng = np.random.RandomState(1)
+    rings = synthetic.create_islands(rng, 10)
+    for kind in run.POINTSETS:
+        points = synthetic.create_points(rng, 1000, kind, rings)
+        assert points.shape == (1000, 2)
+        assert (np.abs(points) <= [180, 90]).all()
+    assert len(np.unique(synthetic.create_points(rng, 1000, 'duplicated'), axis=0)) <= 100
+
+
+def test_run_and_compare(tmpdir):
+    print('test_run_and_compare')
+    datadir, output = str(tmpdir.join('data')), str(tmpdir.join('results.json'))
+    synthetic.create_datadir(datadir, scale=0.05, nislands=50)
+    subprocess.check_call([sys.executable, '-m', 'benchmarks.run', '--datadir', datadir, '--sizes', '1,10',
+                           '--repeat', '1', '--only', 'rasters,landmask,app_msgpack', '--output', output], cwd=ROOT)
+    with open(output) as f:
+        results = json.load(f)
+    assert set(results['load']) == {'coastlines', 'rasters', 'landmask'}
+    assert len(results['results']) == 3 * len(run.POINTSETS) * 2
+    rows, regression = run.compare(results, results)
+    assert len(rows) == len(results['results']) and not regression
+    slower = json.loads(json.dumps(results))
+    for r in slower['results']:
+        r['best'] *= 2
+    assert run.compare(results, slower)[1]
@@ -0,0 +1,130 @@
+import json
+import os
+import zipfile
+import numpy as np
+import pytest
+import dataprep.rasters as rasters
+# Terminal run: python -m pytest
+
+
+class FakeBand(object):
+    def __init__(self, xsize, ysize, blocksize):
+        self.XSize, self.YSize = xsize, ysize
+        self.blocksize = blocksize
+
+    def GetBlockSize(self):
+        return self.blocksize
+
+
+@pytest.fixture()
+def outdir(monkeypatch, tmpdir):
+    """ Conversions into tmpdir with create_memmap writing a small memmap and recording the converted rasters """
+    converted = []
+
+    def create_memmap(path, outdir, outname):
+        converted.append(outname)
+        np.memmap(os.path.join(outdir, outname + '.mmf'), dtype='int16', mode='w+', shape=(2, 2)).flush()
+        return {'id': outname, 'dtype': 'int16', 'shape': (2, 2), 'bandinfo': {'scale_factor': 2}}
+    monkeypatch.setattr(rasters, 'outdir', str(tmpdir))
+    monkeypatch.setattr(rasters, 'tilesize', None)
+    monkeypatch.setattr(rasters, 'create_memmap', create_memmap)
+    return str(tmpdir), converted
+
+
+def test_window_rows(monkeypatch):
+    print('test_window_rows')
+    monkeypatch.setattr(rasters, 'window_bytes', 1000)
+    monkeypatch.setattr(rasters, 'tilesize', None)
+    assert rasters.window_rows(FakeBand(10, 1000, (10, 1)), 2) == 50
+    assert rasters.window_rows(FakeBand(10, 1000, (10, 8)), 2) == 48  # whole blocks
+    assert rasters.window_rows(FakeBand(10, 20, (10, 1)), 2) == 20
+    assert rasters.window_rows(FakeBand(1000, 1000, (1000, 1)), 2) == 1  # at least one row
+    monkeypatch.setattr(rasters, 'tilesize', 16)
+    assert rasters.window_rows(FakeBand(10, 20, (10, 1)), 2) == 48  # whole tiles, write_rows needs tilesize rows
+
+
+def test_source_file():
+    print('test_source_file')
+    assert rasters.source_file('NETCDF:"/data/x.nc":elevation') == '/data/x.nc'
+    assert rasters.source_file('/data/x.tif') == '/data/x.tif'
+
+
+def test_write_metadata(tmpdir):
+    print('test_write_metadata')
+    rasters.write_metadata(str(tmpdir), 'a', {'id': 'a'})
+    assert os.listdir(str(tmpdir)) == ['a.json']
+    with open(str(tmpdir.join('a.json'))) as f:
+        assert json.load(f) == {'id': 'a'}
+
+
+def test_run_conversions_incremental(outdir, tmpdir):
+    print('test_run_conversions_incremental')
+    outdir, converted = outdir
+    source = tmpdir.join('a.tif')
+    source.write('a')
+    tasks = [{'path': str(source), 'outname': 'a', 'category': 'bathymetry', 'negate': True}]
+    assert rasters.run_conversions(tasks, nprocesses=1) == ['a']
+    with open(os.path.join(outdir, 'a.json')) as f:
+        metadata = json.load(f)
+    assert metadata['category'] == 'bathymetry' and metadata['bandinfo']['scale_factor'] == -2
+    assert metadata['source'] == rasters.source_signature(str(source))
+    assert rasters.up_to_date(outdir, 'a', metadata['source'])
+    assert rasters.run_conversions(tasks, nprocesses=1) == []
+    assert rasters.run_conversions(tasks, overwrite=True, nprocesses=1) == ['a']
+    source.write('ab')
+    assert rasters.run_conversions(tasks, nprocesses=1) == ['a']
+    assert converted == ['a', 'a', 'a']
+
+
+def test_interrupted_conversion_not_up_to_date(outdir, tmpdir, monkeypatch):
+    print('test_interrupted_conversion_not_up_to_date')
+    outdir, converted = outdir
+    source = tmpdir.join('a.tif')
+    source.write('a')
+    tasks = [{'path': str(source), 'outname': 'a', 'category': 'bathymetry'}]
+    rasters.run_conversions(tasks, nprocesses=1)
+
+    def interrupted(path, outdir, outname):
+        raise KeyboardInterrupt()
+    create_memmap = rasters.create_memmap
+    monkeypatch.setattr(rasters, 'create_memmap', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        rasters.run_conversions(tasks, overwrite=True, nprocesses=1)
+    assert not rasters.up_to_date(outdir, 'a', rasters.source_signature(str(source)))
+    monkeypatch.setattr(rasters, 'create_memmap', create_memmap)
+    assert rasters.run_conversions(tasks, nprocesses=1) == ['a']
+
+
+def test_emodnet_signature(outdir, tmpdir, monkeypatch):
+    print('test_emodnet_signature')
+    outdir, converted = outdir
+    emodnet_dir = tmpdir.mkdir('dataprep').mkdir('EMODNET_Bathy')
+    with zipfile.ZipFile(str(emodnet_dir.join('C4.mnt.zip')), 'w') as zipf:
+        zipf.writestr('C4.mnt', 'depths')
+    monkeypatch.setattr(rasters.config, 'dataprepdir', str(tmpdir.join('dataprep')))
+    monkeypatch.setattr(rasters, 'tmpdir', str(tmpdir.mkdir('extracted')))
+    tasks = rasters.emodnet_tasks()
+    assert [t['outname'] for t in tasks] == ['emodnet_bathy_C4']
+    assert tasks[0]['path'] == 'NETCDF:"{}":DEPTH'.format(os.path.join(rasters.tmpdir, 'C4.mnt'))
+    assert os.path.exists(os.path.join(rasters.tmpdir, 'C4.mnt'))
+    assert rasters.run_conversions(tasks, nprocesses=1) == ['emodnet_bathy_C4']
+    # clearing the extracted files does not make the tile change and up to date tiles are not extracted
+    os.remove(os.path.join(rasters.tmpdir, 'C4.mnt'))
+    assert rasters.run_conversions(rasters.emodnet_tasks(), nprocesses=1) == []
+    assert not os.path.exists(os.path.join(rasters.tmpdir, 'C4.mnt'))
+
+
+def test_create_memmap(tmpdir, monkeypatch):
+    print('test_create_memmap')
+    gdal = pytest.importorskip('osgeo.gdal')
+    data = np.arange(200 * 30, dtype=np.int16).reshape(200, 30)
+    path = str(tmpdir.join('a.tif'))
+    ds = gdal.GetDriverByName('GTiff').Create(path, 30, 200, 1, gdal.GDT_Int16)
+    ds.SetGeoTransform((0, 1, 0, 200, 0, -1))
+    ds.GetRasterBand(1).WriteArray(data)
+    del ds
+    monkeypatch.setattr(rasters, 'window_bytes', 30 * 2 * 7)  # several windows
+    monkeypatch.setattr(rasters, 'tilesize', None)
+    metadata = rasters.create_memmap(path, str(tmpdir), 'a')
+    assert metadata['shape'] == (200, 30) and metadata['dtype'] == 'int16'
+    assert (np.memmap(str(tmpdir.join('a.mmf')), dtype='int16', mode='r', shape=(200, 30)) == data).all()
@@ -0,0 +1,100 @@
+import threading
+import psycopg2
+import pytest
+import service.db as db
+# Terminal run: python -m pytest
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = 0
+
+    def rollback(self):
+        if self.closed:
+            raise psycopg2.InterfaceError('connection already closed')
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture()
+def pool(monkeypatch):
+    monkeypatch.setattr(psycopg2, 'connect', lambda connstring: FakeConnection())
+    return db.ConnectionPool('', maxconn=2, timeout=0.1, check_idle=60)
+
+
+def test_pool_reuses_connections(pool):
+    print('test_pool_reuses_connections')
+    with pool.connection() as conn1:
+        pass
+    with pool.connection() as conn2:
+        assert conn2 is conn1
+
+
+def test_pool_timeout(pool):
+    print('test_pool_timeout')
+    with pool.connection(), pool.connection():
+        with pytest.raises(db.PoolTimeout):
+            pool.getconn()
+
+
+def test_pool_waits_for_connection(pool):
+    print('test_pool_waits_for_connection')
+    pool.timeout = 5
+    conn1, conn2 = pool.getconn(), pool.getconn()
+    threading.Timer(0.05, pool.putconn, [conn1]).start()
+    assert pool.getconn() is conn1
+    pool.putconn(conn2)
+
+
+def test_pool_replaces_broken_connections(pool):
+    print('test_pool_replaces_broken_connections')
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection() as conn1:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+    assert conn1.closed
+    with pool.connection() as conn2:
+        conn2.close()  # e.g. connection lost during the request
+    with pool.connection() as conn3:
+        assert conn3 is not conn1 and conn3 is not conn2
+
+
+def test_pool_connection_state(pool):
+    print('test_pool_connection_state')
+    with pool.connection() as conn1:
+        pool.state(conn1)['pointstable'] = True
+    with pool.connection() as conn2:
+        assert conn2 is conn1 and pool.state(conn2) == {'pointstable': True}
+    with pytest.raises(psycopg2.OperationalError):
+        with pool.connection():
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+    with pool.connection() as conn3:
+        assert pool.state(conn3) == {}  # a new connection, even when it reuses the id of the closed one
+
+
+class RecordingCursor(psycopg2.extensions.cursor):
+    executed = []
+
+    def execute(self, sql, args=None):
+        RecordingCursor.executed.append(sql)
+        return psycopg2.extensions.cursor.execute(self, sql, args)
+
+
+def test_points_table_created_once():
+    print('test_points_table_created_once')
+    import numpy as np
+    import service.lookup as lookup
+    try:
+        db.check()
+    except psycopg2.Error:
+        pytest.skip('database not available')
+    points = np.array([[1.0, 2.0], [3.0, 4.0]])
+    with db.pool.connection() as conn, conn.cursor(cursor_factory=RecordingCursor) as cur:
+        lookup.load_points(cur, points)
+    del RecordingCursor.executed[:]
+    with db.pool.connection() as conn2, conn2.cursor(cursor_factory=RecordingCursor) as cur:
+        assert conn2 is conn
+        lookup.load_points(cur, points)
+        cur.execute("SELECT count(*) FROM {}".format(lookup._pointstable))
+        assert cur.fetchone()[0] == 2  # the rows of the first request were rolled back
+    assert not [sql for sql in RecordingCursor.executed if 'CREATE' in sql or 'TRUNCATE' in sql]
@@ -0,0 +1,28 @@
+import numpy as np
+import service.dedup as dedup
+# Terminal run: python -m pytest
+
+
+def test_unique_points_scatter_back():
+    print('test_unique_points_scatter_back')
+    points = np.array([[1, 2], [1, 2], [0, 0], [3, 4], [-180, -90], [180, 90], [1.0000001, 2]])
+    unique, inverse = dedup.unique_points(points)
+    assert len(unique) == 6
+    assert np.array_equal(unique[inverse], points)
+
+
+def test_unique_points_precision():
+    print('test_unique_points_precision')
+    points = np.array([[1, 2], [1.0000001, 2], [1.001, 2]])
+    unique, inverse = dedup.unique_points(points, precision=4)
+    assert len(unique) == 2
+    assert inverse[0] == inverse[1] != inverse[2]
+
+
+def test_unique_points_morton_order():
+    print('test_unique_points_morton_order')
+    points = np.array([[170, 80], [-170, -80], [-169.9, -80], [169.9, 80]])
+    unique, _ = dedup.unique_points(points)
+    assert np.array_equal(unique, [[-170, -80], [-169.9, -80], [169.9, 80], [170, 80]])
+    codes = dedup.morton_codes(np.array([[-180.0, -90], [0, 0], [180, 90]]))
+    assert codes[0] == 0 and codes[0] < codes[1] < codes[2]
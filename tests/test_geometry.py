@@ -0,0 +1,63 @@
+import struct
+import numpy as np
+import pytest
+import service.geometry as geometry
+# Terminal run: python -m pytest
+
+
+@pytest.fixture()
+def square_with_hole():
+    outer = geometry.ring_edges([[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]])
+    hole = geometry.ring_edges([[0.5, 0.5], [1, 0.5], [1, 1], [0.5, 1], [0.5, 0.5]])
+    return np.vstack([outer, hole])
+
+
+@pytest.mark.parametrize("boundary", [True, False])
+def test_points_in_polygons(square_with_hole, boundary):
+    print('test_points_in_polygons')
+    x = np.array([1.5, 0.7, 3, -1, 0, 2, 1, 1])
+    y = np.array([1.5, 0.7, 1, 0, 1, 1, 0, 2])
+    n, m = len(x), len(square_with_hole)
+    inside = geometry.points_in_polygons(x, y, square_with_hole, np.zeros(n), np.full(n, m), boundary=boundary, maxpairs=m)
+    # the last 4 points are on the left, right, bottom and top edges
+    expected = [True, False, False, False] + ([True, True, True, True] if boundary else [True, False, True, False])
+    assert list(inside) == expected
+
+
+def test_points_in_polygons_per_point_edges(square_with_hole):
+    print('test_points_in_polygons_per_point_edges')
+    x, y = np.array([0.7, 0.7]), np.array([0.7, 0.7])
+    inside = geometry.points_in_polygons(x, y, square_with_hole, [0, 0], [4, 8])
+    assert list(inside) == [True, False]
+
+
+def test_polygon_rings():
+    print('test_polygon_rings')
+    polygon = struct.pack('<BIII', 1, 3, 1, 4) + struct.pack('<8d', 0, 0, 1, 0, 1, 1, 0, 0)
+    point = struct.pack('<BI2d', 1, 1, 5, 5)
+    collection = struct.pack('<BII', 1, 7, 2) + point + polygon
+    rings = geometry.polygon_rings(collection)
+    assert len(rings) == 1
+    assert rings[0].tolist() == [[0, 0], [1, 0], [1, 1], [0, 0]]
+
+
+def test_distance_boxes():
+    print('test_distance_boxes')
+    idx, minx, miny, maxx, maxy = geometry.distance_boxes([0, 179.9, -179.9, 10], [0, 10, -10, 89.9], 111320)
+    assert idx.tolist() == [0, 1, 1, 2, 2, 3]
+    assert 1 < maxx[0] < 1.02 and minx[0] == -maxx[0] and 1 < maxy[0] < 1.02 and miny[0] == -maxy[0]
+    # split at the antimeridian
+    assert minx[1] < 179 and maxx[1] == 180 and minx[2] == -180 and -179.1 < maxx[2] < -179
+    assert minx[3] == -180 and -179 < maxx[3] < -178.8 and maxx[4] == 180
+    # all longitudes around the pole
+    assert (minx[5], maxx[5], maxy[5]) == (-180, 180, 90)
+
+
+def test_gc_distances_to_edges():
+    print('test_gc_distances_to_edges')
+    edges = np.array([[0, 0, 0, 10], [0, 0, 0, 10], [0, 0, 0, 10], [10, 50, 20, 50], [5, 5, 5, 5]])
+    x, y = np.array([1, 0, 180, 15, 5]), np.array([5, 11, 0, 50, 6])
+    distances = np.degrees(geometry.gc_distances_to_edges(x, y, edges))
+    assert np.allclose(distances, [0.996, 1, 170, 0.1075, 1], atol=0.001)
+    assert np.isclose(geometry.gc_bulge(edges[3:4]), 0.1075, atol=0.001)  # the arc along 50N bulges north
+    assert geometry.gc_bulge(edges[:1]) == 0
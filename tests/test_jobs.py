@@ -0,0 +1,55 @@
+import io
+import os
+from multiprocessing.dummy import Pool
+import msgpack
+import pytest
+from falcon import testing
+import service.app as app
+import service.config as config
+import service.jobs as jobs
+# Terminal run: python -m pytest
+
+
+@pytest.fixture()
+def client(tmpdir, monkeypatch):
+    monkeypatch.setattr(config, 'jobs_dir', str(tmpdir))
+    monkeypatch.setattr(config, 'jobs_chunksize', 2)
+    return testing.TestClient(app.create())
+
+
+def test_job_lifecycle(client):
+    print('test_job_lifecycle')
+    result = client.simulate_post('/lookup/jobs', body='x,y\n1,2\n3,4\n1,2\n',
+                                  query_string='areas=0&grids=0&shoredistance=0', headers={'Content-Type': 'text/csv'})
+    assert result.status_code == 202
+    job_id = result.json['id']
+    assert result.headers['location'].endswith('/lookup/jobs/' + job_id)
+    assert result.json['npoints'] == 3 and result.json['nchunks'] == 2
+    assert client.simulate_get('/lookup/jobs/' + job_id + '/result').status_code == 409
+
+    jobs.run_job(Pool(2), jobs.get_job(job_id))
+    status = client.simulate_get('/lookup/jobs/' + job_id).json
+    assert status['status'] == jobs.FINISHED and status['progress'] == 1.0
+    result = client.simulate_get('/lookup/jobs/' + job_id + '/result')
+    assert result.status_code == 200
+    assert result.text.splitlines() == ['{}', '{}', '{}']
+
+
+def test_job_resumes(client):
+    print('test_job_resumes')
+    packed = msgpack.dumps({'points': [[1, 2], [3, 4], [5, 6]], 'areas': False, 'grids': False,
+                            'shoredistance': False}, use_bin_type=True)
+    job_id = client.simulate_post('/lookup/jobs', body=packed, headers={'Content-Type': 'application/msgpack'}).json['id']
+    done = os.path.join(jobs.job_dir(job_id), 'chunks', '0')
+    with open(done, 'wb') as f:
+        f.write(msgpack.dumps(['from before the restart']))
+    assert jobs.get_job(job_id)['progress'] == 0.5
+    jobs.run_job(Pool(1), jobs.get_job(job_id))
+    result = client.simulate_get('/lookup/jobs/' + job_id + '/result')
+    assert list(msgpack.Unpacker(io.BytesIO(result.content), raw=False)) == [['from before the restart'], [{}]]
+
+
+def test_job_not_found(client):
+    print('test_job_not_found')
+    assert client.simulate_get('/lookup/jobs/../../etc').status_code == 404
+    assert client.simulate_get('/lookup/jobs/abc123').status_code == 404
@@ -0,0 +1,61 @@
+import time
+from collections import OrderedDict
+from functools import partial
+import falcon
+import numpy as np
+import pytest
+import service.lookup as lookup
+# Terminal run: python -m pytest
+
+
+def _slow_stage(value, delay=0.2):
+    time.sleep(delay)
+    return value
+
+
+def test_run_stages_concurrently():
+    print('test_run_stages_concurrently')
+    stages = OrderedDict((name, partial(_slow_stage, name)) for name in ['db', 'grids', 'shoredistance'])
+    start = time.time()
+    results = lookup._run_stages(stages)
+    assert results == {'db': 'db', 'grids': 'grids', 'shoredistance': 'shoredistance'}
+    assert time.time() - start < 0.4
+
+
+def test_run_stages_raises_stage_errors():
+    print('test_run_stages_raises_stage_errors')
+    def failing():
+        raise ValueError('stage failed')
+    stages = OrderedDict([('db', partial(_slow_stage, 'db', 0)), ('grids', failing)])
+    with pytest.raises(ValueError):
+        lookup._run_stages(stages)
+
+
+def test_lookup_stream_chunks(monkeypatch):
+    print('test_lookup_stream_chunks')
+    calls = []
+    def lookup_points(points, *args):
+        calls.append(len(points))
+        if len(calls) == 3:
+            raise ValueError('chunk failed')
+        return [{'x': x} for x in points[:, 0].tolist()]
+    monkeypatch.setattr(lookup, 'lookup_points', lookup_points)
+    points = np.column_stack((np.arange(10.0), np.zeros(10)))
+    options = {'areas': False, 'grids': True, 'shoredistance': False, 'areasdistancewithin': 0, 'stream': True}
+    chunks = lookup.lookup_stream(points, options, chunksize=4)
+    assert calls == [4]  # the first chunk is looked up before streaming starts
+    assert next(chunks) == [{'x': x} for x in range(4)]
+    assert len(next(chunks)) == 4
+    with pytest.raises(falcon.HTTPError):
+        next(chunks)
+
+
+def test_compact_areas(monkeypatch):
+    print('test_compact_areas')
+    monkeypatch.setattr(lookup.config, 'areas', {'final_grid5': ('obis', ['id', 'name'])})
+    a, b = {'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}
+    areavals = [{'obis': [a, b]}, {}, {'obis': [b]}]
+    compact = lookup._compact_areas(areavals, np.array([0, 1, 0, 2, 1]))['obis']
+    assert compact['values'] == [a, b]
+    assert compact['offsets'].tolist() == [0, 2, 2, 4, 5, 5]
+    assert compact['indices'].tolist() == [0, 1, 0, 1, 1]
@@ -0,0 +1,28 @@
+import os
+import subprocess
+import sys
+import pytest
+import service.memory as memory
+# Terminal run: python -m pytest
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/smaps'), reason='needs the Linux /proc filesystem')
+
+
+def test_process_memory():
+    print('test_process_memory')
+    m = memory.process_memory()
+    assert m['Rss'] > 0 and m['Private'] > 0
+    assert m['Shared'] + m['Private'] <= m['Rss'] + 1
+
+
+def test_report_includes_children():
+    print('test_report_includes_children')
+    child = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(5)'])
+    try:
+        rows = memory.report(os.getpid())
+        assert rows[0][:2] == (os.getpid(), 'master')
+        assert child.pid in [pid for pid, role, _ in rows if role == 'worker']
+        assert 'private' in memory.format_report(rows)
+    finally:
+        child.kill()
+        child.wait()
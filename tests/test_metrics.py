@@ -0,0 +1,105 @@
+import json
+import os
+from falcon import testing
+import pytest
+import service.app as app
+import service.config as config
+import service.metrics as metrics
+import service.resultcache as resultcache
+# Terminal run: python -m pytest
+
+
+@pytest.fixture()
+def client(monkeypatch):
+    monkeypatch.setattr(config, 'onland', 'landmask')
+    return testing.TestClient(app.create())
+
+
+def test_registry_render():
+    print('test_registry_render')
+    registry = metrics.Registry(buckets=(0.1, 1.0))
+    registry.describe('requests_total', 'counter', 'Requests')
+    registry.inc('requests_total', (('status', '200'),))
+    registry.inc('requests_total', (('status', '200'),), 2)
+    for value in (0.05, 0.5, 5):
+        registry.observe('seconds', value)
+    assert registry.counter('requests_total', (('status', '200'),)) == 3
+    assert registry.histogram('seconds') == (3, 5.55)
+    text = registry.render([('cache_bytes', 'gauge', (), 10)])
+    assert '# TYPE requests_total counter' in text
+    assert 'requests_total{status="200",pid="' in text
+    assert 'seconds_bucket{le="0.1",pid="' in text and 'seconds_bucket{le="+Inf",pid="' in text
+    assert [line.split()[-1] for line in text.splitlines() if line.startswith('seconds_bucket')] == ['1', '2', '3']
+    assert '# TYPE cache_bytes gauge' in text
+
+
+def test_server_timing():
+    print('test_server_timing')
+    timings = metrics.Timings()
+    with timings.stage('grids', 10):
+        pass
+    with timings.stage('grids', 5):
+        pass
+    with pytest.raises(ValueError):
+        with timings.stage('failing'):
+            raise ValueError()
+    header = timings.server_timing(0.5)
+    assert header.startswith('grids;dur=')
+    assert 'desc="15 points"' in header and 'failing;dur=' in header and header.endswith('total;dur=500.00')
+    assert metrics.registry.counter('xylookup_stage_errors_total', (('stage', 'failing'),)) >= 1
+
+
+def test_lookup_timing_and_metrics(client):
+    print('test_lookup_timing_and_metrics')
+    before = metrics.registry.counter('xylookup_requests_total', (('endpoint', 'lookup'), ('status', '200')))
+    result = client.simulate_get('/lookup', query_string='x=1,2&y=3,4&areas=false')
+    assert result.status_code == 200
+    stages = [part.split(';')[0] for part in result.headers['Server-Timing'].split(', ')]
+    for stage in ('parse', 'dedup', 'grids', 'shoredistance', 'onland', 'results', 'serialize', 'total'):
+        assert stage in stages
+    assert client.simulate_get('/lookup', query_string='x=1000&y=3').status_code == 400
+    result = client.simulate_get('/lookup/metrics')
+    assert result.status_code == 200 and result.headers['content-type'].startswith('text/plain')
+    assert metrics.registry.counter('xylookup_requests_total', (('endpoint', 'lookup'), ('status', '200'))) == before + 1
+    assert 'xylookup_requests_total{endpoint="lookup",status="400"' in result.text
+    assert 'xylookup_stage_seconds_bucket{stage="grids",le="0.001"' in result.text
+    assert 'xylookup_tile_cache_hits_total' in result.text
+
+
+def test_render_groups_families():
+    print('test_render_groups_families')
+    registry = metrics.Registry(buckets=(1.0,))
+    registry.inc('a_total', (('s', '1'),))
+    registry.inc('b_total')
+    registry.inc('a_total', (('s', '2'),))
+    registry.observe('c_seconds', 0.5, (('stage', 'x'),))
+    registry.observe('d_seconds', 0.5)
+    registry.observe('c_seconds', 0.5, (('stage', 'y'),))
+    names = [line.split('{')[0].split(' ')[0] for line in registry.render().splitlines() if not line.startswith('#')]
+    names = [name.replace('_bucket', '').replace('_sum', '').replace('_count', '') for name in names]
+    families = [name for i, name in enumerate(names) if i == 0 or names[i - 1] != name]
+    assert families == ['a_total', 'b_total', 'c_seconds', 'd_seconds']
+
+
+def test_metrics_of_all_workers(monkeypatch, tmpdir):
+    print('test_metrics_of_all_workers')
+    monkeypatch.setattr(config, 'metrics_dir', str(tmpdir))
+    monkeypatch.setattr(resultcache, 'cache', None)
+    other = {'pid': 2 ** 22 + 1, 'counters': [['xylookup_points_total', [], 5]],
+             'histograms': [['xylookup_stage_seconds', [['stage', 'grids']], [1] + [0] * len(metrics.BUCKETS), 0.0005]],
+             'collected': [['xylookup_tile_cache_hits_total', 'counter', [], 3],
+                           ['xylookup_tile_cache_bytes', 'gauge', [], 100]]}  # a worker that exited
+    with open(str(tmpdir.join('1.json')), 'w') as f:
+        json.dump(other, f)
+    own = metrics.registry.counter('xylookup_points_total')
+    hits = metrics.tiles.cache.hits
+    count = metrics.registry.histogram('xylookup_stage_seconds', (('stage', 'grids'),))[0]
+    text = metrics.render()
+    assert 'pid=' not in text
+    assert 'xylookup_points_total {}'.format(own + 5) in text
+    assert 'xylookup_tile_cache_hits_total {}'.format(hits + 3) in text
+    assert 'xylookup_tile_cache_bytes {}'.format(metrics.tiles.cache.nbytes) in text  # no gauges of exited workers
+    assert 'xylookup_stage_seconds_count{{stage="grids"}} {}'.format(count + 1) in text
+    assert os.path.exists(str(tmpdir.join('{}.json'.format(os.getpid()))))
+    metrics.clear()
+    assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,49 @@
+import os
+import pstats
+from falcon import testing
+import pytest
+import service.app as app
+import service.config as config
+# Terminal run: python -m pytest
+
+QUERY = 'x=1,2&y=3,4&areas=false'
+
+
+@pytest.fixture()
+def client(monkeypatch):
+    monkeypatch.setattr(config, 'onland', 'landmask')
+    monkeypatch.setattr(config, 'profile_token', 'secret')
+    return testing.TestClient(app.create())
+
+
+def test_profile_report(client):
+    print('test_profile_report')
+    result = client.simulate_get('/lookup', query_string=QUERY, headers={'X-Profile': 'secret'})
+    assert result.status_code == 200
+    assert result.headers['content-type'].startswith('text/plain')
+    assert 'function calls' in result.text
+    assert 'get_columns' in result.text and 'get_coastlinedistances' in result.text  # stages on the stage executor
+    assert result.headers['x-request-id']
+
+
+def test_profile_needs_token(client, monkeypatch):
+    print('test_profile_needs_token')
+    result = client.simulate_get('/lookup', query_string=QUERY, headers={'X-Profile': 'wrong'})
+    assert len(result.json) == 2 and 'x-request-id' not in result.headers
+    monkeypatch.setattr(config, 'profile_token', None)
+    result = client.simulate_get('/lookup', query_string=QUERY, headers={'X-Profile': 'secret'})
+    assert len(result.json) == 2
+
+
+def test_profile_saved(client, monkeypatch, tmpdir):
+    print('test_profile_saved')
+    monkeypatch.setattr(config, 'profile_dir', str(tmpdir))
+    result = client.simulate_get('/lookup', query_string=QUERY + '&stream=true',
+                                 headers={'X-Profile': 'secret', 'X-Request-Id': 'req-1'})
+    assert len(result.json) == 2  # not streamed
+    assert result.headers['x-profile-file'] == os.path.join(str(tmpdir), 'req-1.prof')
+    assert pstats.Stats(result.headers['x-profile-file']).total_calls > 0
+    result = client.simulate_get('/lookup', query_string=QUERY,
+                                 headers={'X-Profile': 'secret', 'X-Request-Id': '../escape'})
+    assert result.headers['x-request-id'] != '../escape'
+    assert os.path.dirname(result.headers['x-profile-file']) == str(tmpdir)
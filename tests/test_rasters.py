@@ -0,0 +1,18 @@
+import numpy as np
+import service.rasters as rasters
+# Terminal run: python -m pytest
+
+
+def test_raster_columns_match_values():
+    print('test_raster_columns_match_values')
+    points = np.array([[2.890605926513672, 51.241779327392585], [180, 0], [3, 55], [0, -90], [-49, 51]])
+    columns = rasters.get_columns(points)
+    values = rasters.get_values(points)
+    assert set(columns) == rasters.get_categories()
+    for category, column in columns.items():
+        assert len(column) == len(points)
+        for i, value in enumerate(column):
+            if np.isnan(value):
+                assert category not in values[i]
+            else:
+                assert values[i][category] == value
@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import numpy as np
+import service.resultcache as resultcache
+# Terminal run: python -m pytest
+
+
+def test_result_cache_tiers(tmpdir):
+    print('test_result_cache_tiers')
+    path = str(tmpdir.join('cache.sqlite'))
+    cache = resultcache.ResultCache(4, 1024 * 1024, path, version='1')
+    points = np.array([[1.00001, 2], [3, 4]])
+    keys = cache.keys(points, '1110')
+    assert cache.get_many(keys) == [None, None]
+    cache.put_many(keys, [{'shoredistance': 10.0}, {'grids': {'bathymetry': 5.5}}])
+    assert cache.keys(np.array([[1.000012, 2]]), '1110')[0] == keys[0]  # same key after rounding
+    assert cache.get_many(keys) == [{'shoredistance': 10.0}, {'grids': {'bathymetry': 5.5}}]
+    # another worker only shares the sqlite file
+    other = resultcache.ResultCache(4, 1024 * 1024, path, version='1')
+    assert other.get_many(keys)[1] == {'grids': {'bathymetry': 5.5}}
+    assert other.stats()['shared_hits'] == 2
+    # other stages or data versions don't reuse results
+    assert other.get_many(other.keys(points, '0110')) == [None, None]
+    newer = resultcache.ResultCache(4, 1024, path, version='2')
+    assert newer.get_many(newer.keys(points, '1110')) == [None, None]
+
+
+def test_result_cache_is_bounded():
+    print('test_result_cache_is_bounded')
+    cache = resultcache.ResultCache(6, 1000)
+    points = np.column_stack((np.arange(100.0), np.zeros(100)))
+    keys = cache.keys(points, '1110')
+    cache.put_many(keys, [{'shoredistance': float(i)} for i in range(100)])
+    stats = cache.stats()
+    assert stats['bytes'] <= 1000 and 0 < stats['entries'] < 100
+    assert cache.get_many(keys[-1:]) == [{'shoredistance': 99.0}]
+    assert cache.get_many(keys[:1]) == [None]
+
+
+class LockedConnection(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, *args):
+        raise sqlite3.OperationalError('database is locked')
+
+    executemany = execute
+
+
+def test_result_cache_shared_locked(tmpdir):
+    print('test_result_cache_shared_locked')
+    cache = resultcache.ResultCache(4, 1024 * 1024, str(tmpdir.join('cache.sqlite')))
+    cache._local.conn = os.getpid(), LockedConnection()
+    keys = cache.keys(np.array([[1, 2]]), '1110')
+    assert cache.get_many(keys) == [None]  # a miss
+    cache.put_many(keys, [{'shoredistance': 10.0}])  # only cached in process
+    assert cache.get_many(keys) == [{'shoredistance': 10.0}]
+    assert cache.stats()['misses'] == 1
@@ -0,0 +1,135 @@
+import os
+import math
+import csv
+import numpy as np
+import pytest
+import service.config as config
+import service.shoredistance as shoredistance
+# Terminal run: python -m pytest
+
+
+def _np_gc_distance(p, points):
+    """ http://www.movable-type.co.uk/scripts/latlong.html """
+    dLon = np.radians(points[:, 0] - p[0])  # * 0.0174532925
+    lat1 = np.radians(p[1])
+    lat2 = np.radians(points[:,1])
+    return np.arccos(np.sin(lat1) * np.sin(lat2) + np.cos(lat1) * np.cos(lat2) * np.cos(dLon))
+
+
+def _gc_distance(A, B):
+    """ http://www.movable-type.co.uk/scripts/latlong.html """
+    dLon = math.radians(B[0]-A[0])  # * 0.0174532925
+    if abs(dLon) < 1.7453e-10 and abs(math.radians(B[1]-A[1])) < 1.7453e-10:
+        return 0
+    lat1 = math.radians(A[1])
+    lat2 = math.radians(B[1])
+
+    try:
+        return(math.acos(math.sin(lat1)*math.sin(lat2) + math.cos(lat1)*math.cos(lat2) * math.cos(dLon)))
+    except ValueError:
+        return 0
+
+def _gc_distancetoline(p, A, B):
+    """ http://www.movable-type.co.uk/scripts/latlong.html """
+    xd = B[0] - A[0]
+    yd = B[1] - A[1]
+    r = ((p[0]- A[0])*(xd) + (p[1]- A[1])*yd)/(xd*xd + yd*yd)
+    if 0 < r < 1:
+        pointOnLine = (A[0] + r * xd, A[1] + r * yd)
+        return _gc_distance(p, pointOnLine)
+    else:
+        return float("Inf") # minimum distance to p, A and p, B has already been calculated
+
+
+def _getcoastlinedistance_loop(positions, tree, coastpoints, coastlines):
+    """ Point by point reference implementation of shoredistance._getcoastlinedistance """
+    radius = 6371000
+    positions = np.array(positions)
+    _, indexes = tree.query(shoredistance._np_to_cartesian(positions), k=5, eps=0.00001, p=2)
+    mindistances = np.zeros(len(positions))
+    for i, p in enumerate(positions):
+        distances = _np_gc_distance(p, coastpoints[indexes[i,]])
+        mindistance = distances[0]
+        if mindistance < (5000.0 / radius):  # less than 5 km
+            maxresultindex = np.searchsorted(distances, distances[0] + (250.0 / radius), side="left")
+            for resultsindex in range(maxresultindex):
+                point_index = indexes[i,resultsindex]
+                coastline_index = np.searchsorted(coastlines, point_index, side="right")
+                minpointindex_coastline = coastlines[coastline_index-1]
+                maxpointindex_coastline = coastlines[coastline_index] - 1
+                d1, d2 = None, None # d1 line to the left, d2 line to the right
+                if point_index > minpointindex_coastline:
+                    d1 = _gc_distancetoline(p, coastpoints[point_index - 1], coastpoints[point_index])
+                if point_index < maxpointindex_coastline:
+                    d2 = _gc_distancetoline(p, coastpoints[point_index], coastpoints[point_index + 1])
+                if (not d1 or not d2) and np.array_equal(coastpoints[minpointindex_coastline], coastpoints[maxpointindex_coastline]): # polygon coastline
+                    if not d1:
+                        d1 = _gc_distancetoline(p, coastpoints[maxpointindex_coastline], coastpoints[maxpointindex_coastline-1]) # laatste segment
+                    if not d2:
+                        d2 = _gc_distancetoline(p, coastpoints[minpointindex_coastline], coastpoints[minpointindex_coastline+1]) # eerste segment
+                if d1 and d1 < mindistance:
+                    mindistance = d1
+                if d2 and d2 < mindistance:
+                    mindistance = d2
+        mindistances[i] = mindistance
+
+    return mindistances * radius
+
+
+@pytest.fixture()
+def coastline():
+    rng = np.random.RandomState(42)
+    lines = []
+    for i in range(200):
+        cx, cy = rng.uniform(-10, 10), rng.uniform(40, 60)
+        if i % 3 == 0:  # closed polygon
+            a = np.linspace(0, 2 * np.pi, rng.randint(5, 50))
+            line = np.column_stack((cx + 0.1 * np.cos(a), cy + 0.1 * np.sin(a)))
+            line[-1] = line[0]
+        else:
+            line = np.cumsum(rng.normal(0, 0.005, (rng.randint(2, 50), 2)), axis=0) + [cx, cy]
+        lines.append(line)
+    coastpoints = np.concatenate(lines)
+    coastlines = np.cumsum([0] + [len(l) for l in lines])
+    return shoredistance._build_kdtree(coastpoints), coastpoints, coastlines
+
+
+def test_getcoastlinedistance_matches_loop(coastline):
+    print('test_getcoastlinedistance_matches_loop')
+    tree, coastpoints, coastlines = coastline
+    rng = np.random.RandomState(1)
+    points = coastpoints[rng.randint(0, len(coastpoints), 2000)] + rng.normal(0, 0.01, (2000, 2))
+    points[:10] = coastpoints[:10]  # exactly on the coastline
+    expected = _getcoastlinedistance_loop(points, tree, coastpoints, coastlines)
+    actual = shoredistance._getcoastlinedistance(points, tree, coastpoints, coastlines)
+    assert actual == pytest.approx(expected, abs=1e-6, nan_ok=True)
+
+
+def test_coastlines_cache_rebuilt_when_source_changes(tmpdir):
+    print('test_coastlines_cache_rebuilt_when_source_changes')
+    path = str(tmpdir.join('coastlines.jsonlines'))
+    with open(path, 'w') as f:
+        f.write('{"type": "LineString", "coordinates": [[0, 0], [1, 1], [2, 1]]}\n')
+    coastpoints, coastlines, tree = shoredistance._load_cache(path)
+    assert len(coastpoints) == 3 and list(coastlines) == [0, 3]
+    with open(path, 'a') as f:
+        f.write('{"type": "LineString", "coordinates": [[5, 5], [6, 6]]}\n')
+    coastpoints, coastlines, tree = shoredistance._load_cache(path)
+    assert len(coastpoints) == 5 and list(coastlines) == [0, 3, 5]
+    _, index = tree.query(shoredistance._np_to_cartesian(np.array([[6.0, 6.0]])))
+    assert index[0] == 4
+
+
+@pytest.mark.skipif(not os.path.exists(os.path.join(config.landmaskdir, 'landmask.json')),
+                    reason='landmask not created, see dataprep/landmask.py')
+def test_landmask_matches_postgis():
+    print('test_landmask_matches_postgis')
+    import service.landmask as landmask
+    import service.lookup as lookup
+    import service.db as db
+    with open("./tests/r_testlookup.csv") as csvfile:
+        points = np.array([row[0:2] for i, row in enumerate(csv.reader(csvfile, delimiter=",")) if i > 0], dtype=float)
+    with db.pool.connection() as conn, conn.cursor() as cur:
+        pointstable = lookup.load_points(cur, points)
+        expected = shoredistance._on_land(cur, pointstable, len(points))
+    assert list(landmask.on_land(points)) == list(expected)
@@ -0,0 +1,97 @@
+from falcon import testing
+import numpy as np
+import pytest
+import service.app as app
+import service.config as config
+import service.startup as startup
+# Terminal run: python -m pytest
+
+
+@pytest.fixture()
+def client(monkeypatch):
+    monkeypatch.setattr(config, 'onland', 'landmask')
+    monkeypatch.setattr(config, 'areas_engine', 'memory')
+    monkeypatch.setattr(config, 'areas_distance_engine', 'memory')
+    return testing.TestClient(app.create())
+
+
+def test_subsystem_loads_once():
+    print('test_subsystem_loads_once')
+    calls = []
+    subsystem = startup.Subsystem('test_once', lambda: calls.append(1) or 'value', lambda value: [np.zeros(1000)])
+    assert subsystem.state == startup.PENDING
+    assert subsystem.get() == 'value' and subsystem.get() == 'value'
+    assert len(calls) == 1
+    subsystem.warm()
+    status = subsystem.status()
+    assert status['state'] == startup.READY and status['load_seconds'] >= 0 and status['warm_bytes'] == 8000
+
+
+def test_subsystem_failure_is_retried():
+    print('test_subsystem_failure_is_retried')
+    attempts = []
+
+    def load():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise IOError('missing file')
+        return 'value'
+    subsystem = startup.Subsystem('test_retry', load)
+    with pytest.raises(IOError):
+        subsystem.get()
+    assert subsystem.status()['state'] == startup.FAILED and 'missing' in subsystem.status()['error']
+    assert subsystem.get() == 'value'
+    assert subsystem.status()['state'] == startup.READY and subsystem.status()['error'] is None
+
+
+def test_touch_memmap(tmpdir):
+    print('test_touch_memmap')
+    path = str(tmpdir.join('a.npy'))
+    np.save(path, np.arange(10000, dtype=np.int32))
+    assert startup.touch(np.load(path, mmap_mode='r')) == 40000
+    assert startup.touch(np.zeros((0, 2))) == 0
+
+
+def test_required(monkeypatch):
+    print('test_required')
+    monkeypatch.setattr(config, 'onland', 'postgis')
+    monkeypatch.setattr(config, 'areas_engine', 'postgis')
+    assert startup.required() == ['coastlines', 'rasters']
+    assert startup.database_required()
+    monkeypatch.setattr(config, 'onland', 'landmask')
+    monkeypatch.setattr(config, 'areas_engine', 'memory')
+    assert startup.required() == ['coastlines', 'rasters', 'landmask', 'areaindex']
+    assert startup.database_required()  # areasdistancewithin
+    monkeypatch.setattr(config, 'areas_distance_engine', 'memory')
+    assert not startup.database_required()
+
+
+def test_health(client):
+    print('test_health')
+    result = client.simulate_get('/lookup/health')
+    assert result.status_code == 200
+    assert result.json['status'] == 'ok'
+    assert set(result.json['subsystems']) == {'coastlines', 'rasters', 'landmask', 'areaindex'}
+
+
+def test_ready(client, monkeypatch):
+    print('test_ready')
+    monkeypatch.setattr(config, 'warmup', False)
+    names = startup.required()
+    for name in names[:-1]:
+        monkeypatch.setattr(startup.get(name), 'state', startup.READY)
+    failed = startup.get(names[-1])
+    monkeypatch.setattr(failed, 'state', startup.FAILED)
+    monkeypatch.setattr(failed, 'error', 'missing file')
+    monkeypatch.setattr(failed, 'value', None)
+    monkeypatch.setattr(failed, '_load', lambda: 'value')
+    result = client.simulate_get('/lookup/ready')
+    assert result.status_code == 503
+    assert result.json['ready'] is False
+    assert result.json['subsystems'][names[-1]]['state'] == startup.FAILED
+    startup.load_all()
+    result = client.simulate_get('/lookup/ready')
+    assert result.status_code == 200
+    assert result.json['ready'] is True
+    assert failed.value == 'value'
+    assert 'database' not in result.json
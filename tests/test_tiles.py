@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import service.tiles as tiles
+# Terminal run: python -m pytest
+
+
+@pytest.fixture()
+def tiled(tmpdir):
+    arr = np.random.RandomState(1).uniform(-100, 100, (1000, 700)).astype(np.float32)
+    path = str(tmpdir.join('raster'))
+    writer = tiles.TileWriter(path, arr.shape, arr.dtype, 128, fill=-9999)
+    for row in range(0, arr.shape[0], 128):
+        writer.write_rows(arr[row:row + 128])
+    writer.close()
+    return arr, path
+
+
+def test_tiled_array_matches_array(tiled):
+    print('test_tiled_array_matches_array')
+    arr, path = tiled
+    data = tiles.TiledArray(path, arr.dtype, arr.shape, 128, tiles.TileCache(10 * 1024 * 1024))
+    rng = np.random.RandomState(2)
+    rows, cols = rng.randint(0, arr.shape[0], 5000), rng.randint(0, arr.shape[1], 5000)
+    rows[:2], cols[:2] = [0, arr.shape[0] - 1], [0, arr.shape[1] - 1]
+    assert np.array_equal(data[rows, cols], arr[rows, cols])
+    assert len(data[rows[:0], cols[:0]]) == 0
+
+
+def test_tile_cache_is_bounded(tiled):
+    print('test_tile_cache_is_bounded')
+    arr, path = tiled
+    tilebytes = 128 * 128 * 4
+    cache = tiles.TileCache(3 * tilebytes)
+    data = tiles.TiledArray(path, arr.dtype, arr.shape, 128, cache)
+    rows, cols = np.repeat(np.arange(0, 1000, 128), 6), np.tile(np.arange(0, 700, 128), 8)
+    assert np.array_equal(data[rows, cols], arr[rows, cols])
+    assert cache.nbytes <= 3 * tilebytes and cache.misses == 48
+    data[rows[-1:], cols[-1:]]
+    assert cache.hits == 1
+
+
+def test_tile_counter_per_request(tiled):
+    print('test_tile_counter_per_request')
+    import threading
+    import service.metrics as metrics
+    arr, path = tiled
+    data = tiles.TiledArray(path, arr.dtype, arr.shape, 128, tiles.TileCache(10 * 1024 * 1024))
+    rows, cols = np.array([0, 1, 300]), np.array([0, 1, 0])
+    timings = metrics.Timings()
+    with timings.stage('grids', 3):
+        data[rows, cols]
+        other = threading.Thread(target=lambda: [data[rows, cols] for _ in range(5)])  # another request
+        other.start()
+        other.join()
+        data[rows, cols]
+    data[rows, cols]  # outside the stages of the request
+    assert (timings.tilecache.hits, timings.tilecache.misses) == (2, 2)
+    assert (data.cache.hits, data.cache.misses) == (14, 2)